@@ -17,6 +17,7 @@ CONFIG = {
     'animate': True,
     'nice': 0,
     'tqdm': False,  # disable=CONFIG['tqdm']
+    'boosting_backend': 'process',
 }
 
 
@@ -31,6 +32,7 @@ def configure(
         animate=None,
         nice=None,
         tqdm=None,
+        boosting_backend=None,
 ):
     """Set basic configuration parameters for the current session
 
@@ -74,6 +76,10 @@ def configure(
         other processes; negative numbers require root privileges).
     tqdm : bool
         Enable or disable :mod:`tqdm` progress bars.
+    boosting_backend : 'process' | 'thread'
+        Run :func:`boosting` in worker processes (default) or in threads of
+        the current process. Threads share the data without copying it and
+        don't need to start new processes.
     """
     # don't change values before raising an error
     new = {}
@@ -119,5 +125,9 @@ def configure(
         new['nice'] = nice
     if tqdm is not None:
         new['tqdm'] = not tqdm
+    if boosting_backend is not None:
+        if boosting_backend not in ('process', 'thread'):
+            raise ValueError("boosting_backend=%r" % (boosting_backend,))
+        new['boosting_backend'] = boosting_backend
 
     CONFIG.update(new)
@@ -7541,9 +7541,10 @@ class Scalar(Dimension):
             A dataset with variables describing cluster properties.
         """
         ds = Dataset()
-        where = [np.flatnonzero(cluster) for cluster in x]
-        ds['%s_min' % self.name] = Var([self.values[w[0]] for w in where])
-        ds['%s_max' % self.name] = Var([self.values[w[-1]] for w in where])
+        first = np.argmax(x, 1)
+        last = x.shape[1] - 1 - np.argmax(x[:, ::-1], 1)
+        ds['%s_min' % self.name] = Var(self.values[first])
+        ds['%s_max' % self.name] = Var(self.values[last])
         return ds
 
     @classmethod
@@ -8613,27 +8614,20 @@ class SourceSpace(Dimension):
             return ds
 
         # hemi
-        hemis = []
-        for x_ in x:
-            where = np.flatnonzero(x_)
-            src_in_lh = (where < self.lh_n)
-            if np.all(src_in_lh):
-                hemis.append('lh')
-            elif np.any(src_in_lh):
-                hemis.append('bh')
-            else:
-                hemis.append('rh')
+        in_lh = x[:, :self.lh_n].any(1)
+        in_rh = x[:, self.lh_n:].any(1)
+        hemis = np.where(in_lh, np.where(in_rh, 'bh', 'lh'), 'rh')
         ds['hemi'] = Factor(hemis)
 
-        # location
+        # location: the most frequent label among the cluster's sources
         if self.parc is not None:
-            locations = []
-            for x_ in x:
-                parc_entries = self.parc[x_]
-                argmax = np.argmax(np.bincount(parc_entries.x))
-                location = parc_entries[argmax]
-                locations.append(location)
-            ds['location'] = Factor(locations)
+            codes = self.parc.x
+            n_codes = codes.max() + 1
+            cluster, source = np.nonzero(x)
+            counts = np.bincount(cluster * n_codes + codes[source],
+                                 minlength=len(x) * n_codes)
+            argmax = counts.reshape((len(x), n_codes)).argmax(1)
+            ds['location'] = Factor([self.parc._labels[code] for code in argmax])
 
         return ds
 
@@ -8725,7 +8719,7 @@ class SourceSpace(Dimension):
             if parc is None:
                 raise RuntimeError("SourceSpace has no parcellation (use "
                                    ".set_parc())")
-            idx = np.array([parc[s] == parc[d] for s, d in connectivity])
+            idx = parc.x[connectivity[:, 0]] == parc.x[connectivity[:, 1]]
             connectivity = connectivity[idx]
 
         return connectivity
@@ -9169,13 +9163,11 @@ class UTS(Dimension):
             first axis.
         """
         # find indices of cluster extent
-        row, col = np.nonzero(x)
-        try:
-            ts = [col[row == i][[0, -1]] for i in range(len(x))]
-        except IndexError:
+        if not np.all(x.any(1)):
             raise ValueError("Empty cluster")
-        ts = np.array(ts)
-        return ts
+        first = np.argmax(x, 1)
+        last = x.shape[1] - 1 - np.argmax(x[:, ::-1], 1)
+        return np.column_stack((first, last))
 
     def _cluster_properties(self, x):
         """Find cluster properties for this dimension
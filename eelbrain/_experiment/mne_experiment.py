@@ -3679,7 +3679,7 @@ class MneExperiment(FileTree):
         dst = self.get('test-file', mkdir=True)
 
         # try to load cached test
-        res = None
+        res = resume = None
         desc = self._get_rel('test-file', 'test-dir')
         if self._result_file_mtime(dst, data):
             try:
@@ -3699,6 +3699,8 @@ class MneExperiment(FileTree):
                                   "make=True to perform the test." %
                                   (desc, res.samples, samples))
                 else:
+                    # reuse permutations from the cached test
+                    resume = res
                     res = None
         elif not make and exists(dst):
             raise IOError("The requested test is outdated: %s. Set make=True "
@@ -3782,6 +3784,8 @@ class MneExperiment(FileTree):
 
             if do_test:
                 self._log.info("Make test: %s", desc)
+                if resume is not None:
+                    test_kwargs['resume'] = resume
                 res = self._make_test(y_name, res_data, test_obj, test_kwargs)
 
         if do_test:
@@ -7,9 +7,88 @@ from scipy.ndimage import generate_binary_structure
 VALID_TYPES = {'none', 'grid', 'custom'}
 
 
+class CustomGraph(object):
+    """Connectivity graph of a dimension with custom connectivity
+
+    Parameters
+    ----------
+    edges : array of int, (n_edges, 2)
+        Sorted ``[src, dst]`` pairs, with all ``src < dst``.
+    n_vertices : int
+        Number of vertices in the graph.
+
+    Attributes
+    ----------
+    edges : array of int, (n_edges, 2)
+        Sorted edges.
+    edge_start, edge_stop : array of int, (n_vertices,)
+        Range of ``edges`` with each vertex as ``src``.
+    indptr, indices : array of int
+        Symmetric graph in compressed sparse row (CSR) format: the neighbors
+        of vertex ``i`` are ``indices[indptr[i]:indptr[i + 1]]``.
+
+    Notes
+    -----
+    All arrays are read-only so that a graph can be shared between tests
+    and worker processes.
+    """
+    __slots__ = ('edges', 'edge_start', 'edge_stop', 'indptr', 'indices')
+
+    def __init__(self, edges, n_vertices):
+        n_edges = np.bincount(edges[:, 0], minlength=n_vertices)
+        self.edges = edges
+        self.edge_stop = np.cumsum(n_edges)
+        self.edge_start = self.edge_stop - n_edges
+        self.indptr, self.indices = _symmetric_csr(edges, n_vertices)
+        for k in self.__slots__:
+            getattr(self, k).setflags(write=False)
+
+
+def _symmetric_csr(edges, n_vertices):
+    "Symmetric CSR ``(indptr, indices)`` from one-directional edges"
+    edges = edges.astype(np.int64)
+    src = np.concatenate((edges[:, 0], edges[:, 1]))
+    dst = np.concatenate((edges[:, 1], edges[:, 0]))
+    indptr = np.zeros(n_vertices + 1, np.int64)
+    np.cumsum(np.bincount(src, minlength=n_vertices), out=indptr[1:])
+    indices = dst[np.lexsort((dst, src))]
+    return indptr, indices
+
+
+def custom_graph(dim, disconnect_parc=False):
+    """Connectivity graph for a dimension with custom connectivity
+
+    Graphs are memoized on the dimension object, so that repeated tests on
+    the same dimension build the graph only once.
+
+    Parameters
+    ----------
+    dim : Dimension
+        Dimension with custom connectivity.
+    disconnect_parc : bool
+        Remove connections between different regions of ``dim.parc``.
+
+    Returns
+    -------
+    graph : CustomGraph
+        Connectivity graph.
+    """
+    edges = dim.connectivity()
+    cache = getattr(dim, '_custom_graphs', None)
+    if cache is None or cache[0] is not edges:
+        # (re-)initialize if the dimension's connectivity has been modified
+        cache = dim._custom_graphs = (edges, {})
+    graphs = cache[1]
+    if disconnect_parc not in graphs:
+        if disconnect_parc:
+            edges = dim.connectivity(disconnect_parc=True)
+        graphs[disconnect_parc] = CustomGraph(edges, len(dim))
+    return graphs[disconnect_parc]
+
+
 class Connectivity(object):
     """N-dimensional connectivity"""
-    __slots__ = ('struct', 'custom')
+    __slots__ = ('struct', 'custom', 'custom_csr')
 
     def __init__(self, dims, parc=None):
         types = tuple(dim._connectivity_type for dim in dims)
@@ -20,6 +99,7 @@ class Connectivity(object):
 
         # custom connectivity
         self.custom = {}
+        self.custom_csr = {}
         n_custom = types.count('custom')
         if n_custom > 1:
             raise NotImplementedError("More than one axis with custom connectivity")
@@ -29,16 +109,9 @@ class Connectivity(object):
                 raise NotImplementedError(
                     "Custom connectivity on axis other than first")
             custom_dim = dims[axis]
-            if custom_dim.name == parc:
-                edges = custom_dim.connectivity(disconnect_parc=True)
-            else:
-                edges = custom_dim.connectivity()
-            dim_length = len(custom_dim)
-            src = edges[:, 0]
-            n_edges = np.bincount(src, minlength=dim_length)
-            edge_stop = np.cumsum(n_edges)
-            edge_start = edge_stop - n_edges
-            self.custom[axis] = (edges, edge_start, edge_stop)
+            graph = custom_graph(custom_dim, custom_dim.name == parc)
+            self.custom[axis] = (graph.edges, graph.edge_start, graph.edge_stop)
+            self.custom_csr[axis] = (graph.indptr, graph.indices)
 
         # prepare struct for grid connectivity
         self.struct = generate_binary_structure(len(dims), 1)
@@ -46,12 +119,43 @@ class Connectivity(object):
             if ctype != 'grid':
                 self.struct[(slice(None),) * i + (slice(None, None, 2),)] = False
 
+    def stack(self, n):
+        """Connectivity for ``n`` maps stacked on the first axis
+
+        The maps are not connected to each other. With custom connectivity,
+        the maps are concatenated along the first (custom) axis, and the
+        custom graph is repeated for each map. Otherwise, the maps are
+        stacked along a new first axis. The stacked connectivity is used for
+        labeling clusters only (no ``custom_csr``).
+        """
+        out = Connectivity.__new__(Connectivity)
+        out.custom_csr = {}
+        if self.custom:
+            edges, edge_start, edge_stop = self.custom[0]
+            n_vertices = len(edge_start)
+            n_edges = len(edges)
+            out.custom = {0: (
+                np.concatenate([edges + i * n_vertices for i in range(n)]).astype(np.uint32),
+                np.concatenate([edge_start + i * n_edges for i in range(n)]),
+                np.concatenate([edge_stop + i * n_edges for i in range(n)]),
+            )}
+            out.struct = self.struct
+        else:
+            out.custom = {}
+            out.struct = np.zeros((3,) + self.struct.shape, np.bool_)
+            out.struct[1] = self.struct
+        return out
+
     def __getstate__(self):
         return {k: getattr(self, k) for k in self.__slots__}
 
     def __setstate__(self, state):
         for k, v in state.items():
             setattr(self, k, v)
+        if 'custom_csr' not in state:
+            self.custom_csr = {
+                axis: _symmetric_csr(edges, len(edge_start)) for
+                axis, (edges, edge_start, _) in self.custom.items()}
 
 
 def find_peaks(x, connectivity, out=None):
@@ -1,7 +1,8 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
 #cython: boundscheck=False, wraparound=False
 
-from libc.stdlib cimport malloc, free
+from cython cimport floating
+from libc.stdlib cimport malloc, calloc, free
 import numpy as np
 cimport numpy as np
 
@@ -99,34 +100,231 @@ def merge_labels(np.ndarray[UINT32, ndim=2] cmap,
     return out
 
 
-def tfce_increment(np.ndarray[UINT32, ndim=1] labels,
-                   np.ndarray[UINT32, ndim=1] label_image,
-                   np.ndarray[FLOAT64, ndim=1] image,
-                   double e, double h_factor):
-    cdef unsigned int i, cid
-    cdef unsigned int n = image.shape[0]
-    cdef unsigned int n_labels = labels.max() + 1
+cdef inline Py_ssize_t find_root(Py_ssize_t* parent, double* acc,
+                                 Py_ssize_t* path, Py_ssize_t i):
+    "Find the root of ``i``, compressing the path while preserving ``acc`` sums"
+    cdef Py_ssize_t root = i
+    cdef Py_ssize_t n = 0
+    cdef Py_ssize_t j
+    while parent[root] != root:
+        path[n] = root
+        n += 1
+        root = parent[root]
+    # path[n - 1] is a child of root; compress from there
+    for j in range(n - 2, -1, -1):
+        i = path[j]
+        acc[i] += acc[parent[i]]
+        parent[i] = root
+    return root
 
-    cdef double* area = <double*> malloc(sizeof(double) * n_labels)
 
-    # initialize area
-    for i in range(n_labels):
-        area[i] = 0.
+cdef inline void flush(Py_ssize_t* size, Py_ssize_t* start, double* acc,
+                       double* cum_factor, double e, Py_ssize_t root,
+                       Py_ssize_t level):
+    "Add the TFCE value accumulated above ``level`` to the cluster of ``root``"
+    if start[root] > level:
+        if level < 0:
+            acc[root] += size[root] ** e * cum_factor[start[root]]
+        else:
+            acc[root] += size[root] ** e * (cum_factor[start[root]] -
+                                            cum_factor[level])
+        start[root] = level
+
+
+cdef inline void merge_clusters(Py_ssize_t* parent, Py_ssize_t* size,
+                                Py_ssize_t* start, double* acc,
+                                Py_ssize_t* path, double* cum_factor, double e,
+                                Py_ssize_t a, Py_ssize_t b, Py_ssize_t level):
+    "Merge the clusters containing ``a`` and ``b`` at ``level``"
+    a = find_root(parent, acc, path, a)
+    b = find_root(parent, acc, path, b)
+    if a == b:
+        return
+    flush(size, start, acc, cum_factor, e, a, level)
+    flush(size, start, acc, cum_factor, e, b, level)
+    if size[a] < size[b]:
+        a, b = b, a
+    parent[b] = a
+    acc[b] -= acc[a]
+    size[a] += size[b]
+
 
-    # determine area
-    for i in range(n):
-        cid = label_image[i]
-        if cid > 0:
-            area[cid] += 1.
+def tfce_union_find(np.ndarray[INT64, ndim=1] order,
+                    np.ndarray[INT64, ndim=1] levels,
+                    np.ndarray[FLOAT64, ndim=1] cum_factor,
+                    double e,
+                    np.ndarray[INT64, ndim=1] strides,
+                    np.ndarray[INT64, ndim=1] lengths,
+                    np.ndarray[INT64, ndim=1] custom_indptr,
+                    np.ndarray[INT64, ndim=1] custom_indices,
+                    np.ndarray[FLOAT64, ndim=1] out):
+    """Add the TFCE values for one tail to ``out``
 
-    # determine TFCE value
-    for cid in labels:
-        area[cid] = area[cid] ** e * h_factor
+    Parameters
+    ----------
+    order : array of int
+        Flat indices of all points with ``levels >= 0``, sorted by descending
+        ``levels``.
+    levels : array of int
+        For each point in the flattened map, the index of the highest
+        height it reaches (-1 for points below the lowest height).
+    cum_factor : array of float
+        Cumulative sum of ``height ** H`` over heights.
+    e : float
+        Extent exponent.
+    strides, lengths : array of int
+        Stride and length of each grid-connected axis of the map.
+    custom_indptr, custom_indices : array of int
+        Symmetric connectivity of the first axis in CSR format (empty if the
+        first axis does not have custom connectivity).
+    out : array of float
+        Flattened output map.
+
+    Notes
+    -----
+    Points are added in order of descending height and merged into clusters
+    with a union-find structure. The TFCE value of a cluster is accumulated
+    on its root whenever the cluster's extent changes, and the TFCE value of
+    each point is the sum of ``acc`` along the path to its root.
+    """
+    cdef Py_ssize_t n = out.shape[0]
+    cdef Py_ssize_t n_active = order.shape[0]
+    cdef Py_ssize_t n_axes = strides.shape[0]
+    cdef Py_ssize_t n_custom = custom_indptr.shape[0] - 1
+    cdef Py_ssize_t custom_stride = n // n_custom if n_custom > 0 else 0
+    cdef Py_ssize_t i, j, ax, src, dst, coord, step, vert, level, root
+
+    cdef Py_ssize_t* parent = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * n)
+    cdef Py_ssize_t* size = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * n)
+    cdef Py_ssize_t* start = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * n)
+    cdef Py_ssize_t* path = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * n)
+    cdef double* acc = <double*> malloc(sizeof(double) * n)
+    cdef char* active = <char*> calloc(n, sizeof(char))
+    cdef double* cum = &cum_factor[0]
+
+    for i in range(n_active):
+        src = order[i]
+        level = levels[src]
+        parent[src] = src
+        size[src] = 1
+        start[src] = level
+        acc[src] = 0
+        active[src] = 1
+
+        for ax in range(n_axes):
+            step = strides[ax]
+            coord = (src // step) % lengths[ax]
+            if coord > 0 and active[src - step]:
+                merge_clusters(parent, size, start, acc, path, cum, e,
+                               src, src - step, level)
+            if coord < lengths[ax] - 1 and active[src + step]:
+                merge_clusters(parent, size, start, acc, path, cum, e,
+                               src, src + step, level)
+
+        if n_custom > 0:
+            vert = src // custom_stride
+            for j in range(custom_indptr[vert], custom_indptr[vert + 1]):
+                dst = src + (custom_indices[j] - vert) * custom_stride
+                if active[dst]:
+                    merge_clusters(parent, size, start, acc, path, cum, e,
+                                   src, dst, level)
+
+    # add remaining values down to the lowest height
+    for i in range(n_active):
+        src = order[i]
+        if parent[src] == src:
+            flush(size, start, acc, cum, e, src, -1)
+
+    for i in range(n_active):
+        src = order[i]
+        root = find_root(parent, acc, path, src)
+        if root == src:
+            out[src] += acc[src]
+        else:
+            out[src] += acc[src] + acc[root]
 
-    # update TFCE image
-    for i in range(n):
-        cid = label_image[i]
-        if cid > 0:
-            image[i] += area[cid]
+    free(parent)
+    free(size)
+    free(start)
+    free(path)
+    free(acc)
+    free(active)
 
-    free(area)
+
+def cluster_mass_max(np.ndarray[UINT32, ndim=2] cmap,
+                     np.ndarray[floating, ndim=2] stat_map,
+                     np.ndarray[UINT32, ndim=1] cids,
+                     np.ndarray[INT64, ndim=1] row_parc,
+                     int tail,
+                     np.ndarray[FLOAT64, ndim=1] out):
+    """Largest cluster mass in each parcel
+
+    Parameters
+    ----------
+    cmap : array of int, ndim=2
+        Cluster map (non-adjacent dimension on the first axis).
+    stat_map : array of float, ndim=2
+        Statistical map corresponding to ``cmap`` (``float32`` or ``float64``;
+        masses are always summed in double precision).
+    cids : array of int
+        Cluster ids to include.
+    row_parc : array of int
+        Index of the parcel containing each row of ``cmap`` (-1 for rows
+        not in any parcel).
+    tail : int
+        Tail of the test; for ``tail <= 0`` the absolute mass is used.
+    out : array of float
+        Largest cluster mass in each parcel (0 for parcels without clusters).
+
+    Notes
+    -----
+    Each cluster is assumed to be contained in a single parcel, which is the
+    case when parcels are disconnected.
+    """
+    cdef Py_ssize_t n_rows = cmap.shape[0]
+    cdef Py_ssize_t n_cols = cmap.shape[1]
+    cdef Py_ssize_t n_cids = cids.shape[0]
+    cdef Py_ssize_t i, j, parc
+    cdef unsigned int label, max_label = 0
+    cdef double v
+
+    out[:] = 0
+    for i in range(n_cids):
+        if cids[i] > max_label:
+            max_label = cids[i]
+    if n_cids == 0:
+        return out
+
+    cdef double* mass = <double*> calloc(max_label + 1, sizeof(double))
+    cdef Py_ssize_t* label_parc = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * (max_label + 1))
+    cdef char* use_label = <char*> calloc(max_label + 1, sizeof(char))
+    for i in range(n_cids):
+        use_label[cids[i]] = 1
+        label_parc[cids[i]] = -1
+
+    for i in range(n_rows):
+        parc = row_parc[i]
+        if parc < 0:
+            continue
+        for j in range(n_cols):
+            label = cmap[i, j]
+            if label > max_label or not use_label[label]:
+                continue
+            mass[label] += stat_map[i, j]
+            label_parc[label] = parc
+
+    for i in range(n_cids):
+        label = cids[i]
+        parc = label_parc[label]
+        if parc < 0:
+            continue
+        v = mass[label]
+        if tail <= 0 and v < 0:
+            v = -v
+        if v > out[parc]:
+            out[parc] = v
+
+    free(mass)
+    free(label_parc)
+    free(use_label)
+    return out
@@ -12,7 +12,7 @@ Hopkins, K. D. (1976). A Simplified Method for Determining Expected Mean
 from collections import OrderedDict
 
 import numpy as np
-from scipy.linalg import lstsq
+from scipy.linalg import lstsq, orth
 import scipy.stats
 
 from .. import fmtxt
@@ -20,7 +20,6 @@ from .._utils import LazyProperty
 from .._data_obj import (
     Model, Var, asmodel, assub, asvar, assert_has_no_empty_cells, find_factors,
     hasrandom, is_higher_order_effect, isbalanced, iscategorial, isnestedin)
-from .opt import anova_fmaps, anova_full_fmaps, lm_res_ss, ss
 from .stats import ftest_p
 from . import test
 
@@ -370,6 +369,22 @@ class _NDANOVA(object):
     def _map(self, y, flat_f_map, perm):
         raise NotImplementedError
 
+    def map_batch(self, y, perms, out):
+        """Fit the model to a batch of permutations of ``y``
+
+        Parameters
+        ----------
+        y : np.array (n_cases, n_tests)
+            Dependent variables.
+        perms : array of int (n_perm, n_cases)
+            Permutations.
+        out : array (n_perm, n_effects, n_tests)
+            Container for the F-maps (order corresponding to self.effects).
+        """
+        for perm, flat_f_map in zip(perms, out):
+            self._map(y, flat_f_map, perm)
+        return out
+
     def p_maps(self, f_maps):
         """Convert F-maps for uncorrected p-maps
 
@@ -410,28 +425,55 @@ class _NDANOVA(object):
 
 
 class _BalancedNDANOVA(_NDANOVA):
-    "For balanced but not fully specified models"
+    """For balanced but not fully specified models
+
+    Notes
+    -----
+    Betas for all tests are computed as a single matrix product of the
+    projector with ``y``, and the betas of several permutations are computed
+    in the same matrix product by stacking permuted projectors. Since
+    permuting cases does not change ``X'X``, the sum of squares of each
+    effect follows from its betas as ``b' X_e'X_e b``.
+    """
     def __init__(self, x, effects, dfs_denom):
         _NDANOVA.__init__(self, x, effects, dfs_denom)
 
         self._effect_to_beta = x._effect_to_beta
-        self._x_full_perm = None
-        self._x_proj_perm = None
+        self._xtx = self.p.x.T.dot(self.p.x)
+        self._n_betas = self.p.x.shape[1]
 
     def _map(self, y, flat_f_map, perm):
         if perm is None:
-            x_full = self.p.x
-            x_proj = self.p.projector
+            projector = self.p.projector[None]
         else:
-            if self._x_full_perm is None:
-                self._x_full_perm = np.empty_like(self.p.x)
-                self._x_proj_perm = np.empty_like(self.p.projector)
-            x_full = self.p.x.take(perm, 0, self._x_full_perm)
-            x_proj = self.p.projector.take(perm, 1, self._x_proj_perm)
-
-        self._map_balanced(y, flat_f_map, x_full, x_proj)
-
-    def _map_balanced(self, y, flat_f_map, x_full, xsinv):
+            projector = self.p.projector[:, perm][None]
+        self._map_balanced(y, flat_f_map[None], projector)
+
+    def map_batch(self, y, perms, out):
+        projector = self.p.projector[:, perms].swapaxes(0, 1)
+        self._map_balanced(y, out, projector)
+        return out
+
+    def _betas(self, y, projector):
+        "Betas ``(n_perm, n_betas, n_tests)`` for ``projector (n_perm, n_betas, n_cases)``"
+        n_perm = len(projector)
+        projector = projector.reshape((n_perm * self._n_betas, self._n_obs))
+        projector = projector.astype(y.dtype, copy=False)
+        return projector.dot(y).reshape((n_perm, self._n_betas, y.shape[1]))
+
+    def _effect_ms(self, betas):
+        "Mean squares ``(n_perm, n_effects, n_tests)`` of all model effects"
+        out = np.empty((len(betas), len(self._effect_to_beta), betas.shape[2]))
+        for i, (start, df) in enumerate(self._effect_to_beta):
+            stop = start + df
+            effect_betas = betas[:, start:stop]
+            ss = np.matmul(self._xtx[start:stop, start:stop], effect_betas)
+            ss *= effect_betas
+            ss.sum(1, out=out[:, i])
+            out[:, i] /= df
+        return out
+
+    def _map_balanced(self, y, out, projector):
         raise NotImplementedError
 
 
@@ -448,9 +490,18 @@ class _BalancedFixedNDANOVA(_BalancedNDANOVA):
 
         self.df_error = x.df_error
 
-    def _map_balanced(self, y, flat_f_map, x_full, xsinv):
-        anova_fmaps(y, x_full, xsinv, flat_f_map, self._effect_to_beta,
-                    self.df_error)
+    def _map_balanced(self, y, out, projector):
+        # centering y only changes the intercept
+        y = y - y.mean(0)
+        betas = self._betas(y, projector)
+        ms = self._effect_ms(betas)
+        # SS_res = y'y - b'X'Xb
+        ms_res = np.matmul(self._xtx, betas)
+        ms_res *= betas
+        ms_res = ms_res.sum(1)
+        np.subtract(np.einsum('ij,ij->j', y, y), ms_res, ms_res)
+        ms_res /= self.df_error
+        np.divide(ms, ms_res[:, None], out)
 
 
 class _BalancedMixedNDANOVA(_BalancedNDANOVA):
@@ -474,95 +525,108 @@ class _BalancedMixedNDANOVA(_BalancedNDANOVA):
         effects = tuple(x.effects[i] for i in keep)
         dfs_denom = tuple(df_den[i] for i in keep)
         _BalancedNDANOVA.__init__(self, x, effects, dfs_denom)
-        self._e_ms_array = _hopkins_ems_array(x)
+        self._keep = keep
+        self._e_ms_array = _hopkins_ems_array(x)[keep, :] > 0
 
-    def _map_balanced(self, y, flat_f_map, x_full, xsinv):
-        anova_full_fmaps(y, x_full, xsinv, flat_f_map, self._effect_to_beta,
-                         self._e_ms_array)
+    def _map_balanced(self, y, out, projector):
+        betas = self._betas(y, projector)
+        ms = self._effect_ms(betas)
+        for i, (i_effect, e_ms) in enumerate(zip(self._keep, self._e_ms_array)):
+            np.divide(ms[:, i_effect], ms[:, e_ms].sum(1), out[:, i])
 
 
 class _IncrementalNDANOVA(_NDANOVA):
+    """ANOVA based on incremental model comparisons
+
+    Notes
+    -----
+    All sums of squares needed for the F-tests are quadratic forms
+    ``y' (H_1 - H_0) y`` in the difference between the hat matrices of two
+    nested models. Each such difference is a projection, ``H_1 - H_0 = W W'``,
+    where ``W`` is an orthonormal basis for the columns of the design matrix of
+    model 1 after projecting out those of model 0 (see
+    :func:`_complement_basis`), so that ``n x n`` matrices are never formed.
+    The sums of squares of all comparisons then follow from a single matrix
+    product of the stacked bases with ``y``, and permuting cases permutes the
+    rows of ``W``.
+    """
     def __init__(self, x):
         comparisons = IncrementalComparisons(x)
         _NDANOVA.__init__(self, x, comparisons.effects, comparisons.dfs_denom)
-
         self._comparisons = comparisons
-        self._SS_diff = None
-        self._MS_e = None
-        self._SS_res = None
-
-        self._x_orig = {}
-        self._full_ss_i = -1
-        for m, i in comparisons.relevant_models:
-            if m is None:  # intercept only
-                self._x_orig[i] = None
-                self._full_ss_i = i
-            else:
-                p = m._parametrize()
-                self._x_orig[i] = (p.x, p.projector)
-        if comparisons.mixed and self._full_ss_i == -1:
-            # need full SS
-            self._x_orig[-1] = None
-        self._x_perm = None
-
-    def preallocate(self, y_shape):
-        f_map = _NDANOVA.preallocate(self, y_shape)
-
-        shape = self._flat_f_map.shape[1]
-        self._SS_diff = np.empty(shape)
-        self._MS_e = np.empty(shape)
-        self._SS_res = {i: np.empty(shape) for i in self._x_orig.keys()}
-        return f_map
-
-    def _map(self, y, flat_f_map, perm):
-        if self._SS_diff is None:
-            shape = y.shape[1]
-            SS_diff = MS_diff = np.empty(shape)
-            MS_e = np.empty(shape)
-            SS_res = {i: np.empty(shape) for i in self._x_orig.keys()}
+        models = comparisons.models
+        n = self._n_obs
+
+        def design(i):
+            if i is None or models[i] is None:
+                return np.ones((n, 1))
+            return models[i]._parametrize().x
+
+        # quadratic forms: SS of each comparison, then the E(MS) or residuals
+        pairs = [(i1, i0) for i1, i0 in comparisons.comparisons.values()]
+        if comparisons.mixed:
+            pairs.extend((comparisons.ems_idx[i_test], None) for i_test in
+                         comparisons.comparisons)
         else:
-            SS_diff = MS_diff = self._SS_diff
-            MS_e = self._MS_e
-            SS_res = self._SS_res
+            pairs.append((0, None))
+        bases = [_complement_basis(design(i1), design(i0)) for i1, i0 in pairs]
+        self._basis = np.hstack(bases)
+        self._basis_start = np.cumsum([0] + [b.shape[1] for b in bases[:-1]])
+        self._dfs_nom = np.array(self.dfs_nom, float)[:, None]
+        self._dfs_denom = np.array(self.dfs_denom, float)[:, None]
 
+    def _map(self, y, flat_f_map, perm):
         if perm is None:
-            x_dict = self._x_orig
+            basis = self._basis.T[None]
         else:
-            x_orig = self._x_orig
-            x_dict = self._x_perm
-            if x_dict is None:
-                self._x_perm = x_dict = {}
-                for i, x in x_orig.items():
-                    if x is None:
-                        x_dict[i] = None
-                    else:
-                        x_dict[i] = (np.empty_like(x[0]), np.empty_like(x[1]))
+            basis = self._basis[perm].T[None]
+        self._map_forms(y, flat_f_map[None], basis)
+
+    def map_batch(self, y, perms, out):
+        self._map_forms(y, out, self._basis[perms].swapaxes(1, 2))
+        return out
+
+    def _map_forms(self, y, out, basis):
+        "F-maps for stacked bases ``(n_perm, n_basis, n_cases)``"
+        # all models contain the intercept
+        y = y - y.mean(0)
+        n_perm, n_basis, _ = basis.shape
+        basis = basis.reshape((n_perm * n_basis, self._n_obs))
+        z = basis.astype(y.dtype, copy=False).dot(y)
+        z **= 2
+        z = z.reshape((n_perm, n_basis, y.shape[1]))
+        ss = np.add.reduceat(z, self._basis_start, 1)
+        n_effects = self.n_effects
+        np.divide(ss[:, :n_effects], self._dfs_nom, out)
+        if self._comparisons.mixed:
+            ss_e = ss[:, n_effects:]
+        else:
+            # SS_res = y'y - y'H_0y
+            ss_e = np.einsum('ij,ij->j', y, y) - ss[:, n_effects:]
+        out /= ss_e / self._dfs_denom
 
-            for i in x_dict:
-                if x_dict[i]:
-                    x_orig[i][0].take(perm, 0, x_dict[i][0])
-                    x_orig[i][1].take(perm, 1, x_dict[i][1])
 
-        # calculate SS_res for all models
-        for i, x in x_dict.items():
-            if x is None:  # TODO:  use the same across permutations?
-                ss(y, SS_res[i])
-            else:
-                x_full, xsinv = x
-                lm_res_ss(y, x_full, xsinv, SS_res[i])
-
-        # incremental comparisons
-        if not self._comparisons.mixed:
-            np.divide(SS_res[0], self.x.df_error, MS_e)
-        for i, (i_test, (i1, i0)) in enumerate(self._comparisons.comparisons.items()):
-            if self._comparisons.mixed:
-                i_ems = self._comparisons.ems_idx[i_test]
-                np.subtract(SS_res[self._full_ss_i], SS_res[i_ems], MS_e)
-                np.divide(MS_e, self.dfs_denom[i], MS_e)
-            df_diff = self._comparisons.x.effects[i_test].df
-            np.subtract(SS_res[i0], SS_res[i1], SS_diff)
-            np.divide(SS_diff, df_diff, MS_diff)
-            np.divide(MS_diff, MS_e, flat_f_map[i])
+def _complement_basis(x1, x0):
+    """Orthonormal basis for the columns of ``x1`` orthogonal to ``x0``
+
+    Parameters
+    ----------
+    x1 : array (n_cases, n_params_1)
+        Design matrix of the larger model.
+    x0 : array (n_cases, n_params_0)
+        Design matrix of a model nested in ``x1``.
+
+    Returns
+    -------
+    basis : array (n_cases, df)
+        Orthonormal basis ``W`` with ``W W' = H_1 - H_0``. Requires
+        ``O(n_cases * n_params**2)`` operations.
+    """
+    q0 = orth(x0)
+    r = x1 - q0.dot(q0.T.dot(x1))
+    u, s, _ = np.linalg.svd(r, full_matrices=False)
+    tol = max(x1.shape) * np.finfo(float).eps * np.linalg.norm(x1, 2)
+    return u[:, s > tol]
 
 
 def effect_id(effects):
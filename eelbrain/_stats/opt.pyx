@@ -2,8 +2,9 @@
 #cython: boundscheck=False, wraparound=False
 
 cimport cython
+from cython cimport floating
 from cython.view cimport array as cvarray
-from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, calloc, free
 import numpy as np
 cimport numpy as cnp
 
@@ -375,8 +376,8 @@ def lm_res_ss(cnp.ndarray[FLOAT64, ndim=2] y,
     free(betas)
 
 
-def t_1samp(cnp.ndarray[FLOAT64, ndim=2] y,
-            cnp.ndarray[FLOAT64, ndim=1] out):
+def t_1samp(cnp.ndarray[floating, ndim=2] y,
+            cnp.ndarray[floating, ndim=1] out):
     """T-values for 1-sample t-test
 
     Parameters
@@ -384,37 +385,49 @@ def t_1samp(cnp.ndarray[FLOAT64, ndim=2] y,
     y : array (n_cases, n_tests)
         Dependent Measurement.
     out : array (n_tests,)
-        Container for output.
+        Container for output (same dtype as ``y``).
+
+    Notes
+    -----
+    ``y`` can be ``float32`` or ``float64``; means and variances are always
+    accumulated in double precision. ``y`` is traversed row by row, so that
+    memory access is sequential also when ``n_tests`` is large.
     """
     cdef unsigned long i, case
-    cdef double mean, denom
+    cdef double denom
 
     cdef unsigned long n_tests = y.shape[1]
     cdef unsigned long n_cases = y.shape[0]
     cdef double div = (n_cases - 1) * n_cases
+    cdef double *mean = <double *>calloc(n_tests, sizeof(double))
+    cdef double *ss = <double *>calloc(n_tests, sizeof(double))
 
+    # mean
+    for case in range(n_cases):
+        for i in range(n_tests):
+            mean[i] += y[case, i]
     for i in range(n_tests):
-        # mean
-        mean = 0
-        for case in range(n_cases):
-            mean += y[case, i]
-        mean /= n_cases
+        mean[i] /= n_cases
 
-        # variance
-        denom = 0
-        for case in range(n_cases):
-            denom += (y[case, i] - mean) ** 2
+    # variance
+    for case in range(n_cases):
+        for i in range(n_tests):
+            ss[i] += (y[case, i] - mean[i]) ** 2
 
-        denom /= div
+    for i in range(n_tests):
+        denom = ss[i] / div
         denom **= 0.5
         if denom > 0:
-            out[i] = mean / denom
+            out[i] = mean[i] / denom
         else:
             out[i] = 0
 
+    free(mean)
+    free(ss)
+
 
-def t_1samp_perm(cnp.ndarray[FLOAT64, ndim=2] y,
-                 cnp.ndarray[FLOAT64, ndim=1] out, 
+def t_1samp_perm(cnp.ndarray[floating, ndim=2] y,
+                 cnp.ndarray[floating, ndim=1] out,
                  cnp.ndarray[INT8, ndim=1] sign):
     """T-values for 1-sample t-test
 
@@ -456,8 +469,8 @@ def t_1samp_perm(cnp.ndarray[FLOAT64, ndim=2] y,
             out[i] = 0
 
 
-def t_ind(cnp.ndarray[FLOAT64, ndim=2] y,
-          cnp.ndarray[FLOAT64, ndim=1] out,
+def t_ind(cnp.ndarray[floating, ndim=2] y,
+          cnp.ndarray[floating, ndim=1] out,
           cnp.ndarray[INT8, ndim=1] group):
     "Indpendent-samples t-test, assuming equal variance"
     cdef unsigned long i, case
@@ -505,9 +518,9 @@ def t_ind(cnp.ndarray[FLOAT64, ndim=2] y,
         out[i] = (mean1 - mean0) / (var * var_mult) ** 0.5
 
 
-def has_zero_variance(cnp.ndarray[FLOAT64, ndim=2] y):
+def has_zero_variance(cnp.ndarray[floating, ndim=2] y):
     "True if any data-columns have zero variance"
-    cdef double value
+    cdef floating value
     cdef unsigned long case, i
 
     for i in range(y.shape[1]):
@@ -1,17 +1,18 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
-from itertools import repeat
-from math import ceil
 import random
 
 import numpy as np
 
 from .._data_obj import NDVar, Var, NestedEffect
-from .._utils import intervals
 
 
 _YIELD_ORIGINAL = 0
 # for testing purposes, yield original order instead of permutations
 
+# sign flips for up to this many cases are drawn without replacement (from a
+# random order of all 2**n sign patterns)
+SIGN_FLIP_SET_MAX_N = 20
+
 
 def _resample_params(N, samples):
     """Decide whether to do permutations or random resampling
@@ -44,7 +45,23 @@ def _resample_params(N, samples):
     return n_samples, samples
 
 
-def permute_order(n, samples=10000, replacement=False, unit=None, seed=0):
+def _iter_random_state(seed, start, stop):
+    """Random state for each permutation index
+
+    Each permutation is generated from a random state seeded with the
+    ``(seed, index)`` pair, so that any permutation can be generated directly,
+    independently of the others and of the global random state.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    random_state = np.random.RandomState()
+    for i in range(start, stop):
+        random_state.seed((seed, i))
+        yield random_state
+
+
+def permute_order(n, samples=10000, replacement=False, unit=None, seed=0,
+                  start=0, batch=None):
     """Generator function to create indices to shuffle n items
 
     Parameters
@@ -62,59 +79,70 @@ def permute_order(n, samples=10000, replacement=False, unit=None, seed=0):
         unit (with or without replacement) and then shuffling the values
         within units (no replacement).
     seed : None | int
-        Seed the random state of the relevant randomization module
-        (:mod:`random` or :mod:`numpy.random`) to make replication possible.
-        None to skip seeding (default 0).
+        Seed for the permutations (default 0). Permutation ``i`` only depends
+        on ``seed`` and ``i``, not on the global random state. None to use a
+        random seed.
+    start : int
+        Index of the first permutation to yield (the sequence of permutations
+        is the same as for ``start=0``, but the first ``start`` permutations
+        are skipped without being generated).
+    batch : int
+        Yield blocks of ``batch`` permutations at a time instead of single
+        permutations (the last block can be shorter).
 
     Returns
     -------
-    Iterator over index.
+    Iterator over index (with ``batch``, over arrays of shape
+    ``(batch, n)`` in which each row is one permutation).
     """
     n = int(n)
     samples = int(samples)
+    permutations = _permute_order(n, samples, replacement, unit, seed, start)
+    if batch is None:
+        return permutations
+    return _iter_batches(permutations, n, int(batch), np.intp)
+
+
+def _permute_order(n, samples, replacement, unit, seed, start):
     if samples < 0:
         err = "Complete permutation for resampling through reordering"
         raise NotImplementedError(err)
 
     if _YIELD_ORIGINAL:
         original = np.arange(n)
-        for _ in range(samples):
+        for _ in range(start, samples):
             yield original
         return
 
-    if seed is not None:
-        np.random.seed(seed)
-
+    random_states = _iter_random_state(seed, start, samples)
     if unit is None:
         if replacement:
-            for _ in range(samples):
-                yield np.random.randint(n, n)
+            for random_state in random_states:
+                yield random_state.randint(n, size=n)
         else:
-            index = np.arange(n)
-            for _ in range(samples):
-                np.random.shuffle(index)
-                yield index
+            for random_state in random_states:
+                yield random_state.permutation(n)
     else:
         if replacement:
             raise NotImplementedError("Replacement and units")
         idx_orig = np.arange(n)
         idx_perm = np.empty_like(idx_orig)
         unit_idxs = [np.flatnonzero(unit == cell) for cell in unit.cells]
-        if isinstance(unit, NestedEffect):
-            dst_idxs_iter = ((unit_idxs[i] for i in order)
-                             for order in permute_order(len(unit_idxs), samples, seed=None))
-        else:
-            dst_idxs_iter = repeat(unit_idxs, samples)
-
-        for dst_idxs in dst_idxs_iter:
+        permute_units = isinstance(unit, NestedEffect)
+        for random_state in random_states:
+            if permute_units:
+                order = random_state.permutation(len(unit_idxs))
+                dst_idxs = [unit_idxs[i] for i in order]
+            else:
+                dst_idxs = unit_idxs
             for src, dst in zip(unit_idxs, dst_idxs):
                 v = idx_orig[src]
-                np.random.shuffle(v)
+                random_state.shuffle(v)
                 idx_perm[dst] = v
             yield idx_perm
 
 
-def permute_sign_flip(n, samples=10000, seed=0, out=None):
+def permute_sign_flip(n, samples=10000, seed=0, out=None, batch=None, start=0):
     """Iterate over indices for ``samples`` permutations of the data
 
     Parameters
@@ -125,51 +153,92 @@ def permute_sign_flip(n, samples=10000, seed=0, out=None):
         Number of samples to yield. If < 0, all possible permutations are
         performed.
     seed : None | int
-        Seed the random state of the :mod:`random` module to make replication 
-        possible. None to skip seeding (default 0).
+        Seed for the permutations (default 0). Permutation ``i`` only depends
+        on ``seed`` and ``i``, not on the global random state. None to use a
+        random seed.
     out : array of int8  (n,)
         Buffer for the ``sign`` variable that is yielded in each iteration.
+    batch : int
+        Yield blocks of ``batch`` permutations at a time instead of single
+        permutations (the last block can be shorter).
+    start : int
+        Index of the first permutation to yield (the sequence of permutations
+        is the same as for ``start=0``, but the first ``start`` permutations
+        are skipped without being generated).
 
     Yields
     ------
-    sign : array of int8  (n,)
+    sign : array of int8  (n,) | (batch, n)
         Sign for each case (``1`` or ``-1``; ``sign`` is the same array object 
-        but its content modified in every iteration).
+        but its content modified in every iteration). With ``batch``, each row
+        corresponds to one permutation.
+
+    Notes
+    -----
+    The original data (all signs ``1``) are never included. For
+    ``n <= 20``, random samples are drawn without replacement, as the first
+    ``samples`` patterns in a random order of all ``2**n - 1`` sign patterns.
+    For larger ``n``, samples are drawn independently (with replacement); the
+    expected proportion of duplicates, about ``samples / 2**(n + 1)``, is then
+    below 0.5% for ``samples <= 10000``.
     """
     n = int(n)
-    if seed is not None:
-        random.seed(seed)
+    if batch is not None:
+        if out is not None:
+            raise TypeError("out can not be specified with batch")
+        return _iter_batches(_permute_sign_flip(n, samples, seed, None, start),
+                             n, int(batch), np.int8)
+    return _permute_sign_flip(n, samples, seed, out, start)
+
+
+def _iter_batches(permutations, n, batch, dtype):
+    "Accumulate single permutations into blocks of ``batch``"
+    out = np.empty((batch, n), dtype)
+    i = 0
+    for perm in permutations:
+        out[i] = perm
+        i += 1
+        if i == batch:
+            yield out
+            i = 0
+    if i:
+        yield out[:i]
 
+
+def _permute_sign_flip(n, samples, seed, out=None, start=0):
     if out is None:
         out = np.empty(n, np.int8)
     else:
         assert out.shape == (n,)
 
-    if n > 62:  # Python 2 limit for xrange
-        if samples < 0:
-            raise NotImplementedError("All possibilities for more than 62 cases")
-        n_groups = ceil(n / 62.)
-        group_size = int(ceil(n / n_groups))
-        out_parts = list(range(0, n, group_size)) + [n]
-        for _ in zip(*(permute_sign_flip(stop - start, samples, None, out[start: stop])
-                       for start, stop in intervals(out_parts))):
-            yield out
-        return
-
-    # determine possible number of permutations
-    n_perm_possible = 2 ** n
     if samples < 0:
         # do all permutations
-        sample_sequences = range(1, n_perm_possible)
+        if n > 62:
+            raise NotImplementedError("All possibilities for more than 62 cases")
+        seqs = range(start + 1, 2 ** n)
+    elif n <= SIGN_FLIP_SET_MAX_N:
+        # random resampling without replacement
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        order = np.random.RandomState(seed).permutation(2 ** n - 1)
+        seqs = order[start:samples] + 1
     else:
-        # random resampling
-        sample_sequences = random.sample(range(1, n_perm_possible), samples)
+        seqs = None
 
-    for seq in sample_sequences:
-        out.fill(1)
-        for i in (i for i, s in enumerate(bin(seq)[-1:1:-1]) if s == '1'):
-            out[i] = -1
-        yield out
+    if seqs is not None:
+        bits = np.arange(n, dtype=np.int64)
+        for seq in seqs:
+            flip = np.bitwise_and(np.right_shift(seq, bits), 1)
+            np.subtract(1, flip * 2, out, casting='unsafe')
+            yield out
+    else:
+        # random resampling with replacement
+        for random_state in _iter_random_state(seed, start, samples):
+            flip = random_state.randint(2, size=n)
+            while not flip.any():
+                flip = random_state.randint(2, size=n)
+            np.subtract(1, flip * 2, out, casting='unsafe')
+            yield out
 
 
 def resample(y, samples=10000, replacement=False, unit=None, seed=0):
@@ -191,9 +260,8 @@ def resample(y, samples=10000, replacement=False, unit=None, seed=0):
         unit (with or without replacement) and then shuffling the values
         within units (no replacement).
     seed : None | int
-        Seed the random state of the relevant randomization module
-        (:mod:`random` or :mod:`numpy.random`) to make replication possible.
-        None to skip seeding (default 0).
+        Seed for the resampling (default 0; see :func:`permute_order`). None to
+        use a random seed.
 
     Returns
     -------
@@ -211,5 +279,5 @@ def resample(y, samples=10000, replacement=False, unit=None, seed=0):
     out = y.copy('{name}_resampled')
 
     for index in permute_order(len(out), samples, replacement, unit, seed):
-        out.x[index] = y.x
+        out.x[:] = y.x[index]
         yield out
@@ -81,10 +81,61 @@ def corr(y, x, out=None, perm=None):
         if np.isscalar(out):
             out = 0
         else:
-            out.place(isnan, 0)
+            np.place(out, isnan, 0)
     return out
 
 
+def _zscore(a):
+    "Z-score along the first axis with ``ddof=1``, 0 where the variance is 0"
+    z = a - a.mean(0)
+    sd = z.std(0, ddof=1, keepdims=True)
+    z /= np.where(sd > 0, sd, np.inf)
+    return z
+
+
+class CorrPerm(object):
+    """Correlation maps for batches of permutations of ``x``
+
+    Parameters
+    ----------
+    x : array (n_cases,)
+        Covariate, which is permuted.
+
+    Notes
+    -----
+    Since only ``x`` is permuted, ``y`` is standardized once, when the object
+    is first called with it, and the correlation maps for a batch of
+    permutations are the product of the permuted, standardized ``x``
+    ``(n_perm, n_cases)`` with the standardized ``y`` ``(n_cases, n_tests)``.
+    As in :func:`corr`, the correlation is 0 where ``y`` or ``x`` have zero
+    variance.
+    """
+    def __init__(self, x):
+        x = np.asarray(x, np.float64)
+        self._z_x = _zscore(x) / (len(x) - 1)
+        self._y = None
+        self._z_y = None
+        self._z_x_y = None
+
+    def __call__(self, y, out, perms):
+        """Correlation maps for permutations of ``x``
+
+        Parameters
+        ----------
+        y : array (n_cases, n_tests)
+            Dependent variable.
+        out : array (n_perm, n_tests)
+            Container for output.
+        perms : array of int (n_perm, n_cases)
+            Permutations of ``x``.
+        """
+        if y is not self._y:
+            self._z_y = _zscore(y)
+            self._z_x_y = self._z_x.astype(y.dtype)
+            self._y = y
+        return np.dot(self._z_x_y[perms], self._z_y, out)
+
+
 def lm_betas_se_1d(y, b, p):
     """Regression coefficient standard errors
 
@@ -274,7 +325,7 @@ def t_1samp(y, out=None):
     "T-value for 1-sample t-test"
     n_cases = len(y)
     if out is None:
-        out = np.empty(y.shape[1:])
+        out = np.empty(y.shape[1:], y.dtype)
 
     if out.ndim == 1:
         y_flat = y
@@ -287,11 +338,46 @@ def t_1samp(y, out=None):
     return out
 
 
+def t_1samp_perm_batch(y, out, signs):
+    """T-values for 1-sample t-test on a batch of sign-flip permutations
+
+    Parameters
+    ----------
+    y : array (n_cases, n_tests)
+        Dependent measurement.
+    out : array (n_perm, n_tests)
+        Container for output.
+    signs : array of int8 (n_perm, n_cases)
+        Sign of each case in each permutation.
+
+    Notes
+    -----
+    Flipping signs leaves the sum of squares of each test unchanged, so the
+    variance for each permutation follows from the permuted mean. The means of
+    all permutations in the batch are computed as a single matrix product.
+    """
+    n_cases = len(y)
+    np.dot(signs.astype(y.dtype), y, out)
+    out /= n_cases
+    # variance * n_cases
+    ss = np.einsum('ij,ij->j', y, y)
+    var = np.square(out)
+    var *= -n_cases
+    var += ss
+    # denominator
+    var /= (n_cases - 1) * n_cases
+    valid = var > 0
+    np.sqrt(var, var, where=valid)
+    np.divide(out, var, out, where=valid)
+    out[~valid] = 0
+    return out
+
+
 def t_ind(y, group, out=None, perm=None):
     "T-value for independent samples t-test, assuming equal variance"
     n_cases = len(y)
     if out is None:
-        out = np.empty(y.shape[1:])
+        out = np.empty(y.shape[1:], y.dtype)
 
     if perm is not None:
         group = group[perm]
@@ -307,6 +393,11 @@ def t_ind(y, group, out=None, perm=None):
     return out
 
 
+def t_ind_perm(group, y, out, perm):
+    "T-values for :func:`t_ind` with permutation ``perm`` of ``group``"
+    return t_ind(y, group, out, perm)
+
+
 def ftest_f(p, df_num, df_den):
     "F values for given probabilities."
     p = np.asanyarray(p)
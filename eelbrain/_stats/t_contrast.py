@@ -21,8 +21,27 @@ np_ufuncs = {'abs': np.abs,
              'negative': np.negative}
 
 
+# reduction of array functions to pairwise ufuncs
+afunc_ufuncs = {np.min: np.minimum,
+                np.max: np.maximum,
+                np.sum: np.add}
+
+
 class TContrastRel(object):
-    "Parse a contrast expression and expose methods to apply it"
+    """Parse a contrast expression and expose methods to apply it
+
+    Notes
+    -----
+    The contrast is compiled once into
+
+    - the terms of the paired difference underlying each comparison in the
+      contrast (the position of the cases of each cell and their weight), so
+      that the differences for all comparisons and a whole batch of
+      permutations are assembled from the data with vectorized indexing, and
+      then enter a single *t*-test;
+    - a flat sequence of ufunc operations on preallocated buffers, which
+      combines the *t*-maps of the comparisons to the contrast map.
+    """
 
     def __init__(self, contrast, cells, indexes):
         """Parse a contrast expression and expose methods to apply it
@@ -38,39 +57,191 @@ class TContrastRel(object):
             Indexes for the data of every cell.
         """
         ast = parse(contrast)
-        n_buffers, cells_in_contrast = _t_contrast_rel_properties(ast)
+        _, cells_in_contrast = _t_contrast_rel_properties(ast)
         pcells, mcells = _t_contrast_rel_expand_cells(cells_in_contrast, cells)
+        comparisons = []
+        ops, root, n_slots = _t_contrast_rel_compile(ast, comparisons)
 
         self.contrast = contrast
         self.indexes = indexes
         self._ast = ast
         self._pcells = pcells
         self._mcells = mcells
-        self._n_buffers = n_buffers
+        self._comparisons = comparisons
+        self._ops = ops
+        self._root = root
+        self._n_slots = n_slots
+        self._n_cases = None
+        self._n_subjects = None
+        self._terms = None
 
-        # data buffers
-        self._buffer_shape = None
-        self._buffer = None
-        self._y_perm = None
+    @property
+    def buffer_maps(self):
+        "Number of maps of the size of ``y`` buffered per permutation"
+        n_subjects = self._n_subjects or 1
+        return len(self._comparisons) + 2 * n_subjects + self._n_slots
+
+    def _get_terms(self, n_cases):
+        """Terms of the paired differences for all comparisons
+
+        Returns
+        -------
+        terms : list of list of (array, float)
+            For each comparison, the positions of the cases of each
+            contributing cell (one per subject) and the cell's weight.
+        """
+        if self._n_cases == n_cases:
+            return self._terms
+        cases = np.arange(n_cases)
+        positions = {cell: cases[self.indexes[cell]] for cell in self._pcells}
+        n_subjects = {len(index) for index in positions.values()}
+        if len(n_subjects) != 1:
+            raise ValueError("Cells in contrast %r have different numbers of "
+                             "cases" % (self.contrast,))
+        terms = []
+        for c1, c0 in self._comparisons:
+            weights = {}
+            for cell, sign in ((c1, 1.), (c0, -1.)):
+                base = self._mcells.get(cell, (cell,))
+                for cell_ in base:
+                    weights[cell_] = weights.get(cell_, 0) + sign / len(base)
+            terms.append([(positions[cell], w) for cell, w in weights.items()
+                          if w])
+        self._n_cases = n_cases
+        self._n_subjects = n_subjects.pop()
+        self._terms = terms
+        return terms
 
     def map(self, y):
-        "Apply contrast without retainig data buffers"
-        buff = np.empty((self._n_buffers,) + y.shape[1:])
-        data = _t_contrast_rel_data(y, self.indexes, self._pcells, self._mcells)
-        tmap = _t_contrast_rel(self._ast, data, buff)
-        return tmap
+        "Apply contrast to the data"
+        n_cases = len(y)
+        out = np.empty(y.shape[1:], y.dtype)
+        y_flat = y.reshape((n_cases, -1))
+        self._map(y_flat, out.reshape((1, -1)), np.arange(n_cases)[None])
+        return out
 
     def __call__(self, y, out, perm):
-        "Apply contrast to permutation of the data, storing and recycling data buffers"
-        buffer_shape = (self._n_buffers,) + y.shape[1:]
-        if self._buffer_shape != buffer_shape:
-            self._buffer = np.empty(buffer_shape)
-            self._y_perm = np.empty_like(y)
-            self._buffer_shape = buffer_shape
-        self._y_perm[perm] = y
-        data = _t_contrast_rel_data(self._y_perm, self.indexes, self._pcells, self._mcells)
-        tmap = _t_contrast_rel(self._ast, data, self._buffer, out)
-        return tmap
+        """Apply contrast to permutations of the data
+
+        Parameters
+        ----------
+        y : array (n_cases, n_tests)
+            Data.
+        out : array (n_tests,) | (n_perm, n_tests)
+            Container for output.
+        perm : array of int (n_cases,) | (n_perm, n_cases)
+            Permutation, or a batch of permutations (in which case each row
+            of ``out`` corresponds to one permutation).
+        """
+        if perm.ndim == 1:
+            self(y, out.reshape((1, -1)), perm[None])
+            return out
+        # case i of the permuted data is case source[i] of y
+        n_perm, n_cases = perm.shape
+        source = np.empty_like(perm)
+        source[np.arange(n_perm)[:, None], perm] = np.arange(n_cases)
+        return self._map(y, out, source)
+
+    def _map(self, y, out, source):
+        "Contrast maps for the data ``y[source]``, ``source (n_perm, n_cases)``"
+        terms = self._get_terms(len(y))
+        n_perm = len(source)
+        n_tests = y.shape[1]
+        # t-maps of all comparisons, from the paired differences
+        # (n_comparisons, n_perm, n_tests)
+        tmaps = np.empty((len(terms), n_perm, n_tests), y.dtype)
+        for comparison_terms, tmap in zip(terms, tmaps):
+            diff = None
+            for positions, weight in comparison_terms:
+                x = y[source[:, positions].T]
+                if weight != 1:
+                    x *= weight
+                if diff is None:
+                    diff = x
+                else:
+                    diff += x
+            stats.t_1samp(diff.reshape((self._n_subjects, -1)),
+                          tmap.reshape(-1))
+        if not self._ops:
+            out[...] = tmaps[self._root]
+            return out
+        buffers = np.empty((self._n_slots - 1, n_perm, n_tests), y.dtype)
+        maps = list(tmaps) + list(buffers) + [out]
+        for func, args, dst in self._ops:
+            func(*[maps[i] for i in args], out=maps[dst])
+        return out
+
+
+def _t_contrast_rel_compile(ast, comparisons):
+    """Compile a contrast into a flat sequence of operations
+
+    Parameters
+    ----------
+    ast : tuple
+        Contrast specification.
+    comparisons : list
+        List of ``(c1, c0)`` comparisons, which is filled during compilation.
+
+    Returns
+    -------
+    ops : list of ``(ufunc, args, dst)``
+        Operations, with ``args`` and ``dst`` indexing maps. The maps are the
+        *t*-maps of all comparisons, followed by ``n_slots - 1`` buffers and
+        the output.
+    root : int
+        Index of the map holding the result (only relevant when ``ops`` is
+        empty, otherwise the result is in the output).
+    n_slots : int
+        Number of maps holding intermediate results, including the output.
+    """
+    ops = []
+    n_slots = 0
+
+    def compile_item(item):
+        "Return the map of ``item`` as ``(is_slot, index)``"
+        nonlocal n_slots
+        kind = item[0]
+        if kind == 'comp':
+            cells = item[1:]
+            if cells not in comparisons:
+                comparisons.append(cells)
+            return False, comparisons.index(cells)
+        elif kind == 'afunc' and len(item[2]) == 1:
+            return compile_item(item[2][0])
+        slot = (True, n_slots)
+        n_slots += 1
+        if kind == 'ufunc':
+            _, func, item_ = item
+            ops.append((func, (compile_item(item_),), slot))
+        elif kind == 'bfunc':
+            _, func, items = item
+            ops.append((func, tuple(map(compile_item, items)), slot))
+        elif kind == 'afunc':
+            _, func, items = item
+            ufunc = afunc_ufuncs[func]
+            args = [compile_item(item_) for item_ in items]
+            ops.append((ufunc, tuple(args[:2]), slot))
+            for arg in args[2:]:
+                ops.append((ufunc, (slot, arg), slot))
+        else:
+            raise RuntimeError("item=%r" % (item,))
+        return slot
+
+    root = compile_item(ast)
+    n_comparisons = len(comparisons)
+
+    def index(arg):
+        is_slot, i = arg
+        if not is_slot:
+            return i
+        elif i == 0:  # the root slot is the output
+            return n_comparisons + n_slots - 1
+        else:
+            return n_comparisons + i - 1
+
+    ops = [(func, tuple(map(index, args)), index(dst)) for
+           func, args, dst in ops]
+    return ops, index(root), n_slots
 
 
 def _t_contrast_rel_properties(item):
@@ -165,27 +336,3 @@ def _t_contrast_rel_data(y, indexes, cells, mean_cells):
         data[name] = x
 
     return data
-
-
-def _t_contrast_rel(item, data, buff, out=None):
-    "Execute a t_contrast (recursive)"
-    if item[0] == 'ufunc':
-        _, func, item_ = item
-        tmap = _t_contrast_rel(item_, data, buff[1:], buff[0])
-        tmap = func(tmap, out)
-    elif item[0] == 'bfunc':
-        _, func, items = item
-        tmap1 = _t_contrast_rel(items[0], data, buff[2:], buff[1])
-        tmap2 = _t_contrast_rel(items[1], data, buff[2:], buff[0])
-        tmap = func(tmap1, tmap2, out)
-    elif item[0] == 'afunc':
-        _, func, items_ = item
-        tmaps = buff[:len(items_)]
-        for i, item_ in enumerate(items_):
-            _t_contrast_rel(item_, data, buff[i + 1:], tmaps[i])
-        tmap = func(tmaps, axis=0, out=out)
-    else:
-        _, c1, c0 = item
-        tmap = stats.t_1samp(data[c1] - data[c0], out)
-
-    return tmap
@@ -21,23 +21,22 @@ n_samples : None | int
     number of permutations that constitute the complete set.
 '''
 from datetime import datetime, timedelta
-from itertools import chain
+from functools import partial, reduce
+from itertools import chain, islice
 from math import ceil
-from multiprocessing import Process, Event, SimpleQueue
-from multiprocessing.sharedctypes import RawArray
 import logging
+import mmap
 import operator
 import os
 import re
-import signal
 import socket
-from time import time as current_time
+from time import perf_counter, time as current_time
 from warnings import warn
 
 import numpy as np
 import scipy.stats
 from scipy import ndimage
-from tqdm import trange
+from tqdm import tqdm
 
 from .. import fmtxt
 from .. import _colorspaces as _cs
@@ -50,23 +49,36 @@ from .._data_obj import (
     hasrandom, cellname, combine, dataobj_repr)
 from .._exceptions import OldVersionError, ZeroVariance
 from .._report import enumeration, format_timewindow, ms
-from .._utils import LazyProperty
+from .._utils import LazyProperty, intervals
 from .._utils.numpy_utils import FULL_AXIS_SLICE
 from .._utils.system import caffeine
 from . import opt, stats
 from .connectivity import Connectivity, find_peaks
-from .connectivity_opt import merge_labels, tfce_increment
+from .connectivity_opt import cluster_mass_max, merge_labels, tfce_union_find
 from .glm import _nd_anova
 from .permutation import _resample_params, permute_order, permute_sign_flip
 from .t_contrast import TContrastRel
 from .test import star, star_factor
-from functools import reduce
+from .workers import SharedArray, get_pool, shutdown_pool
 
 
 __test__ = False
 
-# toggle multiprocessing for problematic functions on Windows
-MP_FOR_NON_TOP_LEVEL_FUNCTIONS = os.name != 'nt'  # FIXME
+# batched permutation kernels: memory for the stat-map buffer (in bytes), and
+# maximum number of permutations per batch
+BATCH_BUFFER_SIZE = 2 ** 25
+MAX_BATCH = 128
+# memory-mapped data: memory for one block of columns read into memory for
+# permutations (in bytes)
+BLOCK_BUFFER_SIZE = 2 ** 27
+# number of ranges of permutations per worker process (for load balancing and
+# progress display)
+CHUNKS_PER_WORKER = 4
+# samples='adaptive': number of permutations after which to check whether
+# all p-values are determined, i.e., their confidence interval excludes alpha
+ADAPTIVE_SAMPLES = (100, 200, 500, 1000, 2000, 5000, 10000)
+ADAPTIVE_ALPHA = 0.05
+ADAPTIVE_CONFIDENCE = 0.99
 
 
 def check_variance(x):
@@ -183,6 +195,31 @@ class NDTest(object):
     def _first_cdist(self):
         return self._cdist
 
+    @property
+    def timing(self):
+        """Time and memory used for the permutation test
+
+        ``dict`` (or ``None`` if no permutations were computed) with entries:
+
+        ``total``, ``data``, ``kernel``, ``map``, ``ipc``, ``finalize``
+            Time (in seconds) for the whole permutation test, for preparing
+            the data, spent in the test kernels computing statistical maps,
+            in processing the maps (cluster formation, TFCE), in transferring
+            results from worker processes, and in packaging the results.
+            ``kernel`` and ``map`` are summed over workers.
+        ``n_permutations``
+            Number of permutations computed (not counting permutations reused
+            from a previous result).
+        ``workers``
+            For each worker process (by process ID), ``permutations``, busy
+            ``time`` and ``permutations_per_second``.
+        ``memory``
+            Bytes used for the ``data`` (not counting memory-mapped data) and
+            by the ``buffers`` of each worker.
+        """
+        cdist = self._first_cdist
+        return getattr(cdist, 'timing', None)
+
     def _plot_model(self):
         "Determine x for plotting categories"
         return None
@@ -330,6 +367,11 @@ class NDTest(object):
         # n samples
         if self.samples == -1:
             l.add_item("In all %s possible permutations" % self.n_samples)
+        elif cdist.adaptive:
+            l.add_item("In %s random permutations (adaptive stopping based "
+                       "on %g%% confidence intervals of p-values relative to "
+                       "%g)" % (self.samples, ADAPTIVE_CONFIDENCE * 100,
+                                ADAPTIVE_ALPHA))
         else:
             l.add_item("In %s random permutations" % self.samples)
 
@@ -377,8 +419,11 @@ class t_contrast_rel(NDTest):
         0: both (two-tailed);
         1: upper tail (one-tailed);
         -1: lower tail (one-tailed).
-    samples : int
-        Number of samples for permutation test (default 0).
+    samples : int | 'adaptive'
+        Number of samples for permutation test (default 0). With
+        ``'adaptive'``, permutations stop as soon as it is determined whether
+        the p-value of each cluster is above or below 0.05 (up to 10000
+        permutations).
     pmin : None | scalar (0 < pmin < 1)
         Threshold for forming clusters:  use a t-value equivalent to an
         uncorrected p-value for a related samples t-test (with df =
@@ -395,6 +440,16 @@ class t_contrast_rel(NDTest):
         disconnected.
     force_permutation: bool
         Conduct permutations regardless of whether there are any clusters.
+    resume : NDTest
+        Previous result of the same test, for example with fewer ``samples``.
+        Permutations already computed for ``resume`` are reused instead of
+        being recomputed.
+    dtype : 'float64' | 'float32'
+        Precision for computing the permutation distribution (the statistic
+        for the original data is always computed in double precision).
+        ``'float32'`` halves the memory used by the permuted data; statistics
+        of permuted data then agree with ``'float64'`` to about 5 significant
+        digits.
     mintime : scalar
         Minimum duration for clusters (in seconds).
     minsource : int
@@ -439,7 +494,8 @@ class t_contrast_rel(NDTest):
     @caffeine
     def __init__(self, y, x, contrast, match=None, sub=None, ds=None, tail=0,
                  samples=0, pmin=None, tmin=None, tfce=False, tstart=None,
-                 tstop=None, parc=None, force_permutation=False, **criteria):
+                 tstop=None, parc=None, force_permutation=False, resume=None,
+                 dtype='float64', **criteria):
         if match is None:
             raise TypeError("The `match` parameter needs to be specified for "
                             "repeated measures test t_contrast_rel")
@@ -471,14 +527,21 @@ class t_contrast_rel(NDTest):
             else:
                 t_threshold = threshold = None
 
+            adaptive = samples == 'adaptive'
+            if adaptive:
+                samples = ADAPTIVE_SAMPLES[-1]
             cdist = _ClusterDist(ct.y, samples, threshold, tail, 't',
                                  "t-contrast", tstart, tstop, criteria,
-                                 parc, force_permutation)
+                                 parc, force_permutation, adaptive, dtype)
             cdist.add_original(tmap)
+            cdist.reuse_permutations(resume)
             if cdist.do_permutation:
-                iterator = permute_order(len(ct.y), samples, unit=ct.match)
-                run_permutation(t_contrast, cdist, iterator,
-                                MP_FOR_NON_TOP_LEVEL_FUNCTIONS)
+                batch = permutation_batch_size(cdist, t_contrast.buffer_maps)
+                iterator = partial(permute_order, len(ct.y), samples,
+                                   unit=ct.match, batch=batch)
+                run_permutation(t_contrast, cdist, iterator, batch=batch)
+                if adaptive:
+                    samples = cdist.samples
 
         # NDVar map of t-values
         info = _cs.stat_info('t', t_threshold, tail=tail)
@@ -531,8 +594,11 @@ class corr(NDTest):
     ds : None | Dataset
         If a Dataset is specified, all data-objects can be specified as
         names of Dataset variables.
-    samples : int
-        Number of samples for permutation test (default 0).
+    samples : int | 'adaptive'
+        Number of samples for permutation test (default 0). With
+        ``'adaptive'``, permutations stop as soon as it is determined whether
+        the p-value of each cluster is above or below 0.05 (up to 10000
+        permutations).
     pmin : None | scalar (0 < pmin < 1)
         Threshold for forming clusters:  use an r-value equivalent to an
         uncorrected p-value.
@@ -549,6 +615,16 @@ class corr(NDTest):
         Collect permutation extrema for all regions of the parcellation of
         this dimension. For threshold-based test, the regions are
         disconnected.
+    resume : NDTest
+        Previous result of the same test, for example with fewer ``samples``.
+        Permutations already computed for ``resume`` are reused instead of
+        being recomputed.
+    dtype : 'float64' | 'float32'
+        Precision for computing the permutation distribution (the statistic
+        for the original data is always computed in double precision).
+        ``'float32'`` halves the memory used by the permuted data; statistics
+        of permuted data then agree with ``'float64'`` to about 5 significant
+        digits.
     mintime : scalar
         Minimum duration for clusters (in seconds).
     minsource : int
@@ -574,7 +650,8 @@ class corr(NDTest):
     @caffeine
     def __init__(self, y, x, norm=None, sub=None, ds=None, samples=0,
                  pmin=None, rmin=None, tfce=False, tstart=None, tstop=None,
-                 match=None, parc=None, **criteria):
+                 match=None, parc=None, resume=None, dtype='float64',
+                 **criteria):
         sub = assub(sub, ds)
         y = asndvar(y, sub=sub, ds=ds, dtype=np.float64)
         if not y.has_case:
@@ -625,15 +702,22 @@ class corr(NDTest):
                 r_threshold = threshold = None
             info = _cs.stat_info('r', r_threshold)
 
+            adaptive = samples == 'adaptive'
+            if adaptive:
+                samples = ADAPTIVE_SAMPLES[-1]
             cdist = _ClusterDist(y, samples, threshold, 0, 'r', name, tstart,
-                                 tstop, criteria, parc)
+                                 tstop, criteria, parc, adaptive=adaptive,
+                                 dtype=dtype)
             cdist.add_original(rmap)
+            cdist.reuse_permutations(resume)
             if cdist.do_permutation:
-                def test_func(y, out, perm):
-                    return stats.corr(y, x.x, out, perm)
-                iterator = permute_order(n, samples, unit=match)
-                run_permutation(test_func, cdist, iterator,
-                                MP_FOR_NON_TOP_LEVEL_FUNCTIONS)
+                batch = permutation_batch_size(cdist)
+                iterator = partial(permute_order, n, samples, unit=match,
+                                   batch=batch)
+                run_permutation(stats.CorrPerm(x.x), cdist, iterator,
+                                batch=batch)
+                if adaptive:
+                    samples = cdist.samples
 
         # compile results
         dims = y.dims[1:]
@@ -702,8 +786,11 @@ class ttest_1samp(NDTest):
         0: both (two-tailed);
         1: upper tail (one-tailed);
         -1: lower tail (one-tailed).
-    samples : int
-        Number of samples for permutation test (default 0).
+    samples : int | 'adaptive'
+        Number of samples for permutation test (default 0). With
+        ``'adaptive'``, permutations stop as soon as it is determined whether
+        the p-value of each cluster is above or below 0.05 (up to 10000
+        permutations).
     pmin : None | scalar (0 < pmin < 1)
         Threshold for forming clusters:  use a t-value equivalent to an
         uncorrected p-value.
@@ -719,6 +806,16 @@ class ttest_1samp(NDTest):
         disconnected.
     force_permutation: bool
         Conduct permutations regardless of whether there are any clusters.
+    resume : NDTest
+        Previous result of the same test, for example with fewer ``samples``.
+        Permutations already computed for ``resume`` are reused instead of
+        being recomputed.
+    dtype : 'float64' | 'float32'
+        Precision for computing the permutation distribution (the statistic
+        for the original data is always computed in double precision).
+        ``'float32'`` halves the memory used by the permuted data; statistics
+        of permuted data then agree with ``'float64'`` to about 5 significant
+        digits.
     mintime : scalar
         Minimum duration for clusters (in seconds).
     minsource : int
@@ -752,7 +849,8 @@ class ttest_1samp(NDTest):
     @caffeine
     def __init__(self, y, popmean=0, match=None, sub=None, ds=None, tail=0,
                  samples=0, pmin=None, tmin=None, tfce=False, tstart=None,
-                 tstop=None, parc=None, force_permutation=False, **criteria):
+                 tstop=None, parc=None, force_permutation=False, resume=None,
+                 dtype='float64', **criteria):
         ct = Celltable(y, match=match, sub=sub, ds=ds, coercion=asndvar,
                        dtype=np.float64)
 
@@ -789,14 +887,24 @@ class ttest_1samp(NDTest):
                 y_perm = ct.y - popmean
             else:
                 y_perm = ct.y
+            adaptive = samples == 'adaptive'
+            if adaptive:
+                samples = ADAPTIVE_SAMPLES[-1]
             n_samples, samples = _resample_params(len(y_perm), samples)
+            # complete permutations are not in random order
+            adaptive = adaptive and samples >= 0
             cdist = _ClusterDist(y_perm, n_samples, threshold, tail, 't',
                                  '1-Sample t-Test', tstart, tstop, criteria,
-                                 parc, force_permutation)
+                                 parc, force_permutation, adaptive, dtype)
             cdist.add_original(tmap)
+            cdist.reuse_permutations(resume, samples < 0)
             if cdist.do_permutation:
-                iterator = permute_sign_flip(n, samples)
-                run_permutation(opt.t_1samp_perm, cdist, iterator)
+                batch = permutation_batch_size(cdist)
+                iterator = partial(permute_sign_flip, n, samples, batch=batch)
+                run_permutation(stats.t_1samp_perm_batch, cdist, iterator,
+                                batch=batch)
+                if adaptive:
+                    samples = cdist.samples
 
         # NDVar map of t-values
         info = _cs.stat_info('t', t_threshold, tail=tail)
@@ -881,8 +989,11 @@ class ttest_ind(NDTest):
         0: both (two-tailed);
         1: upper tail (one-tailed);
         -1: lower tail (one-tailed).
-    samples : int
-        Number of samples for permutation test (default 0).
+    samples : int | 'adaptive'
+        Number of samples for permutation test (default 0). With
+        ``'adaptive'``, permutations stop as soon as it is determined whether
+        the p-value of each cluster is above or below 0.05 (up to 10000
+        permutations).
     pmin : None | scalar (0 < pmin < 1)
         Threshold p value for forming clusters. None for threshold-free
         cluster enhancement.
@@ -898,6 +1009,16 @@ class ttest_ind(NDTest):
         disconnected.
     force_permutation: bool
         Conduct permutations regardless of whether there are any clusters.
+    resume : NDTest
+        Previous result of the same test, for example with fewer ``samples``.
+        Permutations already computed for ``resume`` are reused instead of
+        being recomputed.
+    dtype : 'float64' | 'float32'
+        Precision for computing the permutation distribution (the statistic
+        for the original data is always computed in double precision).
+        ``'float32'`` halves the memory used by the permuted data; statistics
+        of permuted data then agree with ``'float64'`` to about 5 significant
+        digits.
     mintime : scalar
         Minimum duration for clusters (in seconds).
     minsource : int
@@ -934,7 +1055,8 @@ class ttest_ind(NDTest):
     @caffeine
     def __init__(self, y, x, c1=None, c0=None, match=None, sub=None, ds=None,
                  tail=0, samples=0, pmin=None, tmin=None, tfce=False,
-                 tstart=None, tstop=None, parc=None, force_permutation=False, **criteria):
+                 tstart=None, tstop=None, parc=None, force_permutation=False,
+                 resume=None, dtype='float64', **criteria):
         ct = Celltable(y, x, match, sub, cat=(c1, c0), ds=ds, coercion=asndvar,
                        dtype=np.float64)
         c1, c0 = ct.cat
@@ -963,16 +1085,21 @@ class ttest_ind(NDTest):
             else:
                 t_threshold = threshold = None
 
+            adaptive = samples == 'adaptive'
+            if adaptive:
+                samples = ADAPTIVE_SAMPLES[-1]
             cdist = _ClusterDist(ct.y, samples, threshold, tail, 't',
                                  'Independent Samples t-Test', tstart, tstop,
-                                 criteria, parc, force_permutation)
+                                 criteria, parc, force_permutation, adaptive,
+                                 dtype)
             cdist.add_original(tmap)
+            cdist.reuse_permutations(resume)
             if cdist.do_permutation:
-                def test_func(y, out, perm):
-                    return stats.t_ind(y, groups, out, perm)
-                iterator = permute_order(n, samples)
-                run_permutation(test_func, cdist, iterator,
-                                MP_FOR_NON_TOP_LEVEL_FUNCTIONS)
+                test_func = partial(stats.t_ind_perm, groups)
+                iterator = partial(permute_order, n, samples)
+                run_permutation(test_func, cdist, iterator)
+                if adaptive:
+                    samples = cdist.samples
 
         # NDVar map of t-values
         info = _cs.stat_info('t', t_threshold, tail=tail)
@@ -1091,8 +1218,11 @@ class ttest_rel(NDTest):
         0: both (two-tailed, default);
         1: upper tail (one-tailed);
         -1: lower tail (one-tailed).
-    samples : int
-        Number of samples for permutation test (default 0).
+    samples : int | 'adaptive'
+        Number of samples for permutation test (default 0). With
+        ``'adaptive'``, permutations stop as soon as it is determined whether
+        the p-value of each cluster is above or below 0.05 (up to 10000
+        permutations).
     pmin : None | scalar (0 < pmin < 1)
         Threshold for forming clusters:  use a t-value equivalent to an
         uncorrected p-value.
@@ -1108,6 +1238,16 @@ class ttest_rel(NDTest):
         disconnected.
     force_permutation: bool
         Conduct permutations regardless of whether there are any clusters.
+    resume : NDTest
+        Previous result of the same test, for example with fewer ``samples``.
+        Permutations already computed for ``resume`` are reused instead of
+        being recomputed.
+    dtype : 'float64' | 'float32'
+        Precision for computing the permutation distribution (the statistic
+        for the original data is always computed in double precision).
+        ``'float32'`` halves the memory used by the permuted data; statistics
+        of permuted data then agree with ``'float64'`` to about 5 significant
+        digits.
     mintime : scalar
         Minimum duration for clusters (in seconds).
     minsource : int
@@ -1146,7 +1286,8 @@ class ttest_rel(NDTest):
     @caffeine
     def __init__(self, y, x, c1=None, c0=None, match=None, sub=None, ds=None,
                  tail=0, samples=0, pmin=None, tmin=None, tfce=False,
-                 tstart=None, tstop=None, parc=None, force_permutation=False, **criteria):
+                 tstart=None, tstop=None, parc=None, force_permutation=False,
+                 resume=None, dtype='float64', **criteria):
         if isinstance(x, NDVar) or isinstance(x, str) and x in ds and isinstance(ds[x], NDVar):
             assert c1 is None
             assert c0 is None
@@ -1198,14 +1339,25 @@ class ttest_rel(NDTest):
             else:
                 t_threshold = threshold = None
 
+            adaptive = samples == 'adaptive'
+            if adaptive:
+                samples = ADAPTIVE_SAMPLES[-1]
             n_samples, samples = _resample_params(len(diff), samples)
+            # complete permutations are not in random order
+            adaptive = adaptive and samples >= 0
             cdist = _ClusterDist(diff, n_samples, threshold, tail, 't',
                                  'Related Samples t-Test', tstart, tstop,
-                                 criteria, parc, force_permutation)
+                                 criteria, parc, force_permutation, adaptive,
+                                 dtype)
             cdist.add_original(tmap)
+            cdist.reuse_permutations(resume, samples < 0)
             if cdist.do_permutation:
-                iterator = permute_sign_flip(n, samples)
-                run_permutation(opt.t_1samp_perm, cdist, iterator)
+                batch = permutation_batch_size(cdist)
+                iterator = partial(permute_sign_flip, n, samples, batch=batch)
+                run_permutation(stats.t_1samp_perm_batch, cdist, iterator,
+                                batch=batch)
+                if adaptive:
+                    samples = cdist.samples
 
         # NDVar map of t-values
         info = _cs.stat_info('t', t_threshold, tail=tail)
@@ -1462,8 +1614,11 @@ class anova(MultiEffectNDTest):
     ds : None | Dataset
         If a Dataset is specified, all data-objects can be specified as
         names of Dataset variables.
-    samples : int
-        Number of samples for permutation test (default 0).
+    samples : int | 'adaptive'
+        Number of samples for permutation test (default 0). With
+        ``'adaptive'``, permutations stop as soon as it is determined whether
+        the p-value of each cluster is above or below 0.05 (up to 10000
+        permutations).
     pmin : None | scalar (0 < pmin < 1)
         Threshold for forming clusters:  use an f-value equivalent to an
         uncorrected p-value.
@@ -1486,6 +1641,16 @@ class anova(MultiEffectNDTest):
         disconnected.
     force_permutation: bool
         Conduct permutations regardless of whether there are any clusters.
+    resume : NDTest
+        Previous result of the same test, for example with fewer ``samples``.
+        Permutations already computed for ``resume`` are reused instead of
+        being recomputed.
+    dtype : 'float64' | 'float32'
+        Precision for computing the permutation distribution (the statistic
+        for the original data is always computed in double precision).
+        ``'float32'`` halves the memory used by the permuted data; statistics
+        of permuted data then agree with ``'float64'`` to about 5 significant
+        digits.
     mintime : scalar
         Minimum duration for clusters (in seconds).
     minsource : int
@@ -1518,7 +1683,8 @@ class anova(MultiEffectNDTest):
     @caffeine
     def __init__(self, y, x, sub=None, ds=None, samples=0, pmin=None,
                  fmin=None, tfce=False, tstart=None, tstop=None, match=None,
-                 parc=None, force_permutation=False, **criteria):
+                 parc=None, force_permutation=False, resume=None,
+                 dtype='float64', **criteria):
         x_arg = x
         sub_arg = sub
         sub = assub(sub, ds)
@@ -1563,20 +1729,27 @@ class anova(MultiEffectNDTest):
             else:
                 f_thresholds = thresholds = (None,) * len(effects)
 
+            adaptive = samples == 'adaptive'
+            if adaptive:
+                samples = ADAPTIVE_SAMPLES[-1]
             cdists = [_ClusterDist(y, samples, thresh, 1, 'F', e.name, tstart,
-                                   tstop, criteria, parc, force_permutation)
+                                   tstop, criteria, parc, force_permutation,
+                                   adaptive, dtype)
                       for e, thresh in zip(effects, thresholds)]
 
             # Find clusters in the actual data
             do_permutation = 0
             for cdist, fmap in zip(cdists, fmaps):
                 cdist.add_original(fmap)
+                cdist.reuse_permutations(resume)
                 do_permutation += cdist.do_permutation
 
             if do_permutation:
-                iterator = permute_order(len(y), samples,
-                                         unit=None if match is False else match)
+                iterator = partial(permute_order, len(y), samples,
+                                   unit=None if match is False else match)
                 run_permutation_me(lm, cdists, iterator)
+                if adaptive:
+                    samples = min(cdist.samples for cdist in cdists)
 
         # create ndvars
         dims = y.dims[1:]
@@ -1839,58 +2012,145 @@ def _label_clusters_binary(bin_map, cmap, cmap_flat, connectivity, criteria):
 
     # apply minimum cluster size criteria
     if criteria and cids.size:
+        index = np.flatnonzero(cmap)
+        labels = cmap.ravel()[index].astype(np.int64)
         for axes, v in criteria:
-            cids = np.setdiff1d(cids,
-                                [i for i in cids if np.count_nonzero(np.equal(cmap, i).any(axes)) < v],
-                                True)
+            extent = _cluster_extent(cmap.shape, index, labels, n, axes)
+            cids = cids[extent[cids] >= v]
             if cids.size == 0:
                 break
 
     return cids
 
 
+def _cluster_extent(shape, index, labels, n, axes):
+    """Extent of clusters after collapsing ``axes``
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the cluster map.
+    index : array of int
+        Flat indices of all labelled points in the cluster map.
+    labels : array of int
+        Cluster label at each point in ``index``.
+    n : int
+        Largest cluster label.
+    axes : tuple of int
+        Axes to collapse.
+
+    Returns
+    -------
+    extent : array of int, shape = (n + 1,)
+        For each label, the number of distinct positions on the remaining axes.
+    """
+    kept = [ax for ax in range(len(shape)) if ax not in axes]
+    if kept:
+        position = np.unravel_index(index, shape)
+        kept_shape = [shape[ax] for ax in kept]
+        n_kept = int(np.prod(kept_shape))
+        keys = labels * n_kept
+        keys += np.ravel_multi_index([position[ax] for ax in kept], kept_shape)
+        labels = np.unique(keys) // n_kept
+    else:
+        labels = np.unique(labels)
+    return np.bincount(labels, minlength=n + 1)
+
+
+def _cluster_voxels(cluster_map, cids):
+    """Locate all voxels of the clusters ``cids`` in a single pass
+
+    Parameters
+    ----------
+    cluster_map : array of int
+        Map in which clusters are marked by bearing the same number.
+    cids : array_like of int
+        Cluster ids.
+
+    Returns
+    -------
+    index : array of int
+        For each voxel, the index of its cluster in ``cids``.
+    voxels : tuple of array of int
+        Position of the voxels (as returned by :func:`numpy.nonzero`).
+    """
+    cids = np.asarray(cids, np.intp)
+    n = max(cluster_map.max(), cids.max(initial=0)) + 1
+    cid_index = np.full(n, -1, np.intp)
+    cid_index[cids] = np.arange(len(cids))
+    index_map = cid_index[cluster_map]
+    voxels = np.nonzero(index_map >= 0)
+    return index_map[voxels], voxels
+
+
 def tfce(stat_map, tail, connectivity):
-    tfce_im = np.empty(stat_map.shape, np.float64)
-    tfce_im_1d = flatten_1d(tfce_im)
-    bin_buff = np.empty(stat_map.shape, np.bool8)
-    int_buff = np.empty(stat_map.shape, np.uint32)
-    int_buff_flat = flatten(int_buff, connectivity)
-    int_buff_1d = flatten_1d(int_buff)
-    return _tfce(stat_map, tail, connectivity, tfce_im, tfce_im_1d, bin_buff, int_buff,
-                 int_buff_flat, int_buff_1d)
+    out = np.empty(stat_map.shape, np.float64)
+    graph = tfce_graph(stat_map.shape, connectivity)
+    return _tfce(stat_map, tail, graph, out)
 
 
-def _tfce(stat_map, tail, conn, out, out_1d, bin_buff, int_buff,
-          int_buff_flat, int_buff_1d, dh=0.1, e=0.5, h=2.0):
-    "Threshold-free cluster enhancement"
-    out.fill(0)
+def tfce_graph(shape, connectivity):
+    """Neighborhood structure of a flattened map for :func:`_tfce`
 
-    # determine slices
-    if tail == 0:
-        hs = chain(np.arange(-dh, stat_map.min(), -dh),
-                   np.arange(dh, stat_map.max(), dh))
-    elif tail < 0:
-        hs = np.arange(-dh, stat_map.min(), -dh)
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the statistical map (non-adjacent dimension on the first
+        axis).
+    connectivity : Connectivity
+        N-dimensional connectivity.
+
+    Returns
+    -------
+    graph : tuple of arrays
+        ``(strides, lengths, custom_indptr, custom_indices)``: strides and
+        lengths of grid-connected axes, and the symmetric custom connectivity
+        of the first axis in CSR format.
+    """
+    ndim = len(shape)
+    strides = np.cumprod((1,) + shape[:0:-1])[::-1]
+    center = (1,) * ndim
+    grid_axes = [ax for ax in range(ndim) if
+                 connectivity.struct[center[:ax] + (0,) + center[ax + 1:]]]
+    if 0 in connectivity.custom_csr:
+        indptr, indices = connectivity.custom_csr[0]
     else:
-        hs = np.arange(dh, stat_map.max(), dh)
-
-    # label clusters in slices at different heights
-    # fill each cluster with total section value
-    # each point's value is the vertical sum
-    for h_ in hs:
-        if h_ > 0:
-            np.greater_equal(stat_map, h_, bin_buff)
-            h_factor = h_ ** h
-        else:
-            np.less_equal(stat_map, h_, bin_buff)
-            h_factor = (-h_) ** h
+        indptr = indices = np.empty(0, np.int64)
+    return (strides[grid_axes].astype(np.int64),
+            np.array([shape[ax] for ax in grid_axes], np.int64),
+            indptr, indices)
+
 
-        c_ids = _label_clusters_binary(bin_buff, int_buff, int_buff_flat, conn, None)
-        tfce_increment(c_ids, int_buff_1d, out_1d, e, h_factor)
+def _tfce(stat_map, tail, graph, out, dh=0.1, e=0.5, h=2.0):
+    """Threshold-free cluster enhancement
 
+    The TFCE value of each point is the sum over heights ``h_`` in steps of
+    ``dh`` of ``extent ** e * h_ ** h``, where ``extent`` is the size of the
+    cluster containing the point in the map thresholded at ``h_``.
+    """
+    out.fill(0)
+    out_1d = flatten_1d(out)
+    x = stat_map.ravel()
+    if tail >= 0:
+        _tfce_tail(x, stat_map.max(), graph, out_1d, dh, e, h)
+    if tail <= 0:
+        _tfce_tail(-x, -stat_map.min(), graph, out_1d, dh, e, h)
     return out
 
 
+def _tfce_tail(x, x_max, graph, out, dh, e, h):
+    "Add TFCE values for the positive tail of ``x`` to ``out``"
+    hs = np.arange(dh, x_max, dh)
+    if len(hs) == 0:
+        return
+    # index of the highest height that each point reaches
+    levels = np.searchsorted(hs, x, 'right') - 1
+    order = np.flatnonzero(levels >= 0)
+    order = order[np.argsort(levels[order], kind='mergesort')[::-1]]
+    cum_factor = np.cumsum(hs ** h)
+    tfce_union_find(order, levels, cum_factor, e, *graph, out)
+
+
 class StatMapProcessor(object):
 
     def __init__(self, tail, max_axes, parc):
@@ -1899,6 +2159,12 @@ class StatMapProcessor(object):
         self.max_axes = max_axes
         self.parc = parc
 
+    @property
+    def buffer_bytes(self):
+        "Memory used by preallocated buffers"
+        return sum(v.nbytes for v in self.__dict__.values() if
+                   isinstance(v, np.ndarray) and v.base is None)
+
     def max_stat(self, stat_map):
         if self.tail == 0:
             v = np.abs(stat_map, stat_map).max(self.max_axes)
@@ -1921,19 +2187,12 @@ class TFCEProcessor(StatMapProcessor):
         self.connectivity = connectivity
 
         # Pre-allocate memory buffers used for cluster processing
-        self._bin_buff = np.empty(shape, np.bool8)
-        self._int_buff = np.empty(shape, np.uint32)
         self._tfce_im = np.empty(shape, np.float64)
-        self._tfce_im_1d = flatten_1d(self._tfce_im)
-        self._int_buff_flat = flatten(self._int_buff, connectivity)
-        self._int_buff_1d = flatten_1d(self._int_buff)
+        self._graph = tfce_graph(shape, connectivity)
 
     def max_stat(self, stat_map):
-        v = _tfce(
-            stat_map, self.tail, self.connectivity, self._tfce_im,
-            self._tfce_im_1d,
-            self._bin_buff, self._int_buff, self._int_buff_flat, self._int_buff_1d,
-        ).max(self.max_axes)
+        v = _tfce(stat_map, self.tail, self._graph, self._tfce_im
+                  ).max(self.max_axes)
         if self.parc is None:
             return v
         else:
@@ -1962,32 +2221,100 @@ class ClusterProcessor(StatMapProcessor):
         else:
             self._int_buff = self._int_buff_flat = None
 
+        # parcel of each row of the 2d cluster map
+        self._cmap_2d = self._cmap.reshape((shape[0], -1))
+        self._row_parc, self._n_parc = _row_parc(shape[0], parc)
+
     def max_stat(self, stat_map, threshold=None):
         if threshold is None:
             threshold = self.threshold
-        cmap = self._cmap
         cids = _label_clusters(stat_map, threshold, self.tail, self.connectivity,
-                               self.criteria, cmap, self._cmap_flat,
+                               self.criteria, self._cmap, self._cmap_flat,
                                self._bin_buff, self._int_buff,
                                self._int_buff_flat)
-        if self.parc is not None:
-            v = []
-            for idx in self.parc:
-                clusters_v = ndimage.sum(stat_map[idx], cmap[idx], cids)
-                if len(clusters_v):
-                    if self.tail <= 0:
-                        np.abs(clusters_v, clusters_v)
-                    v.append(clusters_v.max())
-                else:
-                    v.append(0)
-            return v
-        elif len(cids):
-            clusters_v = ndimage.sum(stat_map, cmap, cids)
-            if self.tail <= 0:
-                np.abs(clusters_v, clusters_v)
-            return clusters_v.max()
+        out = cluster_mass_max(self._cmap_2d, stat_map.reshape(self._cmap_2d.shape),
+                               cids, self._row_parc, self.tail,
+                               np.empty(self._n_parc))
+        if self.parc is None:
+            return out[0]
+        else:
+            return out
+
+
+class MultiClusterProcessor(StatMapProcessor):
+    """Find clusters in the maps of several effects jointly
+
+    The maps of all effects are stacked (see :meth:`Connectivity.stack`), so
+    that thresholding, labeling and computing cluster masses each take a
+    single pass over all effects, with buffers that are shared by all effects.
+    """
+    def __init__(self, tail, max_axes, parc, shape, connectivity, threshold,
+                 criteria, thresholds):
+        StatMapProcessor.__init__(self, tail, max_axes, parc)
+        self.n_effects = n = len(thresholds)
+        self.shape = shape
+        if connectivity.custom:
+            stacked_shape = (n * shape[0],) + shape[1:]
+            thresholds = np.repeat(thresholds, shape[0])
+        else:
+            stacked_shape = (n,) + shape
+            if criteria:
+                criteria = [(tuple(ax + 1 for ax in axes) + (0,), v) for
+                            axes, v in criteria]
+        self.connectivity = connectivity.stack(n)
+        self.criteria = criteria
+        # threshold broadcasts along the first axis of the stacked map
+        self.thresholds = np.reshape(thresholds, (-1,) + (1,) * (len(stacked_shape) - 1))
+        self._stacked_shape = stacked_shape
+
+        # Pre-allocate memory buffers used for cluster processing
+        self._bin_buff = np.empty(stacked_shape, np.bool8)
+        self._cmap = np.empty(stacked_shape, np.uint32)
+        self._cmap_flat = flatten(self._cmap, self.connectivity)
+        if tail == 0:
+            self._int_buff = np.empty(stacked_shape, np.uint32)
+            self._int_buff_flat = flatten(self._int_buff, self.connectivity)
+        else:
+            self._int_buff = self._int_buff_flat = None
+
+        # rows of the 2d cluster map are (effect, row), parcels (effect, parcel)
+        self._cmap_2d = self._cmap.reshape((n * shape[0], -1))
+        row_parc, self._n_parc = _row_parc(shape[0], parc)
+        self._row_parc = np.concatenate([
+            np.where(row_parc >= 0, row_parc + i * self._n_parc, -1) for i in
+            range(n)])
+
+    def max_stats(self, stat_maps):
+        """Maximum statistic for each effect
+
+        Parameters
+        ----------
+        stat_maps : array  (n_effects, ...)
+            Statistical map for each effect.
+        """
+        cids = _label_clusters(stat_maps.reshape(self._stacked_shape),
+                               self.thresholds, self.tail, self.connectivity,
+                               self.criteria, self._cmap, self._cmap_flat,
+                               self._bin_buff, self._int_buff,
+                               self._int_buff_flat)
+        out = cluster_mass_max(self._cmap_2d, stat_maps.reshape(self._cmap_2d.shape),
+                               cids, self._row_parc, self.tail,
+                               np.empty(self.n_effects * self._n_parc))
+        out = out.reshape((self.n_effects, self._n_parc))
+        if self.parc is None:
+            return list(out[:, 0])
         else:
-            return 0
+            return list(out)
+
+
+def _row_parc(n_rows, parc):
+    "Parcel of each row of a 2d cluster map, and number of parcels"
+    if parc is None:
+        return np.zeros(n_rows, np.int64), 1
+    row_parc = np.full(n_rows, -1, np.int64)
+    for i, idx in enumerate(parc):
+        row_parc[idx] = i
+    return row_parc, len(parc)
 
 
 def get_map_processor(kind, *args):
@@ -2001,6 +2328,13 @@ def get_map_processor(kind, *args):
         raise ValueError("kind=%s" % repr(kind))
 
 
+def get_map_processor_me(thresholds, kind, *args):
+    "Map processor for the maps of all effects of a multi-effect test"
+    if kind == 'cluster':
+        return MultiClusterProcessor(*args, thresholds)
+    return get_map_processor(kind, *args)
+
+
 class _ClusterDist:
     """Accumulate information on a cluster statistic.
 
@@ -2018,7 +2352,8 @@ class _ClusterDist:
         ``cdist.add_perm(pmap)``.
     """
     def __init__(self, y, samples, threshold, tail=0, meas='?', name=None,
-                 tstart=None, tstop=None, criteria={}, parc=None, force_permutation=False):
+                 tstart=None, tstop=None, criteria={}, parc=None,
+                 force_permutation=False, adaptive=False, dtype='float64'):
         """Accumulate information on a cluster statistic.
 
         Parameters
@@ -2051,8 +2386,19 @@ class _ClusterDist:
             disconnected.
         force_permutation : bool
             Conduct permutations regardless of whether there are any clusters.
+        adaptive : bool
+            Stop permutations as soon as all p-values are determined (see
+            :func:`permutation_rounds`); ``samples`` is the maximum number of
+            permutations.
+        dtype : 'float64' | 'float32'
+            Precision of the data for permutations (see
+            :meth:`data_for_permutation`).
         """
         assert y.has_case
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float64):
+            raise ValueError("dtype=%r: needs to be 'float32' or 'float64'" %
+                             (dtype.name,))
         assert parc is None or isinstance(parc, str)
         if threshold is None:
             kind = 'raw'
@@ -2209,10 +2555,15 @@ class _ClusterDist:
         self.has_original = False
         self.do_permutation = False
         self.dt_perm = None
+        self.timing = None
+        self.n_reused = 0
+        self._reusable = True
         self._finalized = False
         self._init_time = current_time()
         self._host = socket.gethostname()
         self.force_permutation = force_permutation
+        self.adaptive = adaptive
+        self.dtype = dtype
 
         from .. import __version__
         self._version = __version__
@@ -2281,22 +2632,105 @@ class _ClusterDist:
             self._create_dist()
             self.do_permutation = True
         else:
-            self.dist_array = None
             self.finalize()
 
     def _create_dist(self):
         "Create the distribution container"
-        if CONFIG['n_workers']:
-            n = reduce(operator.mul, self.dist_shape)
-            dist_array = RawArray('d', n)
-            dist = np.frombuffer(dist_array, np.float64, n)
-            dist.shape = self.dist_shape
+        self.dist = np.zeros(self.dist_shape)
+
+    def reuse_permutations(self, res, complete=False):
+        """Reuse permutations from a previous result of the same test
+
+        Parameters
+        ----------
+        res : None | NDTest
+            Previous result of the same test, possibly with fewer samples.
+            Permutations are generated by index, so that the first
+            ``min(res.samples, samples)`` permutations are identical and are
+            copied instead of being recomputed (see ``n_reused``).
+        complete : bool
+            Whether the permutations are a complete enumeration rather than
+            a random sample (``samples=-1``).
+        """
+        if res is None or not self.do_permutation:
+            return
+        logger = logging.getLogger(__name__)
+        for _, cdist in res._iter_cdists():
+            if cdist is not None and cdist.name == self.name:
+                break
         else:
-            dist_array = None
-            dist = np.zeros(self.dist_shape)
+            logger.info("Previous result has no distribution for %s", self.name)
+            return
 
-        self.dist_array = dist_array
-        self.dist = dist
+        if cdist.dist is None or not cdist._reusable:
+            reason = "no reusable permutations"
+        elif (res.samples < 0) != complete:
+            reason = "different permutation scheme"
+        elif (cdist.kind != self.kind or cdist.threshold != self.threshold or
+              cdist.tail != self.tail or cdist.tstart != self.tstart or
+              cdist.tstop != self.tstop or cdist.parc != self.parc or
+              cdist.criteria != self.criteria or cdist.dtype != self.dtype):
+            reason = "different test parameters"
+        elif (cdist.dist.shape[1:] != self.dist_shape[1:] or
+              not np.array_equal(cdist._original_param_map,
+                                 self._original_param_map)):
+            reason = "different data"
+        else:
+            n = min(len(cdist.dist), self.samples)
+            self.dist[:n] = cdist.dist[:n]
+            self.n_reused = n
+            logger.debug("Reusing %i permutations for %s", n, self.name)
+            return
+        logger.info("Can not reuse permutations for %s: %s", self.name, reason)
+
+    def p_undecided(self, n):
+        """Whether any p-value could be on either side of ``ADAPTIVE_ALPHA``
+
+        Parameters
+        ----------
+        n : int
+            Number of permutations computed so far.
+
+        Notes
+        -----
+        Uses the Clopper-Pearson confidence interval (``ADAPTIVE_CONFIDENCE``)
+        for the p-value of each cluster (or each value in the statistical map
+        for TFCE and maximum statistic).
+        """
+        dist = self.dist[:n]
+        if dist.ndim > 1:
+            dist = dist.max(tuple(range(1, dist.ndim)))
+
+        if self.kind == 'cluster':
+            if not self.n_clusters:
+                return False
+            v = np.abs(ndimage.sum(self._original_param_map,
+                                   self._original_cluster_map, self._cids))
+        elif self.kind == 'tfce':
+            v = self._original_cluster_map.ravel()
+        elif self.tail == 0:
+            v = np.abs(self._original_param_map.ravel())
+        elif self.tail < 0:
+            v = -self._original_param_map.ravel()
+        else:
+            v = self._original_param_map.ravel()
+        n_larger = n - np.searchsorted(np.sort(dist), v)
+        k = np.unique(n_larger)
+
+        a = (1 - ADAPTIVE_CONFIDENCE) / 2
+        p_low = scipy.stats.beta.ppf(a, k, n - k + 1)
+        p_low[k == 0] = 0
+        p_high = scipy.stats.beta.ppf(1 - a, k + 1, n - k)
+        p_high[k == n] = 1
+        return np.any((p_low <= ADAPTIVE_ALPHA) & (p_high >= ADAPTIVE_ALPHA))
+
+    def truncate(self, n):
+        "Discard all but the first ``n`` permutations"
+        if n == self.samples:
+            return
+        self.dist = self.dist[:n].copy()
+        self.dist_shape = (n,) + self.dist_shape[1:]
+        self.samples = n
 
     def _aggregate_dist(self, **sub):
         """Aggregate permutation distribution to one value per permutation
@@ -2348,14 +2782,15 @@ class _ClusterDist:
         attrs = ('name', 'meas', '_version', '_host', '_init_time',
                  # settings ...
                  'kind', 'threshold', 'tail', 'criteria', 'samples', 'tstart',
-                 'tstop', 'parc',
+                 'tstop', 'parc', 'adaptive', 'dtype',
                  # data properties ...
                  'dims', 'shape', '_nad_ax', '_criteria', '_connectivity',
                  # results ...
-                 'dt_original', 'dt_perm', 'n_clusters', '_dist_dims', 'dist',
+                 'dt_original', 'dt_perm', 'timing', 'n_clusters', '_dist_dims',
+                 'dist',
                  '_original_param_map', '_original_cluster_map', '_cids')
         state = {name: getattr(self, name) for name in attrs}
-        state['version'] = 1
+        state['version'] = 2
         return state
 
     def __setstate__(self, state):
@@ -2398,8 +2833,13 @@ class _ClusterDist:
                 (dims[nad_ax],) + dims[:nad_ax] + dims[nad_ax + 1:],
                 state['parc'])
 
+        state.setdefault('adaptive', False)
+        state.setdefault('dtype', np.dtype(np.float64))
+        state.setdefault('timing', None)
         for k, v in state.items():
             setattr(self, k, v)
+        # permutations before version 2 were not generated by index
+        self._reusable = version >= 2
         self.has_original = True
         self.finalize()
 
@@ -2414,6 +2854,8 @@ class _ClusterDist:
             args.append("tstart=%r" % self.tstart)
         if self.tstop:
             args.append("tstop=%r" % self.tstop)
+        if self.dtype != np.float64:
+            args.append("dtype=%r" % self.dtype.name)
         for item in self.criteria.items():
             args.append("%s=%r" % item)
         return args
@@ -2475,26 +2917,36 @@ class _ClusterDist:
         self.cluster_map = cluster_map_
         self._finalized = True
 
-    def data_for_permutation(self, raw=True):
+    def data_for_permutation(self, shared=True):
         """Retrieve data flattened for permutation
 
         Parameters
         ----------
-        raw : bool
-            Return a RawArray and a shape tuple instead of a numpy array.
+        shared : bool
+            Return a :class:`SharedArray` for worker processes instead of a
+            numpy array.
+
+        Notes
+        -----
+        The data are converted to ``dtype``, so that with ``float32`` the
+        statistical maps for permutations are computed in single precision.
+
+        Memory-mapped data (for example, an NDVar with data from
+        ``numpy.load(..., mmap_mode='r')``) are not copied into memory;
+        instead, :class:`ColumnBlocks` reads them into memory one block of
+        columns at a time.
         """
         # get data in the right shape
         x = self.y_perm.x
         if self._nad_ax:
             x = x.swapaxes(1, 1 + self._nad_ax)
 
-        if not raw:
-            return x.reshape((len(x), -1))
-
-        n = reduce(operator.mul, self.y_perm.shape)
-        ra = RawArray('d', n)
-        ra[:] = x.ravel()  # OPT: don't copy data
-        return ra, x.shape
+        if isinstance(x, np.memmap):
+            return ColumnBlocks(x, self.dtype)
+        x = x.reshape((len(x), -1)).astype(self.dtype, copy=False)
+        if shared:
+            return SharedArray(x)
+        return x
 
     def _cluster_properties(self, cluster_map, cids):
         """Create a Dataset with cluster properties
@@ -2513,28 +2965,17 @@ class _ClusterDist:
             Cluster properties. Which properties are included depends on the
             dimensions.
         """
-        ndim = cluster_map.ndim
         n_clusters = len(cids)
-
-        # setup compression
-        compression = []
-        for ax, dim in enumerate(cluster_map.dims):
-            extents = np.empty((n_clusters, len(dim)), dtype=np.bool_)
-            axes = tuple(i for i in range(ndim) if i != ax)
-            compression.append((ax, dim, axes, extents))
-
-        # find extents for all clusters
-        c_mask = np.empty(cluster_map.shape, np.bool_)
-        for i, cid in enumerate(cids):
-            np.equal(cluster_map, cid, c_mask)
-            for ax, dim, axes, extents in compression:
-                np.any(c_mask, axes, extents[i])
+        index, voxels = _cluster_voxels(cluster_map.x, cids)
 
         # prepare Dataset
         ds = Dataset()
         ds['id'] = Var(cids)
 
-        for ax, dim, axes, extents in compression:
+        # extent of all clusters along each dimension
+        for position, dim in zip(voxels, cluster_map.dims):
+            extents = np.zeros((n_clusters, len(dim)), np.bool_)
+            extents[index, position] = True
             properties = dim._cluster_properties(extents)
             if properties is not None:
                 ds.update(properties)
@@ -2686,11 +3127,9 @@ class _ClusterDist:
         # expand clusters
         if maps:
             shape = (ds.n_cases,) + param_map.shape
-            c_maps = np.empty(shape, dtype=param_map.x.dtype)
-            c_mask = np.empty(param_map.shape, dtype=np.bool_)
-            for i, cid in enumerate(cids):
-                np.equal(cluster_map.x, cid, c_mask)
-                np.multiply(param_map.x, c_mask, c_maps[i])
+            c_maps = np.zeros(shape, dtype=param_map.x.dtype)
+            index, voxels = _cluster_voxels(cluster_map.x, cids)
+            c_maps[(index,) + voxels] = param_map.x[voxels]
 
             # package ndvar
             dims = ('case',) + param_map.dims
@@ -2924,213 +3363,474 @@ class _MergedTemporalClusterDist:
         return clusters
 
 
-def distribution_worker(dist_array, dist_shape, in_queue, kill_beacon):
-    "Worker that accumulates values and places them into the distribution"
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-    n = reduce(operator.mul, dist_shape)
-    dist = np.frombuffer(dist_array, np.float64, n)
-    dist.shape = dist_shape
-    samples = dist_shape[0]
-    for i in trange(samples, desc="Permutation test", unit=' permutations',
-                    disable=CONFIG['tqdm']):
-        dist[i] = in_queue.get()
-        if kill_beacon.is_set():
-            return
+class ColumnBlocks:
+    """Memory-mapped data for permutation, read into memory in column blocks
 
+    Parameters
+    ----------
+    x : np.memmap  (n_cases, ...)
+        Data, in the internal shape of the statistical map.
+    dtype : np.dtype
+        Data type of the blocks.
 
-def permutation_worker(in_queue, out_queue, y, shape, test_func, map_args,
-                       kill_beacon):
-    "Worker for 1 sample t-test"
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-    if CONFIG['nice']:
-        os.nice(CONFIG['nice'])
+    Notes
+    -----
+    Blocks consist of whole rows along the first (non-case) axis of ``x``, so
+    that the columns of each block are contiguous in the flattened
+    statistical map. Each block takes up to ``BLOCK_BUFFER_SIZE`` bytes.
 
-    n = reduce(operator.mul, shape)
-    y = np.frombuffer(y, np.float64, n).reshape((shape[0], -1))
-    stat_map = np.empty(shape[1:])
-    stat_map_flat = stat_map.ravel()
-    map_processor = get_map_processor(*map_args)
-    while not kill_beacon.is_set():
-        perm = in_queue.get()
-        if perm is None:
+    When pickled for worker processes, only the location of ``x`` in the
+    file is stored, and the worker maps the file again.
+    """
+    def __init__(self, x, dtype):
+        n_cases = len(x)
+        row_size = reduce(operator.mul, x.shape[2:], 1)
+        row_bytes = n_cases * row_size * dtype.itemsize
+        self.x = x
+        self.dtype = dtype
+        self._row_size = row_size
+        self._block_rows = max(1, BLOCK_BUFFER_SIZE // row_bytes)
+
+    def __getstate__(self):
+        x = self.x
+        # offset of x in the file: numpy maps the file from the allocation
+        # boundary preceding x.offset
+        map_start = x.offset - x.offset % mmap.ALLOCATIONGRANULARITY
+        map_address = np.frombuffer(x._mmap, np.uint8).ctypes.data
+        offset = map_start + x.ctypes.data - map_address
+        state = {k: v for k, v in self.__dict__.items() if k != 'x'}
+        state['_file'] = (x.filename, offset, x.shape, x.dtype, x.strides)
+        return state
+
+    def __setstate__(self, state):
+        filename, offset, shape, dtype, strides = state.pop('_file')
+        buffer = np.memmap(filename, np.uint8, 'c')
+        state['x'] = np.ndarray(shape, dtype, buffer, offset, strides)
+        self.__dict__.update(state)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __iter__(self):
+        "Iterate over ``(index, block)`` with ``block (n_cases, n_columns)``"
+        n_rows = self.x.shape[1]
+        for start in range(0, n_rows, self._block_rows):
+            stop = min(start + self._block_rows, n_rows)
+            block = np.array(self.x[:, start:stop], self.dtype)
+            index = slice(start * self._row_size, stop * self._row_size)
+            yield index, block.reshape((len(block), -1))
+
+
+def apply_blocks(test_func, y, out, perm):
+    """Apply ``test_func`` to ``ColumnBlocks`` one block at a time
+
+    Test statistics are independent for each column, so that the statistical
+    maps are assembled from the maps of the blocks.
+    """
+    for index, y_block in y:
+        out_block = np.empty(out.shape[:-1] + y_block.shape[1:], out.dtype)
+        test_func(y_block, out_block, perm)
+        out[..., index] = out_block
+    return out
+
+
+def permutation_ranges(start, stop, n_workers, batch=None):
+    """Split permutations ``start`` to ``stop`` into contiguous ranges
+
+    With ``batch``, the ranges are aligned to blocks of ``batch`` permutations
+    (counted from ``start``).
+    """
+    n = stop - start
+    n_units = int(ceil(n / batch)) if batch else n
+    n_workers = max(1, min(n_units, n_workers))
+    bounds = np.linspace(0, n_units, n_workers + 1).round().astype(int)
+    if batch:
+        bounds = np.minimum(bounds * batch, n)
+    return list(intervals(bounds + start))
+
+
+def permutation_rounds(dists):
+    """Ranges of permutations that need to be computed
+
+    Permutations already present in the distributions (``n_reused``) are
+    skipped. For adaptive distributions, permutations are computed in rounds
+    of increasing size (``ADAPTIVE_SAMPLES``), until the confidence interval
+    for all p-values excludes ``ADAPTIVE_ALPHA``, and the distributions are
+    then truncated to the number of permutations actually computed.
+    """
+    dists = [d for d in dists if d.do_permutation]
+    start = min(d.n_reused for d in dists)
+    if not dists[0].adaptive:
+        if start < dists[0].samples:
+            yield start, dists[0].samples
+        return
+
+    for stop in ADAPTIVE_SAMPLES:
+        if stop > start:
+            yield start, stop
+            start = stop
+        if not any(d.p_undecided(stop) for d in dists):
             break
-        test_func(y, stat_map_flat, perm)
-        max_v = map_processor.max_stat(stat_map)
-        out_queue.put(max_v)
+    for d in dists:
+        d.truncate(start)
+
+
+def new_timing():
+    "Container for the timing of a permutation test (see ``NDTest.timing``)"
+    return {'total': 0., 'data': 0., 'kernel': 0., 'map': 0., 'ipc': 0.,
+            'finalize': 0., 'n_permutations': 0, 'workers': {},
+            'memory': {'data': 0, 'buffers': 0}}
 
 
-def run_permutation(test_func, dist, iterator, use_mp=True):
-    if use_mp and CONFIG['n_workers']:
-        workers, out_queue, kill_beacon = setup_workers(test_func, dist)
+def new_task_timing():
+    "Container for the timing of the permutations computed in one process"
+    return {'pid': os.getpid(), 'kernel': 0., 'map': 0., 'permutations': 0,
+            'buffers': 0, 'done': None}
 
-        try:
-            for perm in iterator:
-                out_queue.put(perm)
 
-            for _ in range(len(workers) - 1):
-                out_queue.put(None)
+def add_task_timing(timing, task_timing, t_received=None):
+    """Add the timing of a task to the timing of the test
 
-            logger = logging.getLogger(__name__)
-            for w in workers:
-                w.join()
-                logger.debug("worker joined")
-        except KeyboardInterrupt:
-            kill_beacon.set()
-            raise
+    Parameters
+    ----------
+    timing : dict
+        Timing of the test (see :func:`new_timing`).
+    task_timing : dict
+        Timing of the task (see :func:`new_task_timing`).
+    t_received : float
+        For tasks in worker processes, the time at which the result was
+        received (to estimate the time spent on transferring results).
+    """
+    timing['kernel'] += task_timing['kernel']
+    timing['map'] += task_timing['map']
+    timing['n_permutations'] += task_timing['permutations']
+    if t_received is not None and task_timing['done'] is not None:
+        timing['ipc'] += max(0., t_received - task_timing['done'])
+    worker = timing['workers'].setdefault(
+        task_timing['pid'], {'permutations': 0, 'time': 0.})
+    worker['permutations'] += task_timing['permutations']
+    worker['time'] += task_timing['kernel'] + task_timing['map']
+    if worker['time']:
+        worker['permutations_per_second'] = worker['permutations'] / worker['time']
     else:
-        y = dist.data_for_permutation(False)
-        map_processor = get_map_processor(*dist.map_args)
-        stat_map = np.empty(dist.shape)
+        worker['permutations_per_second'] = 0.
+    memory = timing['memory']
+    memory['buffers'] = max(memory['buffers'], task_timing['buffers'])
+
+
+def data_bytes(y):
+    "Memory used by the data for permutation (except memory-mapped data)"
+    if isinstance(y, SharedArray):
+        return y.size * y.dtype.itemsize
+    elif isinstance(y, ColumnBlocks):
+        return 0
+    return y.nbytes
+
+
+def log_timing(timing, name):
+    "Log the timing of a permutation test with the ``eelbrain`` logger"
+    logger = logging.getLogger(__name__)
+    logger.info(
+        "%s: %i permutations in %.2f s (data %.2f s, kernel %.2f s, map "
+        "%.2f s, IPC %.2f s, finalize %.2f s)", name, timing['n_permutations'],
+        timing['total'], timing['data'], timing['kernel'], timing['map'],
+        timing['ipc'], timing['finalize'])
+    for pid, worker in timing['workers'].items():
+        logger.info("%s: process %i, %i permutations, %.1f / s", name, pid,
+                    worker['permutations'], worker['permutations_per_second'])
+    logger.info("%s: data %.1f MB, buffers %.1f MB per process", name,
+                timing['memory']['data'] / 2**20,
+                timing['memory']['buffers'] / 2**20)
+
+
+def iter_permutations(iterator, start, stop, batch):
+    "Permutations ``start`` to ``stop``, in blocks if ``batch`` is specified"
+    if batch:
+        return islice(iterator(start=start), int(ceil((stop - start) / batch)))
+    return islice(iterator(start=start), stop - start)
+
+
+def iter_max_stat(test_func, y, shape, map_processor, permutations, batch,
+                  timing):
+    """Generate the maximum statistic for each permutation
+
+    Time spent and buffer memory are recorded in ``timing`` (see
+    :func:`new_task_timing`).
+    """
+    if isinstance(y, ColumnBlocks):
+        test_func = partial(apply_blocks, test_func)
+    if batch:
+        stat_maps = np.empty((batch,) + shape, y.dtype)
+        stat_maps_flat = stat_maps.reshape((batch, -1))
+        timing['buffers'] = stat_maps.nbytes + map_processor.buffer_bytes
+        for perm in permutations:
+            n_perm = len(perm)
+            t = perf_counter()
+            test_func(y, stat_maps_flat[:n_perm], perm)
+            timing['kernel'] += perf_counter() - t
+            timing['permutations'] += n_perm
+            for stat_map in stat_maps[:n_perm]:
+                t = perf_counter()
+                v = map_processor.max_stat(stat_map)
+                timing['map'] += perf_counter() - t
+                yield v
+    else:
+        stat_map = np.empty(shape, y.dtype)
         stat_map_flat = stat_map.ravel()
-        for i, perm in enumerate(iterator):
+        timing['buffers'] = stat_map.nbytes + map_processor.buffer_bytes
+        for perm in permutations:
+            t = perf_counter()
             test_func(y, stat_map_flat, perm)
-            dist.dist[i] = map_processor.max_stat(stat_map)
-    dist.finalize()
+            t_kernel = perf_counter()
+            v = map_processor.max_stat(stat_map)
+            timing['map'] += perf_counter() - t_kernel
+            timing['kernel'] += t_kernel - t
+            timing['permutations'] += 1
+            yield v
 
 
-def setup_workers(test_func, dist):
-    "Initialize workers for permutation tests"
-    logger = logging.getLogger(__name__)
-    logger.debug("Setting up %i worker processes..." % CONFIG['n_workers'])
-    permutation_queue = SimpleQueue()
-    dist_queue = SimpleQueue()
-    kill_beacon = Event()
-
-    # permutation workers
-    y, shape = dist.data_for_permutation()
-    args = (permutation_queue, dist_queue, y, shape, test_func, dist.map_args,
-            kill_beacon)
-    workers = []
-    for _ in range(CONFIG['n_workers']):
-        w = Process(target=permutation_worker, args=args)
-        w.start()
-        workers.append(w)
-
-    # distribution worker
-    args = (dist.dist_array, dist.dist_shape, dist_queue, kill_beacon)
-    w = Process(target=distribution_worker, args=args)
-    w.start()
-    workers.append(w)
-
-    return workers, permutation_queue, kill_beacon
+def permutation_task(args):
+    """Compute the maximum statistics for a range of permutations
 
+    Runs in a worker process; returns ``(start, max_stats, timing)``.
+    """
+    test_func, y, shape, map_args, iterator, batch, start, stop = args
+    if isinstance(y, SharedArray):
+        y = y.attach()
+    timing = new_task_timing()
+    map_processor = get_map_processor(*map_args)
+    permutations = iter_permutations(iterator, start, stop, batch)
+    max_stats = list(iter_max_stat(test_func, y, shape, map_processor,
+                                   permutations, batch, timing))
+    timing['done'] = current_time()
+    return start, max_stats, timing
 
-def run_permutation_me(test, dists, iterator):
-    dist = dists[0]
-    if dist.kind == 'cluster':
-        thresholds = tuple(d.threshold for d in dists)
-    else:
-        thresholds = None
 
-    if CONFIG['n_workers']:
-        workers, out_queue, kill_beacon = setup_workers_me(test, dists, thresholds)
+def permutation_task_me(args):
+    """Compute the maximum statistics of all effects for a range of permutations
+
+    Runs in a worker process; returns ``(start, max_stats, timing)``.
+    """
+    (test, y, shape, map_args, thresholds, active, iterator, batch, start,
+     stop) = args
+    if isinstance(y, SharedArray):
+        y = y.attach()
+    timing = new_task_timing()
+    map_processor = get_map_processor_me(thresholds, *map_args)
+    permutations = islice(iterator(start=start), stop - start)
+    max_stats = list(iter_max_stats_me(test, y, shape, map_processor, active,
+                                       permutations, batch, timing))
+    timing['done'] = current_time()
+    return start, max_stats, timing
+
+
+def run_tasks(task, args, start, stop, batch=None):
+    """Distribute permutations ``start`` to ``stop`` to the worker pool
+
+    Permutations are split into ``CHUNKS_PER_WORKER`` contiguous ranges per
+    worker, and ``task`` is called with ``args + (start, stop)`` for each
+    range. Yields ``(start, max_stats, timing)`` for each range as it is
+    completed, while displaying progress.
+    """
+    n_chunks = CONFIG['n_workers'] * CHUNKS_PER_WORKER
+    ranges = permutation_ranges(start, stop, n_chunks, batch)
+    pool = get_pool()
+    try:
+        with tqdm(total=stop - start, desc="Permutation test",
+                  unit=' permutations', disable=CONFIG['tqdm']) as pbar:
+            for item in pool.imap_unordered(task, [args + r for r in ranges]):
+                pbar.update(len(item[1]))
+                yield item
+    except BaseException:
+        # stop workers that are still busy with this test
+        shutdown_pool(True)
+        raise
+
+
+def permutation_batch_size(dist, n_maps=1):
+    """Number of permutations per batch for batched permutation kernels
+
+    Parameters
+    ----------
+    dist : _ClusterDist
+        Distribution (provides the shape of the statistical map).
+    n_maps : int
+        Number of maps of that shape that the kernel buffers per permutation.
+    """
+    n_bytes = reduce(operator.mul, dist.shape) * dist.dtype.itemsize
+    return max(1, min(MAX_BATCH, BATCH_BUFFER_SIZE // (n_bytes * n_maps)))
 
-        try:
-            for perm in iterator:
-                out_queue.put(perm)
 
-            for _ in range(len(workers) - 1):
-                out_queue.put(None)
+def run_permutation(test_func, dist, iterator, use_mp=True, batch=None):
+    """Compute the permutation distribution
 
-            logger = logging.getLogger(__name__)
-            for w in workers:
-                w.join()
-                logger.debug("worker joined")
-        except KeyboardInterrupt:
-            kill_beacon.set()
-            raise
+    Parameters
+    ----------
+    test_func : callable
+        ``test_func(y, out, perm)``, computing the statistical map for
+        permutation ``perm`` of ``y`` and storing it in ``out``. Needs to be
+        picklable to be sent to worker processes.
+    dist : _ClusterDist
+        Distribution in which to store the results.
+    iterator : callable
+        Function returning an iterator over permutations. The function is
+        called in each worker process, and needs to yield the same sequence
+        of permutations every time. It is called with ``start``, the index of
+        the first permutation to yield.
+    use_mp : bool
+        Use multiprocessing (if enabled in the configuration).
+    batch : int
+        ``iterator`` yields blocks of up to ``batch`` permutations, and
+        ``test_func`` computes one map per permutation in ``perm`` (``out``
+        has shape ``(len(perm), n_tests)``).
+
+    Notes
+    -----
+    The first ``dist.n_reused`` permutations are assumed to be present in
+    ``dist.dist`` already (see :meth:`_ClusterDist.reuse_permutations`).
+
+    Time and memory used are stored in ``dist.timing`` (see
+    :attr:`NDTest.timing`).
+    """
+    t_start = perf_counter()
+    timing = new_timing()
+    use_mp = use_mp and CONFIG['n_workers']
+    y = dist.data_for_permutation(bool(use_mp))
+    timing['memory']['data'] = data_bytes(y)
+    if use_mp:
+        args = (test_func, y, dist.shape, dist.map_args, iterator, batch)
     else:
-        y = dist.data_for_permutation(False)
         map_processor = get_map_processor(*dist.map_args)
-
-        stat_maps = test.preallocate((0,) + dist.shape)
-        if thresholds:
-            stat_maps_iter = tuple(zip(stat_maps, thresholds, dists))
-        else:
-            stat_maps_iter = tuple(zip(stat_maps, dists))
-
-        for i, perm in enumerate(iterator):
-            test.map(y, perm)
-            if thresholds:
-                for m, t, d in stat_maps_iter:
-                    if d.do_permutation:
-                        d.dist[i] = map_processor.max_stat(m, t)
+    timing['data'] = perf_counter() - t_start
+
+    try:
+        for start, stop in permutation_rounds((dist,)):
+            if use_mp:
+                for start_, max_stats, task_timing in run_tasks(
+                        permutation_task, args, start, stop, batch):
+                    add_task_timing(timing, task_timing, current_time())
+                    dist.dist[start_:start_ + len(max_stats)] = max_stats
             else:
-                for m, d in stat_maps_iter:
-                    if d.do_permutation:
-                        d.dist[i] = map_processor.max_stat(m)
+                task_timing = new_task_timing()
+                permutations = iter_permutations(iterator, start, stop, batch)
+                max_stats = iter_max_stat(test_func, y, dist.shape,
+                                          map_processor, permutations, batch,
+                                          task_timing)
+                for i, v in zip(range(start, stop), max_stats):
+                    dist.dist[i] = v
+                add_task_timing(timing, task_timing)
+    finally:
+        if isinstance(y, SharedArray):
+            y.close()
+    t = perf_counter()
+    dist.finalize()
+    timing['finalize'] = perf_counter() - t
+    timing['total'] = perf_counter() - t_start
+    dist.timing = timing
+    log_timing(timing, dist.name)
 
-    for d in dists:
-        if d.do_permutation:
-            d.finalize()
 
+def iter_max_stats_me(test, y, shape, map_processor, active, permutations,
+                      batch, timing):
+    """Generate the maximum statistic of each effect for each permutation
 
-def setup_workers_me(test_func, dists, thresholds):
-    "Initialize workers for permutation tests"
-    logger = logging.getLogger(__name__)
-    logger.debug("Setting up %i worker processes..." % CONFIG['n_workers'])
-    permutation_queue = SimpleQueue()
-    dist_queue = SimpleQueue()
-    kill_beacon = Event()
+    With a :class:`MultiClusterProcessor`, the maps of all effects are
+    processed jointly; otherwise, the map of each active effect separately.
+    Time spent and buffer memory are recorded in ``timing`` (see
+    :func:`new_task_timing`).
+    """
+    def map_batch(y, out, perms):
+        return test.map_batch(y, perms, out)
+
+    if isinstance(y, ColumnBlocks):
+        map_batch = partial(apply_blocks, map_batch)
+    test.preallocate(shape)
+    stat_maps = np.empty((batch, test.n_effects) + shape[1:], y.dtype)
+    stat_maps_flat = stat_maps.reshape((batch, test.n_effects, -1))
+    perms = np.empty((batch, len(y)), np.intp)
+    joint = isinstance(map_processor, MultiClusterProcessor)
+    timing['buffers'] = (stat_maps.nbytes + perms.nbytes +
+                         map_processor.buffer_bytes)
+
+    while True:
+        # copy, because permutations can be yielded in the same buffer
+        n_perm = 0
+        for perm in islice(permutations, batch):
+            perms[n_perm] = perm
+            n_perm += 1
+        if n_perm == 0:
+            return
+        t = perf_counter()
+        map_batch(y, stat_maps_flat[:n_perm], perms[:n_perm])
+        timing['kernel'] += perf_counter() - t
+        timing['permutations'] += n_perm
+        for maps in stat_maps[:n_perm]:
+            t = perf_counter()
+            if joint:
+                max_v = map_processor.max_stats(maps)
+                max_v = [v if a else None for v, a in zip(max_v, active)]
+            else:
+                max_v = [map_processor.max_stat(m) if a else None for m, a in
+                         zip(maps, active)]
+            timing['map'] += perf_counter() - t
+            yield max_v
 
-    # permutation workers
+
+def run_permutation_me(test, dists, iterator):
+    """Compute the permutation distributions for all effects of a multi-effect test
+
+    Time and memory used are stored in ``timing`` of all distributions (see
+    :attr:`NDTest.timing`).
+    """
+    t_start = perf_counter()
+    timing = new_timing()
     dist = dists[0]
-    y, shape = dist.data_for_permutation()
-    args = (permutation_queue, dist_queue, y, shape, test_func, dist.map_args,
-            thresholds, kill_beacon)
-    workers = []
-    for _ in range(CONFIG['n_workers']):
-        w = Process(target=permutation_worker_me, args=args)
-        w.start()
-        workers.append(w)
-
-    # distribution worker
-    args = ([d.dist_array for d in dists], dist.dist_shape, dist_queue, kill_beacon)
-    w = Process(target=distribution_worker_me, args=args)
-    w.start()
-    workers.append(w)
-
-    return workers, permutation_queue, kill_beacon
-
-
-def permutation_worker_me(in_queue, out_queue, y, shape, test, map_args,
-                          thresholds, kill_beacon):
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-    if CONFIG['nice']:
-        os.nice(CONFIG['nice'])
-
-    n = reduce(operator.mul, shape)
-    y = np.frombuffer(y, np.float64, n).reshape((shape[0], -1))
-    iterator = test.preallocate(shape)
-    if thresholds:
-        iterator = tuple(zip(iterator, thresholds))
+    if dist.kind == 'cluster':
+        thresholds = tuple(d.threshold for d in dists)
     else:
-        iterator = tuple(iterator)
-    map_processor = get_map_processor(*map_args)
-    while not kill_beacon.is_set():
-        perm = in_queue.get()
-        if perm is None:
-            break
-        test.map(y, perm)
+        thresholds = None
 
-        if thresholds:
-            max_v = [map_processor.max_stat(m, t) for m, t in iterator]
-        else:
-            max_v = [map_processor.max_stat(m) for m in iterator]
-        out_queue.put(max_v)
-
-
-def distribution_worker_me(dist_arrays, dist_shape, in_queue, kill_beacon):
-    "Worker that accumulates values and places them into the distribution"
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-    n = reduce(operator.mul, dist_shape)
-    dists = [d if d is None else np.frombuffer(d, np.float64, n).reshape(dist_shape)
-             for d in dist_arrays]
-    samples = dist_shape[0]
-    for i in trange(samples, desc="Permutation test", unit=' permutations',
-                    disable=CONFIG['tqdm']):
-        for dist, v in zip(dists, in_queue.get()):
-            if dist is not None:
-                dist[i] = v
-        if kill_beacon.is_set():
-            return
+    batch = permutation_batch_size(dist, test.n_effects + test.p.x.shape[1])
+    active = [d.do_permutation for d in dists]
+    use_mp = CONFIG['n_workers']
+    y = dist.data_for_permutation(bool(use_mp))
+    timing['memory']['data'] = data_bytes(y)
+    shape = (0,) + dist.shape
+    if use_mp:
+        args = (test, y, shape, dist.map_args, thresholds, active, iterator,
+                batch)
+    else:
+        map_processor = get_map_processor_me(thresholds, *dist.map_args)
+    timing['data'] = perf_counter() - t_start
+
+    try:
+        for start, stop in permutation_rounds(dists):
+            if use_mp:
+                results = run_tasks(permutation_task_me, args, start, stop)
+            else:
+                task_timing = new_task_timing()
+                permutations = islice(iterator(start=start), stop - start)
+                max_stats = iter_max_stats_me(test, y, shape, map_processor,
+                                              active, permutations, batch,
+                                              task_timing)
+                results = [(start, max_stats, task_timing)]
+            for start_, max_stats, task_timing in results:
+                t_received = current_time() if use_mp else None
+                for i, vs in enumerate(max_stats, start_):
+                    for d, v in zip(dists, vs):
+                        if d.do_permutation:
+                            d.dist[i] = v
+                add_task_timing(timing, task_timing, t_received)
+    finally:
+        if isinstance(y, SharedArray):
+            y.close()
+
+    t = perf_counter()
+    for d in dists:
+        if d.do_permutation:
+            d.finalize()
+    timing['finalize'] = perf_counter() - t
+    timing['total'] = perf_counter() - t_start
+    for d in dists:
+        d.timing = timing
+    log_timing(timing, ', '.join(d.name for d in dists if d.do_permutation))
@@ -226,6 +226,22 @@ def test_anova_perm():
         assert_allclose(r2, r1, 1e-6, 1e-6)
 
 
+def test_anova_perm_batch():
+    "Test ANOVA for batches of permutations"
+    ds = datasets.get_uts(nrm=True)
+    ds_unbalanced = ds.sub("nrm != 'A14'")
+    # balanced fixed, balanced mixed, incremental fixed and incremental mixed
+    for ds_, x in ((ds, 'A*B'), (ds, 'A*B*rm'), (ds[1:], 'A*B'),
+                   (ds_unbalanced, 'A*B*nrm(A)')):
+        y = ds_['uts'].x
+        perms = np.array(list(permute_order(len(y), 5)))
+        aov = glm._nd_anova(ds_.eval(x))
+        out = np.empty((len(perms), aov.n_effects, y.shape[1]))
+        aov.map_batch(y, perms, out)
+        for perm, f_maps in zip(perms, out):
+            assert_allclose(f_maps, aov.map(y, perm), 1e-10)
+
+
 def test_anova_r_adler():
     """Test ANOVA accuracy by comparing with R (Adler dataset of car package)
 
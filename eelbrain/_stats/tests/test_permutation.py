@@ -1,8 +1,7 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
-import sys
-
 from nose.tools import eq_, ok_, assert_not_equal
 import numpy as np
+from numpy.testing import assert_array_equal
 
 from eelbrain import Factor, Var
 from eelbrain._stats.permutation import (
@@ -33,7 +32,21 @@ def test_permutation():
 
     # make sure sequence is stable
     eq_(list(map(tuple, permute_order(4, 3))),
-        [(2, 3, 1, 0), (2, 1, 3, 0), (0, 2, 3, 1)])
+        [(0, 2, 3, 1), (1, 2, 0, 3), (3, 2, 0, 1)])
+
+    # random access
+    perms = [tuple(p) for p in permute_order(6, 10, unit=s)]
+    eq_([tuple(p) for p in permute_order(6, 10, unit=s, start=4)], perms[4:])
+    # independent of the global random state
+    np.random.seed(1)
+    eq_([tuple(p) for p in permute_order(6, 10, unit=s)], perms)
+
+    # batches
+    batches = [batch.copy() for batch in permute_order(6, 10, unit=s, batch=4)]
+    eq_([len(batch) for batch in batches], [4, 4, 2])
+    assert_array_equal(np.vstack(batches), perms)
+    batches = [batch.copy() for batch in permute_order(6, 10, batch=4, start=4)]
+    assert_array_equal(np.vstack(batches), list(permute_order(6, 10))[4:])
 
 
 def test_permutation_sign_flip():
@@ -46,6 +59,18 @@ def test_permutation_sign_flip():
     for i, row in enumerate(res):
         eq_(np.any(np.all(row == res[:i], 1)), False)
 
+    # random samples without replacement
+    res = np.array([tuple(sign) for sign in permute_sign_flip(14, 10000)])
+    eq_(len(np.unique(res, axis=0)), 10000)
+    ok_(np.all(res.min(1) < 0), "Not all permutations have a sign flip")
+    assert_array_equal([tuple(sign) for sign in
+                        permute_sign_flip(14, 20000, start=9990)][:10],
+                       res[9990:])
+    # with replacement
+    res = np.array([tuple(sign) for sign in permute_sign_flip(21, 10)])
+    assert_array_equal([tuple(sign) for sign in
+                        permute_sign_flip(21, 10, start=5)], res[5:])
+
     # n > 62
     res = list(map(tuple, permute_sign_flip(66, 2)))
     eq_(len(res[0]), 66)
@@ -53,8 +78,14 @@ def test_permutation_sign_flip():
     assert_not_equal(res[0], res[1])
 
     # make sure sequence is stable
-    if sys.version_info[0] == 3:
-        target = [(1, -1, -1, -1), (-1, -1, -1, 1), (-1, 1, -1, -1)]
-    else:
-        target = [(-1, 1, -1, -1), (-1, -1, 1, -1), (1, -1, -1, 1)]
+    target = [(1, -1, 1, 1), (-1, -1, -1, 1), (-1, 1, 1, -1)]
     eq_(list(map(tuple, permute_sign_flip(4, 3))), target)
+    eq_(list(map(tuple, permute_sign_flip(4, 3, start=1))), target[1:])
+
+    # batches
+    signs = np.array(list(map(tuple, permute_sign_flip(6, 10))))
+    batches = [batch.copy() for batch in permute_sign_flip(6, 10, batch=4)]
+    eq_([len(batch) for batch in batches], [4, 4, 2])
+    assert_array_equal(np.vstack(batches), signs)
+    batches = [batch.copy() for batch in permute_sign_flip(6, 10, batch=4, start=4)]
+    assert_array_equal(np.vstack(batches), signs[4:])
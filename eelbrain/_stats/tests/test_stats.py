@@ -8,7 +8,7 @@ import scipy.stats
 
 from eelbrain import datasets
 from eelbrain._stats import stats
-from eelbrain._stats.permutation import permute_order
+from eelbrain._stats.permutation import permute_order, permute_sign_flip
 
 
 def test_corr():
@@ -40,6 +40,22 @@ def test_corr():
             r_sp, _ = scipy.stats.pearsonr(y_perm[:, i], x)
             assert_almost_equal(corr[i], r_sp)
 
+    # batches of permutations
+    y = ds.eval("uts.x")
+    y[:, 10] = 1  # zero variance
+    corr_perm = stats.CorrPerm(x)
+    r_batch = np.empty((4, y.shape[1]))
+    for perms in permute_order(n_cases, 10, batch=4):
+        corr_perm(y, r_batch[:len(perms)], perms)
+        for perm, r_perm in zip(perms, r_batch):
+            with warnings.catch_warnings():  # divide by 0
+                warnings.simplefilter("ignore")
+                assert_allclose(r_perm, stats.corr(y, x, perm=perm), 1e-10)
+    # single precision
+    y32 = y.astype(np.float32)
+    r_batch32 = np.empty((len(perms), y.shape[1]), np.float32)
+    assert_allclose(corr_perm(y32, r_batch32, perms), r_batch[:len(perms)], 1e-5)
+
 
 def test_lm():
     "Test linear model function against scipy lstsq"
@@ -116,6 +132,21 @@ def test_t_1samp():
     assert_allclose(stats.t_1samp(y), t, 10)
 
 
+def test_t_1samp_perm_batch():
+    "Test batched sign-flip 1-sample t-test"
+    ds = datasets.get_uts(True)
+    y = ds['utsnd'].x
+    n_cases = len(y)
+    y = y.reshape((n_cases, -1))
+    t = np.empty(y.shape[1])
+    t_batch = np.empty((4, y.shape[1]))
+    for signs in permute_sign_flip(n_cases, 10, batch=4):
+        stats.t_1samp_perm_batch(y, t_batch[:len(signs)], signs)
+        for sign, t_perm in zip(signs, t_batch):
+            stats.t_1samp(y * sign[:, None], t)
+            assert_allclose(t_perm, t)
+
+
 def test_t_ind():
     "Test independent samples t-test"
     ds = datasets.get_uts(True)
@@ -1,12 +1,13 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
 from eelbrain import datasets, Celltable, testnd
 from eelbrain._stats import t_contrast
+from eelbrain._stats.permutation import permute_order
 from eelbrain._stats.stats import t_1samp
 from eelbrain._stats.t_contrast import TContrastRel
 
 from nose.tools import eq_, assert_raises
 import numpy as np
-from numpy.testing import assert_equal, assert_array_equal
+from numpy.testing import assert_equal, assert_array_equal, assert_allclose
 
 
 def test_t_contrast_parsing():
@@ -109,9 +110,44 @@ def test_t_contrast_testnd():
 
     # binary function
     res = testnd.t_contrast_rel('uts', 'A', "a1>a0 - a0>a1", 'rm', ds=ds, tmin=4, samples=10)
-    assert_equal(res.find_clusters()['p'], np.array([1, 1, 0.9, 0, 0.2, 1, 1, 0]))
+    assert_equal(res.find_clusters()['p'], np.array([1, 1, 0.9, 0, 0, 1, 1, 0]))
     res_t = testnd.ttest_rel('uts', 'A', 'a1', 'a0', match='rm', ds=ds, tmin=2, samples=10)
     assert_array_equal(res.t.x, res_t.t.x * 2)
     assert_array_equal(res.clusters['tstart'], res_t.clusters['tstart'])
     assert_array_equal(res.clusters['tstop'], res_t.clusters['tstop'])
     assert_array_equal(res.clusters['v'], res_t.clusters['v'] * 2)
+
+
+def test_t_contrast_perm():
+    "Test t-contrasts for batches of permutations"
+    ds = datasets.get_uts()
+    ct = Celltable('uts', 'A % B', 'rm', ds=ds)
+    y = ct.y.x
+    contrast = ("subtract(min(a1|b0 > a0|b0, abs(a1|* > a0|*), a1|b1 > a0|b1), "
+                "a1|b1 > *|b0)")
+    c = TContrastRel(contrast, ct.cells, ct.data_indexes)
+    eq_(len(c._comparisons), 4)
+
+    def target(y):
+        data = {cell: y[ct.data_indexes[cell]] for cell in ct.cells}
+        data[('a1', '*')] = (data['a1', 'b0'] + data['a1', 'b1']) / 2
+        data[('a0', '*')] = (data['a0', 'b0'] + data['a0', 'b1']) / 2
+        data[('*', 'b0')] = (data['a1', 'b0'] + data['a0', 'b0']) / 2
+        return (np.min((t_1samp(data['a1', 'b0'] - data['a0', 'b0']),
+                        np.abs(t_1samp(data['a1', '*'] - data['a0', '*'])),
+                        t_1samp(data['a1', 'b1'] - data['a0', 'b1'])), 0) -
+                t_1samp(data['a1', 'b1'] - data['*', 'b0']))
+
+    assert_allclose(c.map(y), target(y), 1e-10)
+    perms = np.array([p.copy() for p in permute_order(len(y), 5, unit=ct.match)])
+    out = np.empty((len(perms), y.shape[1]))
+    c(y, out, perms)
+    y_perm = np.empty_like(y)
+    for perm, tmap in zip(perms, out):
+        y_perm[perm] = y
+        assert_allclose(tmap, target(y_perm), 1e-10)
+        # single permutation
+        assert_allclose(c(y, np.empty(y.shape[1]), perm), tmap)
+    # single precision
+    out32 = np.empty(out.shape, np.float32)
+    assert_allclose(c(y.astype(np.float32), out32, perms), out, 1e-4)
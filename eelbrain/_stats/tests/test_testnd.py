@@ -1,8 +1,8 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
 from itertools import product
+import os
 import pickle
 import logging
-import sys
 
 from nose.tools import (
     eq_, ok_, assert_equal, assert_not_equal, assert_almost_equal,
@@ -10,16 +10,22 @@ from nose.tools import (
     assert_raises)
 import numpy as np
 from numpy.testing import assert_array_equal, assert_allclose
+from scipy import ndimage
+import scipy.stats
 
 import eelbrain
 from eelbrain import (Dataset, NDVar, Categorial, Scalar, UTS, Sensor, configure,
                       datasets, test, testnd, set_log_level, cwt_morlet)
 from eelbrain._exceptions import ZeroVariance
-from eelbrain._stats.testnd import (Connectivity, _ClusterDist, label_clusters,
-                                    _MergedTemporalClusterDist, find_peaks)
+from eelbrain._stats import stats, testnd as _testnd
+from eelbrain._stats.permutation import permute_order
+from eelbrain._stats.testnd import (
+    ClusterProcessor, Connectivity, MultiClusterProcessor, _ClusterDist,
+    label_clusters, label_clusters_binary, tfce, _MergedTemporalClusterDist,
+    find_peaks)
 from eelbrain._utils.system import IS_WINDOWS
 from eelbrain._utils.testing import (assert_dataobj_equal, assert_dataset_equal,
-                                     requires_mne_sample_data)
+                                     requires_mne_sample_data, TempDir)
 
 
 def test_anova():
@@ -142,7 +148,7 @@ def test_anova():
     # nested random effect
     res = testnd.anova('uts', 'A * B * nrm(A)', ds=ds, samples=10, tstart=.4)
     assert res.match == 'nrm(A)'
-    assert [p.min() for p in res.p] == [0.0, 0.6, 0.9]
+    assert [p.min() for p in res.p] == [0.0, 0.7, 0.8]
 
 
 
@@ -152,6 +158,31 @@ def test_anova_incremental():
     testnd.anova('uts', 'A*B', ds=ds[3:], pmin=0.05, samples=10)
 
 
+def test_adaptive():
+    "Test permutation tests with samples='adaptive'"
+    ds = datasets.get_uts()
+    res = testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds, pmin=0.05,
+                           samples='adaptive')
+    assert res.samples < 10000
+    eq_(res._cdist.dist.shape, (res.samples,))
+    assert_in("In %i random permutations (adaptive" % res.samples,
+              str(res.info_list()))
+    # same as fixed number of samples
+    res_ = testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds, pmin=0.05,
+                            samples=res.samples)
+    assert_array_equal(res._cdist.dist, res_._cdist.dist)
+    # persistence
+    res_ = pickle.loads(pickle.dumps(res, pickle.HIGHEST_PROTOCOL))
+    assert_dataobj_equal(res_.p, res.p)
+    eq_(res_._cdist.adaptive, True)
+
+    # multiple effects
+    res = testnd.anova('uts', 'A*B*rm', ds=ds, pmin=0.05, samples='adaptive')
+    assert res.samples < 10000
+    for cdist in res._cdist:
+        eq_(cdist.dist.shape, (res.samples,))
+
+
 @requires_mne_sample_data
 def test_anova_parc():
     "Test ANOVA with parc argument and source space data"
@@ -175,8 +206,8 @@ def test_anova_parc():
     del c2['id']
     assert_dataset_equal(c1p, c1)
     assert_dataset_equal(c2p, c2)
-    assert_array_equal(c2['p'], [0.85, 0.88, 0.97, 0.75, 0.99, 0.99, 0.98, 0.0,
-                                 0.12, 0.88, 0.25, 0.97, 0.34, 0.96])
+    assert c2.n_cases == 14
+    assert c2['p'][7] == 0
 
     # without multiprocessing
     configure(n_workers=0)
@@ -200,6 +231,43 @@ def test_anova_parc():
                   tfce=True, parc='source', **kwa)
 
 
+def test_anova_parc_categorial():
+    "Test ANOVA with parc argument on a categorial dimension"
+    ds = datasets.get_uts(True)
+    utsnd = ds['utsnd']
+    categorial = Categorial('categorial', ('a', 'b'))
+    ds['y'] = NDVar(utsnd.x[:, :2], ('case', categorial, utsnd.time))
+    ds['y0'] = utsnd.sub(sensor='0')
+    ds['y1'] = utsnd.sub(sensor='1')
+    kwa = dict(ds=ds, pmin=0.05, samples=100)
+
+    resp = testnd.anova('y', 'A*B', parc='categorial', **kwa)
+    c0p = resp.find_clusters(categorial='a')
+    c1p = resp.find_clusters(categorial='b')
+    assert_array_equal(c1p['p'], [0.64, 0.03, 0.0, 0.0, 0.02, 0.84, 0.33, 0.61,
+                                  0.29, 0.03, 0.01, 0.46, 0.78, 0.02, 0.01,
+                                  0.02, 0.02, 0.5])
+    assert_array_equal(c1p['p_parc'], [0.79, 0.06, 0.0, 0.0, 0.04, 0.98, 0.45,
+                                       0.79, 0.41, 0.04, 0.01, 0.65, 0.92,
+                                       0.06, 0.03, 0.06, 0.04, 0.63])
+    del c0p['p_parc', 'id']
+    del c1p['p_parc', 'id']
+    c0 = testnd.anova('y0', 'A*B', **kwa).find_clusters()
+    c1 = testnd.anova('y1', 'A*B', **kwa).find_clusters()
+    del c0['id']
+    del c1['id']
+    assert_dataset_equal(c0p, c0)
+    assert_dataset_equal(c1p, c1)
+
+    # without multiprocessing
+    configure(n_workers=0)
+    ress = testnd.anova('y', 'A*B', parc='categorial', **kwa)
+    configure(n_workers=True)
+    c1s = ress.find_clusters(categorial='b')
+    del c1s['p_parc', 'id']
+    assert_dataset_equal(c1s, c1)
+
+
 def test_clusterdist():
     "Test _ClusterDist class"
     shape = (10, 6, 6, 4)
@@ -255,6 +323,20 @@ def test_clusterdist():
     cdist.add_original(pmap)
     assert_equal(cdist.n_clusters, 2)
 
+    # cluster properties
+    cdist = _ClusterDist(y, 0, 1.5)
+    cdist.add_original(pmap)
+    clusters = cdist.clusters()
+    eq_(clusters.n_cases, 2)
+    assert_allclose(clusters['tstart'], -0.1)
+    assert_allclose(clusters['tstop'], 0.2)
+    assert_array_equal(clusters['dim2_min'], 0)
+    assert_array_equal(clusters['dim2_max'], 2)
+    assert_array_equal(clusters['n_sensors'], 1)
+    for cid, cluster in zip(clusters['id'], clusters['cluster']):
+        target = cdist.parameter_map * (cdist.cluster_map == cid)
+        assert_array_equal(cluster.x, target.x)
+
     # criteria
     ds = datasets.get_uts(True)
     res = testnd.ttest_rel('utsnd', 'A', match='rm', ds=ds, samples=0, pmin=0.05)
@@ -314,10 +396,7 @@ def test_clusterdist():
     assert_array_equal(peaks, tgt)
     # testnd permutation result
     res = testnd.ttest_1samp(y, tfce=True, samples=3)
-    if sys.version_info[0] == 3:
-        target = [96.84232967, 205.83207424, 425.65942084]
-    else:
-        target = [77.5852307, 119.1976153, 217.6270428]
+    target = [85.55732051, 149.1, 149.29941888]
     assert_allclose(np.sort(res._cdist.dist), target)
 
     # parc with TFCE on unconnected dimension
@@ -376,6 +455,20 @@ def test_corr():
     repr(res)
     res = testnd.corr('utsnd', 'Y', ds=ds, samples=10, tfce=True)
     repr(res)
+    # permutations with normalization, against stats.corr
+    res = testnd.corr('utsnd', 'Y', 'rm', ds=ds, samples=10)
+    y = ds['utsnd'].x.copy()
+    for cell in ds['rm'].cells:
+        index = ds['rm'] == cell
+        y[index] = scipy.stats.zscore(y[index], None)
+    y -= y.mean(0)
+    max_r = [np.abs(stats.corr(y, ds['Y'].x, perm=perm)).max() for perm in
+             permute_order(ds.n_cases, 10)]
+    assert_allclose(res._cdist.dist, max_r)
+    configure(n_workers=0)
+    res_ = testnd.corr('utsnd', 'Y', 'rm', ds=ds, samples=10)
+    configure(n_workers=True)
+    assert_array_equal(res_._cdist.dist, res._cdist.dist)
 
     # persistence
     string = pickle.dumps(res, protocol=pickle.HIGHEST_PROTOCOL)
@@ -385,6 +478,64 @@ def test_corr():
     assert_dataobj_equal(res.p, res_.p)
 
 
+def test_dtype():
+    "Test single precision permutations against double precision"
+    ds = datasets.get_uts(True)
+    tests = ((testnd.ttest_1samp, ('utsnd',)),
+             (testnd.ttest_rel, ('utsnd', 'A', 'a1', 'a0', 'rm')),
+             (testnd.ttest_ind, ('utsnd', 'A', 'a1', 'a0')),
+             (testnd.t_contrast_rel, ('utsnd', 'A', 'a1>a0', 'rm')),
+             (testnd.corr, ('utsnd', 'Y')),
+             (testnd.anova, ('utsnd', 'A*B')),
+             (testnd.anova, ('utsnd', 'A*B*rm')))
+    for (func, args), kwargs in product(tests, ({}, {'pmin': 0.05},
+                                                {'tfce': True})):
+        res = func(*args, ds=ds, samples=20, **kwargs)
+        res32 = func(*args, ds=ds, samples=20, dtype='float32', **kwargs)
+        assert_in("dtype='float32'", repr(res32))
+        for (_, cdist), (_, cdist32) in zip(res._iter_cdists(),
+                                            res32._iter_cdists()):
+            assert_array_equal(cdist32.parameter_map, cdist.parameter_map)
+            assert_allclose(cdist32.dist, cdist.dist, 1e-4)
+
+    # resuming from a different precision recomputes permutations
+    res = testnd.ttest_rel('utsnd', 'A', 'a1', 'a0', 'rm', ds=ds, samples=10)
+    res32 = testnd.ttest_rel('utsnd', 'A', 'a1', 'a0', 'rm', ds=ds, samples=20,
+                             dtype='float32', resume=res)
+    eq_(res32._cdist.n_reused, 0)
+    assert_raises(ValueError, testnd.ttest_1samp, 'utsnd', ds=ds, samples=10,
+                  dtype='int32')
+
+
+def test_resume():
+    "Test reusing permutations of a previous test result"
+    ds = datasets.get_uts()
+
+    res = testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds, samples=20,
+                           pmin=0.05)
+    res_10 = testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds, samples=10,
+                              pmin=0.05)
+    res_10 = pickle.loads(pickle.dumps(res_10, pickle.HIGHEST_PROTOCOL))
+    res_20 = testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds, samples=20,
+                              pmin=0.05, resume=res_10)
+    eq_(res_20._cdist.n_reused, 10)
+    assert_array_equal(res_20._cdist.dist, res._cdist.dist)
+    assert_dataobj_equal(res_20.p, res.p)
+    # incompatible parameters
+    res_20 = testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds, samples=20,
+                              pmin=0.1, resume=res_10)
+    eq_(res_20._cdist.n_reused, 0)
+
+    # multiple effects
+    res = testnd.anova('uts', 'A*B*rm', ds=ds, samples=20, pmin=0.05)
+    res_10 = testnd.anova('uts', 'A*B*rm', ds=ds, samples=10, pmin=0.05)
+    res_20 = testnd.anova('uts', 'A*B*rm', ds=ds, samples=20, pmin=0.05,
+                          resume=res_10)
+    for cdist, cdist_20 in zip(res._cdist, res_20._cdist):
+        eq_(cdist_20.n_reused, 10)
+        assert_array_equal(cdist_20.dist, cdist.dist)
+
+
 def test_t_contrast():
     ds = datasets.get_uts()
 
@@ -421,16 +572,52 @@ def test_t_contrast():
                   'min(a1|b0>a0|b0, a1|b1>a0|b1)', 'rm', tail=1, ds=ds)
 
 
+def test_memmap():
+    "Test permutations with memory-mapped data"
+    ds = datasets.get_uts(True)
+    y = ds['utsnd']
+    tempdir = TempDir()
+    path = os.path.join(tempdir, 'utsnd.npy')
+    np.save(path, y.x)
+    y_mmap = NDVar(np.load(path, mmap_mode='r'), y.dims, y.info, y.name)
+    block_buffer_size = _testnd.BLOCK_BUFFER_SIZE
+    # 2 sensors per block
+    _testnd.BLOCK_BUFFER_SIZE = 2 * len(y) * len(y.time) * 8
+    try:
+        for kwargs, n_workers in product(({}, {'pmin': 0.05}, {'tfce': True}),
+                                         (0, True)):
+            configure(n_workers=n_workers)
+            res = testnd.ttest_1samp(y, samples=20, **kwargs)
+            res_mmap = testnd.ttest_1samp(y_mmap, samples=20, **kwargs)
+            ok_(isinstance(res_mmap._cdist.y_perm.x, np.memmap))
+            assert_allclose(res_mmap._cdist.dist, res._cdist.dist)
+            res = testnd.anova(y, 'A*B', ds=ds, samples=20, **kwargs)
+            res_mmap = testnd.anova(y_mmap, 'A*B', ds=ds, samples=20, **kwargs)
+            for (_, cdist), (_, cdist_mmap) in zip(res._iter_cdists(),
+                                                   res_mmap._iter_cdists()):
+                assert_allclose(cdist_mmap.dist, cdist.dist)
+    finally:
+        _testnd.BLOCK_BUFFER_SIZE = block_buffer_size
+        configure(n_workers=True)
+
+
 def test_labeling():
     "Test cluster labeling"
     shape = flat_shape = (4, 20)
     pmap = np.empty(shape, np.float_)
     edges = np.array([(0, 1), (0, 3), (1, 2), (2, 3)], np.uint32)
-    conn = Connectivity((
-        Scalar('graph', range(4), connectivity=edges),
-        UTS(0, 0.01, 20)))
+    conn_dims = (Scalar('graph', range(4), connectivity=edges),
+                 UTS(0, 0.01, 20))
+    conn = Connectivity(conn_dims)
     criteria = None
 
+    # graph is shared between Connectivity objects
+    conn2 = Connectivity(conn_dims)
+    ok_(conn2.custom[0][0] is conn.custom[0][0])
+    indptr, indices = conn.custom_csr[0]
+    assert_array_equal(indptr, [0, 2, 4, 6, 8])
+    assert_array_equal(indices, [1, 3, 0, 2, 1, 3, 0, 2])
+
     # some clusters
     pmap[:] = [[3, 3, 0, 0, 0, 0, 8, 0, 0, 0, 0, 0, 0, 0, 4, 4, 0, 0, 0, 0],
                [0, 1, 0, 0, 0, 0, 8, 0, 0, 4, 4, 4, 0, 0, 0, 0, 0, 0, 4, 0],
@@ -440,6 +627,14 @@ def test_labeling():
     assert_equal(len(cids), 6)
     assert_array_equal(cmap > 0, np.abs(pmap) > 2)
 
+    # minimum extent criteria
+    cmap, cids = label_clusters(pmap, 2, 0, conn, [((0,), 3)])
+    assert_equal(len(cids), 3)
+    cmap, cids = label_clusters(pmap, 2, 0, conn, [((1,), 2)])
+    assert_equal(len(cids), 3)
+    cmap, cids = label_clusters(pmap, 2, 0, conn, [((0,), 3), ((1,), 2)])
+    assert_equal(len(cids), 1)
+
     # some other clusters
     pmap[:] = [[4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 0, 0],
                [0, 4, 0, 0, 0, 0, 0, 4, 0, 4, 4, 4, 0, 0, 0, 0, 0, 0, 0, 0],
@@ -449,6 +644,67 @@ def test_labeling():
     assert_equal(len(cids), 6)
     assert_array_equal(cmap > 0, np.abs(pmap) > 2)
 
+    # joint processing of several maps
+    grid_conn = Connectivity((UTS(0, 0.01, 4), UTS(0, 0.01, 20)))
+    maps = np.random.RandomState(0).normal(0, 2, (3,) + shape)
+    thresholds = (1, 2, 1.5)
+    for c, criteria, parc in product((conn, grid_conn), (None, [((0,), 2)]),
+                                     (None, ([0, 1], [2, 3]))):
+        for tail in (0, 1):
+            args = (tail, None, parc, shape, c, None, criteria)
+            processor = ClusterProcessor(*args)
+            multi_processor = MultiClusterProcessor(*args, thresholds)
+            max_stats = multi_processor.max_stats(maps)
+            for m, t, v in zip(maps, thresholds, max_stats):
+                assert_array_equal(v, processor.max_stat(m, t))
+
+
+def test_tfce():
+    "Test TFCE against the definition"
+    edges = np.array([(0, 1), (0, 3), (1, 2), (2, 3)], np.uint32)
+    conn = Connectivity((
+        Scalar('graph', range(4), connectivity=edges),
+        UTS(0, 0.01, 20)))
+    rng = np.random.RandomState(0)
+    stat_map = ndimage.gaussian_filter1d(rng.normal(0, 2, (4, 20)), 2)
+
+    def tfce_reference(x, dh=0.1, e=0.5, h=2.0):
+        out = np.zeros(x.shape)
+        for tail_map in (x, -x):
+            for height in np.arange(dh, tail_map.max(), dh):
+                cmap, cids = label_clusters_binary(tail_map >= height, conn)
+                for cid in cids:
+                    index = cmap == cid
+                    out[index] += index.sum() ** e * height ** h
+        return out
+
+    assert_allclose(tfce(stat_map, 0, conn), tfce_reference(stat_map))
+
+
+def test_timing():
+    "Test timing of permutation tests"
+    ds = datasets.get_uts(True)
+    res = testnd.ttest_1samp('uts', ds=ds)
+    eq_(res.timing, None)
+    for n_workers in (0, True):
+        configure(n_workers=n_workers)
+        try:
+            res = testnd.ttest_1samp('uts', ds=ds, samples=20, pmin=0.05)
+            res_me = testnd.anova('utsnd', 'A*B', ds=ds, samples=10, pmin=0.05)
+        finally:
+            configure(n_workers=True)
+        timing = res.timing
+        eq_(timing['n_permutations'], 20)
+        eq_(sum(w['permutations'] for w in timing['workers'].values()), 20)
+        assert_greater(timing['memory']['data'], 0)
+        assert_greater(timing['memory']['buffers'], 0)
+        assert_greater(timing['total'], timing['finalize'])
+        ok_(all(cdist.timing is res_me.timing for cdist in res_me._cdist))
+        eq_(res_me.timing['n_permutations'], 10)
+    # pickling
+    res_ = pickle.loads(pickle.dumps(res, pickle.HIGHEST_PROTOCOL))
+    eq_(res_.timing, res.timing)
+
 
 def test_ttest_1samp():
     "Test testnd.ttest_1samp()"
@@ -491,6 +747,12 @@ def test_ttest_1samp():
     assert_in('p', res2.clusters)
     repr2 = repr(res2)
     assert_in('samples', repr2)
+    # single process
+    configure(n_workers=0)
+    res2_ = testnd.ttest_1samp('uts', sub="A == 'a0'", ds=ds, samples=10,
+                               pmin=0.05, tstart=0, tstop=0.6, mintime=0.05)
+    configure(n_workers=True)
+    assert_array_equal(res2_._cdist.dist, res2._cdist.dist)
 
     # clusters with permutations
     dss = ds.sub("logical_and(A=='a0', B=='b0')")[:8]
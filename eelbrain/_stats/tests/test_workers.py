@@ -0,0 +1,58 @@
+# Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
+import os
+import pickle
+
+from nose.tools import eq_, ok_
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from eelbrain import configure, datasets, testnd
+from eelbrain._stats import workers
+from eelbrain._stats.testnd import ColumnBlocks
+from eelbrain._stats.workers import SharedArray, get_pool, shutdown_pool
+from eelbrain._utils.testing import TempDir
+
+
+def test_pool():
+    "Test the persistent worker pool"
+    ds = datasets.get_uts()
+    configure(n_workers=2)
+    try:
+        res = testnd.ttest_1samp('uts', ds=ds, samples=20)
+        pool = get_pool()
+        eq_(pool._processes, 2)
+        res_ = testnd.ttest_1samp('uts', ds=ds, samples=20)
+        ok_(get_pool() is pool)
+        assert_array_equal(res_._cdist.dist, res._cdist.dist)
+        # reconfigure
+        configure(n_workers=3)
+        ok_(get_pool() is not pool)
+        res_ = testnd.ttest_1samp('uts', ds=ds, samples=20)
+        assert_array_equal(res_._cdist.dist, res._cdist.dist)
+    finally:
+        configure(n_workers=True)
+    shutdown_pool()
+    ok_(workers._pool is None)
+
+
+def test_shared_data():
+    "Test pickling data for worker processes"
+    x = np.random.normal(0, 1, (10, 20))
+    shared = SharedArray(x)
+    shared_ = pickle.loads(pickle.dumps(shared))
+    assert_array_equal(shared_.attach(), x)
+    shared.close()
+    ok_(not os.path.exists(shared.name))
+
+    # memory-mapped data
+    tempdir = TempDir()
+    path = os.path.join(tempdir, 'x.npy')
+    x = np.random.normal(0, 1, (10, 4, 5, 6))
+    np.save(path, x)
+    x_mmap = np.load(path, mmap_mode='r')[:, :, 1:4].swapaxes(1, 2)
+    blocks = ColumnBlocks(x_mmap, np.dtype(np.float32))
+    blocks_ = pickle.loads(pickle.dumps(blocks))
+    assert_array_equal(blocks_.x, x_mmap)
+    for (index, block), (index_, block_) in zip(blocks, blocks_):
+        eq_(index_, index)
+        assert_array_equal(block_, block)
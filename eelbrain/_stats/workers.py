@@ -0,0 +1,121 @@
+# Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
+"""Persistent pool of worker processes for permutation tests
+
+Notes
+-----
+The pool is created when it is first needed and is then reused by all
+subsequent tests. It is recreated when ``n_workers`` or ``nice`` change
+(see :func:`eelbrain.configure`), or when the ``_YIELD_ORIGINAL`` testing flag
+of :mod:`.permutation` changes, and shut down at interpreter exit.
+
+Data are shared with the workers through named segments in shared memory
+(:class:`SharedArray`). Worker processes attach to a segment by name for each
+task, so that the data are neither copied nor kept alive by idle workers.
+"""
+import atexit
+import logging
+from multiprocessing import Pool
+import os
+import signal
+import tempfile
+
+import numpy as np
+
+from .._config import CONFIG
+from . import permutation
+
+
+# directory for shared memory segments (memory-backed file system if available)
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+_pool = None
+_pool_config = None
+
+
+def _initialize_worker(nice, yield_original):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if nice:
+        os.nice(nice)
+    # workers generate their own permutations
+    permutation._YIELD_ORIGINAL = yield_original
+
+
+def get_pool():
+    "Pool with ``CONFIG['n_workers']`` worker processes"
+    global _pool, _pool_config
+    config = (CONFIG['n_workers'], CONFIG['nice'], permutation._YIELD_ORIGINAL)
+    if _pool is not None and _pool_config != config:
+        shutdown_pool()
+    if _pool is None:
+        logger = logging.getLogger(__name__)
+        logger.debug("Starting %i worker processes...", CONFIG['n_workers'])
+        _pool = Pool(CONFIG['n_workers'], _initialize_worker, config[1:])
+        _pool_config = config
+    return _pool
+
+
+def shutdown_pool(terminate=False):
+    """Shut down the worker pool
+
+    Parameters
+    ----------
+    terminate : bool
+        Stop workers immediately, without waiting for pending tasks (e.g.,
+        after an interrupt).
+    """
+    global _pool, _pool_config
+    if _pool is None:
+        return
+    if terminate:
+        _pool.terminate()
+    else:
+        _pool.close()
+    _pool.join()
+    _pool = _pool_config = None
+
+
+atexit.register(shutdown_pool, True)
+
+
+class SharedArray:
+    """Array in a named shared memory segment
+
+    Parameters
+    ----------
+    x : array
+        Data to copy into shared memory.
+
+    Notes
+    -----
+    Only the name of the segment is pickled; workers access the data with
+    :meth:`attach`. The process that created the segment removes
+    it with :meth:`close`.
+
+    The segment is a memory-mapped file in ``SHM_DIR``. This is the mechanism
+    underlying :mod:`multiprocessing.shared_memory` on Linux, which is not
+    available in Python 3.7.
+    """
+    def __init__(self, x):
+        fd, name = tempfile.mkstemp('.dat', 'eelbrain-', SHM_DIR)
+        os.close(fd)
+        self.name = name
+        self.dtype = x.dtype
+        self.shape = x.shape
+        self.size = x.size
+        if x.size:
+            array = np.memmap(name, x.dtype, 'w+', shape=x.shape)
+            array[...] = x
+            array.flush()
+
+    def attach(self):
+        "Array with the data (copy-on-write, so that the segment is unchanged)"
+        if not self.size:
+            return np.empty(self.shape, self.dtype)
+        return np.memmap(self.name, self.dtype, 'c', shape=self.shape)
+
+    def close(self):
+        "Remove the segment"
+        try:
+            os.remove(self.name)
+        except OSError:  # Windows: still mapped by a worker
+            pass
@@ -11,6 +11,7 @@ x2 = ds['x2']
 %prun -s cumulative res = boosting(y, x1, 0, 1)
 
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import inspect
 from itertools import product
 from math import floor
@@ -29,7 +30,8 @@ from .._config import CONFIG
 from .._data_obj import NDVar
 from .._utils import LazyProperty
 from .._utils.system import caffeine
-from ._boosting_opt import l1, l2, generate_options, update_error
+from ._boosting_opt import (
+    l1, l2, generate_options, update_error, l2_cross_products, l2_lag_gram)
 from .shared import RevCorrData
 
 
@@ -39,6 +41,9 @@ VERSION = 6
 # cross-validation
 N_SEGS = 10
 
+# number of signals that are boosted together (incremental l2 error)
+BATCH_SIZE = 64
+
 # process messages
 JOB_TERMINATE = -1
 
@@ -48,6 +53,10 @@ DELTA_ERROR_FUNC = {'l2': 2, 'l1': 1}
 
 DELTA_REDUCTION_STEP = (None, None, None)
 
+# maximum memory for the lag Gram matrices of one cross-validation segment
+# (incremental l2 error, see LagGram)
+L2_GRAM_MAX_BYTES = 2 ** 24
+
 
 class BoostingResult(object):
     """Result from boosting a temporal response function
@@ -82,6 +91,8 @@ class BoostingResult(object):
         Mindelta parameter used.
     scale_data : bool
         Scale_data parameter used.
+    basis : scalar
+        Width of the basis windows used for the kernel (0 for impulses).
     y_mean : NDVar | scalar
         Mean that was subtracted from ``y``.
     y_scale : NDVar | scalar
@@ -93,7 +104,7 @@ class BoostingResult(object):
     """
     def __init__(self, h, r, isnan, t_run, version, delta, mindelta, error,
                  spearmanr, fit_error, scale_data, y_mean, y_scale, x_mean,
-                 x_scale, y=None, x=None, tstart=None, tstop=None,
+                 x_scale, y=None, x=None, tstart=None, tstop=None, basis=0,
                  **experimental_parameters):
         self.h = h
         self.r = r
@@ -114,6 +125,7 @@ class BoostingResult(object):
         self.x = x
         self.tstart = tstart
         self.tstop = tstop
+        self.basis = basis
         self._experimental_parameters = experimental_parameters
 
     def __getstate__(self):
@@ -185,16 +197,18 @@ class BoostingResult(object):
 
 @caffeine
 def boosting(y, x, tstart, tstop, scale_data=True, delta=0.005, mindelta=None,
-             error='l2'):
+             error='l2', basis=0):
     """Estimate a temporal response function through boosting
 
     Parameters
     ----------
     y : NDVar
-        Signal to predict.
+        Signal to predict. With a case dimension, each case is treated as a
+        separate trial (see Notes).
     x : NDVar | sequence of NDVar
         Signal to use to predict ``y``. Can be sequence of NDVars to include
-        multiple predictors. Time dimension must correspond to ``y``.
+        multiple predictors. Time dimension must correspond to ``y``, and if
+        ``y`` has a case dimension, ``x`` needs to have the same cases.
     tstart : float
         Start of the TRF in seconds.
     tstop : float
@@ -213,6 +227,12 @@ def boosting(y, x, tstart, tstop, scale_data=True, delta=0.005, mindelta=None,
         i.e. ``delta`` is constant.
     error : 'l2' | 'l1'
         Error function to use (default is ``l2``).
+    basis : scalar
+        Express the TRF as a sum of Hamming windows of this width (in
+        seconds), shifted by one sample each, instead of as a sum of impulses
+        (default 0, i.e., impulses). Each boosting step then changes the TRF by
+        a smooth window, so that fewer iterations are needed and data with a
+        high sampling rate can be boosted without decimating first.
 
     Returns
     -------
@@ -224,6 +244,17 @@ def boosting(y, x, tstart, tstop, scale_data=True, delta=0.005, mindelta=None,
     -----
     The boosting algorithm is described in [1]_.
 
+    For data with a case dimension, the TRF is applied to each trial
+    separately, i.e., the TRF does not extend across trial boundaries. For
+    cross-validation, the test data consist of whole trials when there are
+    at least as many trials as cross-validation segments, and are otherwise
+    split at trial boundaries.
+
+    With a ``basis``, ``x`` is convolved with the window once before boosting.
+    Coefficients are estimated only for window positions at which the whole
+    window falls inside the TRF, so that the TRF tapers off at ``tstart`` and
+    ``tstop``.
+
     References
     ----------
     .. [1] David, S. V., Mesgarani, N., & Shamma, S. A. (2007). Estimating
@@ -245,12 +276,38 @@ def boosting(y, x, tstart, tstop, scale_data=True, delta=0.005, mindelta=None,
     i_start = int(round(tstart / tstep))
     i_stop = int(round(tstop / tstep))
     trf_length = i_stop - i_start
+    # basis: boost coefficients for windows on x convolved with the window
+    if basis:
+        n_window = int(round(basis / tstep))
+        if n_window < 3:
+            raise ValueError("basis=%r: window needs to be at least 3 samples "
+                             "long" % (basis,))
+        elif n_window > trf_length:
+            raise ValueError("basis=%r: window is longer than the TRF" %
+                             (basis,))
+        window = np.hamming(n_window)
+        x_boost = convolve_basis(x_data, window, data.segments)
+        trf_length_boost = trf_length - n_window + 1
+    else:
+        window = None
+        x_boost = x_data
+        trf_length_boost = trf_length
     if i_start < 0:
         x_data = x_data[:, -i_start:]
+        x_boost = x_boost[:, -i_start:]
         y_data = y_data[:, :i_start]
     elif i_start > 0:
         x_data = x_data[:, :-i_start]
+        x_boost = x_boost[:, :-i_start]
         y_data = y_data[:, i_start:]
+    # trials in the cropped data (exclude samples that would pair y and x
+    # from different trials)
+    if data.segments is None:
+        segments = None
+    else:
+        segments = data.segments - [0, abs(i_start)]
+        if np.any(segments[:, 1] <= segments[:, 0]):
+            raise ValueError("tstart=%r: trials are too short" % (tstart,))
 
     # progress bar
     pbar = tqdm(desc="Boosting %i signals" % n_y if n_y > 1 else "Boosting",
@@ -260,55 +317,53 @@ def boosting(y, x, tstart, tstop, scale_data=True, delta=0.005, mindelta=None,
     res = np.empty((3, n_y))  # r, rank-r, error
     h_x = np.empty((n_y, n_x, trf_length))
     # boosting
-    if CONFIG['n_workers']:
-        # Make sure cross-validations are added in the same order, otherwise
-        # slight numerical differences can occur
+    stop_jobs = None
+    if not CONFIG['n_workers']:
+        results = boost_serial(y_data, x_boost, trf_length_boost, delta,
+                               mindelta_, N_SEGS, error, segments)
+    elif CONFIG['boosting_backend'] == 'thread':
+        results = boost_threads(y_data, x_boost, trf_length_boost, delta,
+                                mindelta_, N_SEGS, error, segments)
+    else:
         job_queue, result_queue = setup_workers(
-            y_data, x_data, trf_length, delta, mindelta_, N_SEGS, error)
+            y_data, x_boost, trf_length_boost, delta, mindelta_, N_SEGS,
+            error, segments)
         stop_jobs = Event()
-        thread = Thread(target=put_jobs, args=(job_queue, n_y, N_SEGS, stop_jobs))
+        thread = Thread(target=put_jobs,
+                        args=(job_queue, n_y, N_SEGS, stop_jobs))
         thread.start()
-
-        # collect results
-        try:
-            h_segs = {}
-            for _ in range(n_y * N_SEGS):
-                y_i, seg_i, h = result_queue.get()
-                pbar.update()
-                if y_i in h_segs:
-                    h_seg = h_segs[y_i]
-                    h_seg[seg_i] = h
-                    if len(h_seg) == N_SEGS:
-                        del h_segs[y_i]
-                        hs = [h for h in (h_seg[i] for i in range(N_SEGS)) if
-                              h is not None]
-                        if hs:
+        results = (result_queue.get() for _ in range(n_y * N_SEGS))
+
+    # collect results
+    # Make sure cross-validations are added in the same order, otherwise
+    # slight numerical differences can occur
+    try:
+        h_segs = {}
+        for y_i, seg_i, h in results:
+            pbar.update()
+            if y_i in h_segs:
+                h_seg = h_segs[y_i]
+                h_seg[seg_i] = h
+                if len(h_seg) == N_SEGS:
+                    del h_segs[y_i]
+                    hs = [h for h in (h_seg[i] for i in range(N_SEGS)) if
+                          h is not None]
+                    if hs:
+                        if window is None:
                             h = np.mean(hs, 0, out=h_x[y_i])
-                            res[:, y_i] = evaluate_kernel(y_data[y_i], x_data, h, error)
                         else:
-                            h_x[y_i] = 0
-                            res[:, y_i] = 0.
-                else:
-                    h_segs[y_i] = {seg_i: h}
-        except KeyboardInterrupt:
-            stop_jobs.set()
-            raise
-    else:
-        for y_i, y_ in enumerate(y_data):
-            hs = []
-            for i in range(N_SEGS):
-                h = boost_1seg(x_data, y_, trf_length, delta, N_SEGS, i,
-                               mindelta_, error)
-                if h is not None:
-                    hs.append(h)
-                pbar.update()
-
-            if hs:
-                h = np.mean(hs, 0, out=h_x[y_i])
-                res[:, y_i] = evaluate_kernel(y_, x_data, h, error)
+                            h = apply_basis(np.mean(hs, 0), window, h_x[y_i])
+                        res[:, y_i] = evaluate_kernel(y_data[y_i], x_data, h,
+                                                      error, segments)
+                    else:
+                        h_x[y_i] = 0
+                        res[:, y_i] = 0.
             else:
-                h_x[y_i].fill(0)
-                res[:, y_i].fill(0.)
+                h_segs[y_i] = {seg_i: h}
+    except KeyboardInterrupt:
+        if stop_jobs is not None:
+            stop_jobs.set()
+        raise
 
     pbar.close()
     dt = time.time() - t_start
@@ -326,11 +381,11 @@ def boosting(y, x, tstart, tstop, scale_data=True, delta=0.005, mindelta=None,
     return BoostingResult(data.package_kernel(h_x, tstart), r, isnan, dt, VERSION,
                           delta, mindelta, error, rr, err,
                           scale_data, y_mean, y_scale, x_mean, x_scale,
-                          data.y_name, data.x_name, tstart, tstop)
+                          data.y_name, data.x_name, tstart, tstop, basis)
 
 
 def boost_1seg(x, y, trf_length, delta, nsegs, segno, mindelta, error,
-               return_history=False):
+               return_history=False, grams=None, segments=None):
     """Boosting with one test segment determined by regular division
 
     Based on port of svdboostV4pred
@@ -357,6 +412,11 @@ def boost_1seg(x, y, trf_length, delta, nsegs, segno, mindelta, error,
         Error function to use.
     return_history : bool
         Return error history as second return value.
+    grams : dict
+        Cache for the :class:`LagGram` of each segment (``{segno: LagGram}``),
+        to reuse them for different ``y`` with the same ``x``.
+    segments : array of (start, stop)
+        Trials (see :func:`segment_index`).
 
     Returns
     -------
@@ -369,26 +429,255 @@ def boost_1seg(x, y, trf_length, delta, nsegs, segno, mindelta, error,
     assert y.shape == (x.shape[1],)
 
     # separate training and testing signal
-    n_times = x.shape[1]
-    test_seg_len = int(floor(x.shape[1] / nsegs))
+    train_index, test_index = segment_index(x.shape[1], nsegs, segno, segments)
+    gram = get_lag_gram(x, trf_length, nsegs, segno, error, grams, segments)
+    return boost_segs(y, x, train_index, test_index, trf_length, delta,
+                      mindelta, error, return_history, gram)
+
+
+def boost_batch(x, y, trf_length, delta, nsegs, segno, mindelta, error,
+                grams=None, segments=None):
+    """Boost several signals with the same test segment
+
+    Parameters
+    ----------
+    x : array (n_stims, n_times)
+        Stimulus.
+    y : array (n_y, n_times)
+        Dependent signals.
+    ...
+        See :func:`boost_1seg`.
+
+    Returns
+    -------
+    hs : list of (None | array)
+        Winning kernel for each signal in ``y``.
+    """
+    gram = get_lag_gram(x, trf_length, nsegs, segno, error, grams, segments)
+    if gram is None:
+        return [boost_1seg(x, y_, trf_length, delta, nsegs, segno, mindelta,
+                           error, segments=segments) for y_ in y]
+    return boost_segs_batch(y, x, gram, delta, mindelta)
+
+
+def get_lag_gram(x, trf_length, nsegs, segno, error, grams=None,
+                 segments=None):
+    """:class:`LagGram` for incremental l2 boosting (or None if not applicable)
+
+    Parameters
+    ----------
+    ...
+        See :func:`boost_1seg`.
+    """
+    if error != 'l2' or not LagGram.fits(x, trf_length):
+        return None
+    elif grams is not None and segno in grams:
+        return grams[segno]
+    index = segment_index(x.shape[1], nsegs, segno, segments)
+    gram = LagGram(x, *index, trf_length)
+    if grams is not None:
+        grams[segno] = gram
+    return gram
+
+
+def boost_segs_batch(y, x, gram, delta, mindelta, return_history=False):
+    """Boosting several signals with the incremental l2 error
+
+    Equivalent to :func:`boost_segs` with ``gram`` for each signal in ``y``,
+    but candidate steps are evaluated, and the errors updated, for all signals
+    together. Each signal stops independently.
+
+    Parameters
+    ----------
+    y : array (n_y, n_times)
+        Dependent signals, time series to predict.
+    x : array (n_stims, n_times)
+        Stimulus.
+    gram : LagGram
+        Lag Gram matrices of ``x`` (determine training and test segments).
+    delta : scalar
+        Step of the adjustment.
+    mindelta : scalar
+        Smallest delta to use (see :func:`boost_segs`).
+    return_history : bool
+        Return error histories as second return value.
+
+    Returns
+    -------
+    hs : list of (None | array)
+        Winning kernel for each signal, or None if 0 is the best kernel.
+    test_sse_histories : list of list (only if ``return_history==True``)
+        SSE for test data at each iteration, for each signal.
+    """
+    n_y = len(y)
+    shape = (len(x), gram.trf_length)
+    h = np.zeros((n_y,) + shape)
+    errors = L2GramError(y, x, gram)
+
+    # buffers
+    new_error = np.empty((n_y,) + shape)
+    new_sign = np.empty((n_y,) + shape, np.int8)
+
+    # state of each signal
+    deltas = np.full(n_y, delta, np.float64)
+    best_test_error = np.full(n_y, np.inf)
+    best_iteration = np.zeros(n_y, np.int64)
+    histories = [[] for _ in range(n_y)]
+    test_error_histories = [[] for _ in range(n_y)]
+    active = np.arange(n_y)
+    for i_boost in range(999999):
+        # evaluate current h
+        e_test, e_train = errors.evaluate(active)
+        keep = []
+        for i, e_test_i in zip(active, e_test):
+            test_error_history = test_error_histories[i]
+            if e_test_i < best_test_error[i]:
+                best_test_error[i] = e_test_i
+                best_iteration[i] = i_boost
+            test_error_history.append(e_test_i)
+            # stop if the test error is higher than in the previous two
+            # iterations (see boost_segs)
+            keep.append(not (i_boost > 10 and
+                             e_test_i > test_error_history[-2] and
+                             e_test_i > test_error_history[-3]))
+        active = active[keep]
+        e_train = e_train[keep]
+        n_active = len(active)
+        if n_active == 0:
+            break
+
+        # generate possible movements -> training error
+        new_error_ = new_error[:n_active]
+        new_sign_ = new_sign[:n_active]
+        errors.options(active, deltas[active], new_error_, new_sign_)
+        i_stims, i_times = np.unravel_index(
+            new_error_.reshape((n_active, -1)).argmin(1), shape)
+
+        keep = []
+        steps = []
+        for k, i in enumerate(active):
+            i_stim = i_stims[k]
+            i_time = i_times[k]
+            history = histories[i]
+            new_train_error = new_error_[k, i_stim, i_time]
+            delta_signed = new_sign_[k, i_stim, i_time] * deltas[i]
+
+            # If no improvements can be found reduce delta
+            if new_train_error > e_train[k]:
+                deltas[i] *= 0.5
+                if deltas[i] >= mindelta:
+                    history.append(DELTA_REDUCTION_STEP)
+                    keep.append(True)
+                else:
+                    keep.append(False)
+                continue
+
+            # abort if we're moving in circles
+            if i_boost >= 2 and (i_stim, i_time, -delta_signed) == history[-1]:
+                keep.append(False)
+                continue
+            elif i_boost >= 4 and history[-3] is DELTA_REDUCTION_STEP:
+                step = (i_stim, i_time, -delta_signed / 2.)
+                if history[-1] == step and history[-2] == step:
+                    keep.append(False)
+                    continue
+
+            # update h with best movement
+            h[i, i_stim, i_time] += delta_signed
+            history.append((i_stim, i_time, delta_signed))
+            steps.append((i, i_stim, i_time, delta_signed))
+            keep.append(True)
+
+        if steps:
+            errors.update(*map(np.array, zip(*steps)))
+        active = active[keep]
+        if len(active) == 0:
+            break
+    else:
+        raise RuntimeError("Maximum number of iterations exceeded")
+
+    # reverse changes after best iteration
+    hs = []
+    for h_, history, best_iteration_ in zip(h, histories, best_iteration):
+        if best_iteration_:
+            for i_stim, i_time, delta_signed in history[-1: best_iteration_ - 1: -1]:
+                if delta_signed is not None:
+                    h_[i_stim, i_time] -= delta_signed
+            hs.append(h_)
+        else:
+            hs.append(None)
+
+    if return_history:
+        return hs, test_error_histories
+    else:
+        return hs
+
+
+def segment_index(n_times, nsegs, segno, segments=None):
+    """Training and test segments for cross-validation
+
+    Parameters
+    ----------
+    n_times : int
+        Number of time samples.
+    nsegs : int
+        Number of cross-validation segments.
+    segno : int [0, nsegs-1]
+        Which segment to use for testing.
+    segments : array of (start, stop)
+        Trials, which are never joined into one segment. With at least
+        ``nsegs`` trials, test segments consist of whole trials; otherwise,
+        the regular division is split at trial boundaries.
+
+    Returns
+    -------
+    train_index : array of (start, stop)
+        Time sample index of training segments.
+    test_index : array of (start, stop)
+        Time sample index of test segments.
+    """
+    if segno < 0 or segno >= nsegs:
+        raise ValueError("segno=%r" % segno)
+    elif segments is not None:
+        return trial_segment_index(n_times, nsegs, segno, segments)
+    test_seg_len = int(floor(n_times / nsegs))
     test_index = ((test_seg_len * segno, test_seg_len * (segno + 1)),)
     if segno == 0:
         train_index = ((test_seg_len, n_times),)
     elif segno == nsegs-1:
         train_index = ((0, n_times - test_seg_len),)
-    elif segno < 0 or segno >= nsegs:
-        raise ValueError("segno=%r" % segno)
     else:
         train_index = ((0, test_seg_len * segno),
                        (test_seg_len * (segno + 1), n_times))
-
-    return boost_segs(y, x, np.array(train_index, np.int64),
-                      np.array(test_index, np.int64), trf_length, delta,
-                      mindelta, error, return_history)
+    return np.array(train_index, np.int64), np.array(test_index, np.int64)
+
+
+def trial_segment_index(n_times, nsegs, segno, segments):
+    "Training and test segments for trials (see :func:`segment_index`)"
+    segments = np.asarray(segments, np.int64)
+    if len(segments) >= nsegs:
+        bounds = np.linspace(0, len(segments), nsegs + 1).round().astype(int)
+        i_start, i_stop = bounds[segno], bounds[segno + 1]
+        test_index = segments[i_start:i_stop]
+        train_index = np.vstack((segments[:i_start], segments[i_stop:]))
+        return train_index, test_index
+
+    test_seg_len = int(floor(n_times / nsegs))
+    t_start = test_seg_len * segno
+    t_stop = t_start + test_seg_len
+    starts, stops = segments.T
+    test_index = np.vstack((np.maximum(starts, t_start),
+                            np.minimum(stops, t_stop))).T
+    train_index = np.vstack((
+        np.vstack((starts, np.minimum(stops, t_start))).T,
+        np.vstack((np.maximum(starts, t_stop), stops)).T))
+    train_index = train_index[np.argsort(train_index[:, 0], kind='mergesort')]
+    return (train_index[train_index[:, 1] > train_index[:, 0]],
+            test_index[test_index[:, 1] > test_index[:, 0]])
 
 
 def boost_segs(y, x, train_index, test_index, trf_length, delta, mindelta,
-               error, return_history):
+               error, return_history, gram=None):
     """Boosting supporting multiple array segments
 
     Parameters
@@ -413,6 +702,9 @@ def boost_segs(y, x, train_index, test_index, trf_length, delta, mindelta,
         Error function to use.
     return_history : bool
         Return error history as second return value.
+    gram : LagGram
+        Lag Gram matrices of ``x`` for ``train_index`` and ``test_index``, to
+        update the l2 error incrementally (only with ``error='l2'``).
 
     Returns
     -------
@@ -421,18 +713,22 @@ def boost_segs(y, x, train_index, test_index, trf_length, delta, mindelta,
     test_sse_history : list (only if ``return_history==True``)
         SSE for test data at each iteration.
     """
-    delta_error = DELTA_ERROR_FUNC[error]
-    error = ERROR_FUNC[error]
     n_stims, n_times = x.shape
     assert y.shape == (n_times,)
 
-    h = np.zeros((n_stims, trf_length))
+    if gram is not None:
+        if error != 'l2':
+            raise ValueError("gram with error=%r" % (error,))
+        hs, histories = boost_segs_batch(y[np.newaxis], x, gram, delta,
+                                         mindelta, True)
+        if return_history:
+            return hs[0], histories[0]
+        return hs[0]
 
-    # index for computing all segments
-    all_index = np.vstack((train_index, test_index))
+    h = np.zeros((n_stims, trf_length))
+    errors = ResidualError(y, x, train_index, test_index, error)
 
     # buffers
-    y_error = y.copy()
     new_error = np.empty(h.shape)
     new_sign = np.empty(h.shape, np.int8)
 
@@ -443,8 +739,7 @@ def boost_segs(y, x, train_index, test_index, trf_length, delta, mindelta,
     # pre-assign iterators
     for i_boost in range(999999):
         # evaluate current h
-        e_test = error(y_error, test_index)
-        e_train = error(y_error, train_index)
+        e_test, e_train = errors.evaluate()
 
         if e_test < best_test_error:
             best_test_error = e_test
@@ -462,7 +757,7 @@ def boost_segs(y, x, train_index, test_index, trf_length, delta, mindelta,
             break
 
         # generate possible movements -> training error
-        generate_options(y_error, x, train_index, delta_error, delta, new_error, new_sign)
+        errors.options(delta, new_error, new_sign)
 
         i_stim, i_time = np.unravel_index(np.argmin(new_error), h.shape)
         new_train_error = new_error[i_stim, i_time]
@@ -492,7 +787,7 @@ def boost_segs(y, x, train_index, test_index, trf_length, delta, mindelta,
         # update h with best movement
         h[i_stim, i_time] += delta_signed
         history.append((i_stim, i_time, delta_signed))
-        update_error(y_error, x[i_stim], all_index, delta_signed, i_time)
+        errors.update(i_stim, i_time, delta_signed)
     else:
         raise RuntimeError("Maximum number of iterations exceeded")
     # print('  (%i iterations)' % (i_boost + 1))
@@ -511,7 +806,226 @@ def boost_segs(y, x, train_index, test_index, trf_length, delta, mindelta,
         return h
 
 
-def setup_workers(y, x, trf_length, delta, mindelta, nsegs, error):
+class ResidualError(object):
+    """Errors of candidate steps, evaluated on the residual ``y - y_pred``
+
+    Supports any error function; each evaluation of the candidate steps
+    traverses all training data for each (stimulus, lag) pair.
+    """
+    def __init__(self, y, x, train_index, test_index, error):
+        self.x = x
+        self.train_index = train_index
+        self.test_index = test_index
+        self.all_index = np.vstack((train_index, test_index))
+        self.error_func = ERROR_FUNC[error]
+        self.delta_error = DELTA_ERROR_FUNC[error]
+        self.y_error = y.copy()
+
+    def evaluate(self):
+        "Test and training error of the current kernel"
+        return (self.error_func(self.y_error, self.test_index),
+                self.error_func(self.y_error, self.train_index))
+
+    def options(self, delta, new_error, new_sign):
+        "Training error and sign for a step of ``delta`` for each kernel element"
+        generate_options(self.y_error, self.x, self.train_index,
+                         self.delta_error, delta, new_error, new_sign)
+
+    def update(self, i_stim, i_time, delta):
+        "Add ``delta`` to the kernel at ``[i_stim, i_time]``"
+        update_error(self.y_error, self.x[i_stim], self.all_index, delta,
+                     i_time)
+
+
+class LagGram(object):
+    """Cross-products of the lagged stimuli in training and test segments
+
+    Depend only on ``x`` and the segments, and are shared by all ``y``.
+
+    Attributes
+    ----------
+    train : array  (n_stims * trf_length, n_stims * trf_length)
+        Cross-products for the training segments.
+    test : array  (n_stims * trf_length, n_stims * trf_length)
+        Cross-products for the test segments.
+    """
+    def __init__(self, x, train_index, test_index, trf_length):
+        n = len(x) * trf_length
+        self.train_index = train_index
+        self.test_index = test_index
+        self.trf_length = trf_length
+        self.train = np.zeros((n, n))
+        l2_lag_gram(x, train_index, self.train)
+        self.test = np.zeros((n, n))
+        l2_lag_gram(x, test_index, self.test)
+        self.train_diag = self.train.diagonal().reshape((len(x), trf_length))
+        self.test_diag = self.test.diagonal().reshape((len(x), trf_length))
+
+    @staticmethod
+    def fits(x, trf_length):
+        "Whether the matrices for ``x`` fit into ``L2_GRAM_MAX_BYTES``"
+        return 2 * (len(x) * trf_length) ** 2 * 8 <= L2_GRAM_MAX_BYTES
+
+
+class L2GramError(object):
+    """Incremental l2 errors of candidate steps for several signals
+
+    Adding ``d`` to the kernel at ``[s, t]`` changes the l2 training error
+    by ``- 2 * d * c[s, t] + d**2 * g[st, st]``, where ``c`` are the
+    cross-products of the residual with the lagged stimuli and ``g`` the
+    cross-products of the lagged stimuli with each other (:class:`LagGram`).
+    After the step, ``c`` is updated from the corresponding row of ``g``.
+    Except for the initial cross-products, the cost of an iteration thus does
+    not depend on the number of time points.
+
+    Parameters
+    ----------
+    y : array (n_y, n_times)
+        Dependent signals.
+    x : array (n_stims, n_times)
+        Stimulus.
+    gram : LagGram
+        Lag Gram matrices of ``x``.
+
+    Notes
+    -----
+    Methods take an ``index`` of the signals to which they apply.
+    """
+    def __init__(self, y, x, gram):
+        self.gram = gram
+        self.c_train = lagged_cross_products(y, x, gram.train_index,
+                                             gram.trf_length)
+        self.c_test = lagged_cross_products(y, x, gram.test_index,
+                                            gram.trf_length)
+        self.e_train = np.array([l2(y_, gram.train_index) for y_ in y])
+        self.e_test = np.array([l2(y_, gram.test_index) for y_ in y])
+
+    def evaluate(self, index):
+        "Test and training error of the current kernels"
+        return self.e_test[index], self.e_train[index]
+
+    def options(self, index, delta, new_error, new_sign):
+        "Training error and sign for a step of ``delta`` for each kernel element"
+        delta = delta[:, np.newaxis, np.newaxis]
+        c = self.c_train[index]
+        # the sign of the step that reduces the error is the sign of c
+        np.abs(c, new_error)
+        new_error *= -2 * delta
+        new_error += delta ** 2 * self.gram.train_diag
+        new_error += self.e_train[index, np.newaxis, np.newaxis]
+        np.copyto(new_sign, np.where(c < 0, -1, 1))
+
+    def update(self, index, i_stim, i_time, delta):
+        "Add ``delta`` to the kernels at ``[i_stim, i_time]``"
+        gram = self.gram
+        self.e_train[index] += delta * (delta * gram.train_diag[i_stim, i_time] -
+                                        2 * self.c_train[index, i_stim, i_time])
+        self.e_test[index] += delta * (delta * gram.test_diag[i_stim, i_time] -
+                                       2 * self.c_test[index, i_stim, i_time])
+        rows = i_stim * gram.trf_length + i_time
+        shape = (len(rows),) + gram.train_diag.shape
+        delta = delta[:, np.newaxis, np.newaxis]
+        self.c_train[index] -= delta * gram.train[rows].reshape(shape)
+        self.c_test[index] -= delta * gram.test[rows].reshape(shape)
+
+
+def lagged_cross_products(y, x, index, trf_length):
+    """Cross-products of signals with the lagged stimuli, summed over segments
+
+    Parameters
+    ----------
+    y : array (n_y, n_times)
+        Signals.
+    x : array (n_stims, n_times)
+        Stimulus.
+    index : array of (start, stop)
+        Time sample index of segments.
+    trf_length : int
+        Number of lags.
+
+    Returns
+    -------
+    cross_products : array (n_y, n_stims, trf_length)
+        ``cross_products[i, s, t]`` is the sum of ``y[i, j] * x[s, j - t]``
+        over all ``j`` with ``j - t`` in the same segment as ``j``.
+    """
+    if len(y) == 1:
+        out = np.empty((1, len(x), trf_length))
+        l2_cross_products(y[0], x, index, out[0])
+        return out
+    # matrix products, sharing each lagged segment of x among all signals
+    out = np.zeros((len(y), len(x), trf_length))
+    for start, stop in index:
+        for i_time in range(min(trf_length, stop - start)):
+            out[:, :, i_time] += np.dot(y[:, start + i_time:stop],
+                                        x[:, start:stop - i_time].T)
+    return out
+
+
+def batch_index(n_y):
+    "Split signals into batches of up to ``BATCH_SIZE``, as ``(start, stop)``"
+    return [(start, min(start + BATCH_SIZE, n_y)) for start in
+            range(0, n_y, BATCH_SIZE)]
+
+
+def boost_serial(y, x, trf_length, delta, mindelta, nsegs, error,
+                 segments=None):
+    """Boost all signals and segments in the current thread
+
+    Yields
+    ------
+    y_i, seg_i, h
+        Result for each signal and segment.
+    """
+    grams = {}
+    for y_start, y_stop in batch_index(len(y)):
+        for seg_i in range(nsegs):
+            hs = boost_batch(x, y[y_start:y_stop], trf_length, delta, nsegs,
+                             seg_i, mindelta, error, grams, segments)
+            for y_i, h in enumerate(hs, y_start):
+                yield y_i, seg_i, h
+
+
+def boost_threads(y, x, trf_length, delta, mindelta, nsegs, error,
+                  segments=None):
+    """Boost all signals and segments in a pool of threads
+
+    The threads share ``y`` and ``x`` (and the :class:`LagGram` of each
+    segment) without copying; the boosting kernels release the GIL.
+
+    Yields
+    ------
+    y_i, seg_i, h
+        Result for each job, in order of completion.
+    """
+    with ThreadPoolExecutor(CONFIG['n_workers']) as executor:
+        # shared, read-only cache
+        grams = {}
+        if error == 'l2' and LagGram.fits(x, trf_length):
+            def make_gram(segno):
+                index = segment_index(x.shape[1], nsegs, segno, segments)
+                return LagGram(x, *index, trf_length)
+            grams.update(enumerate(executor.map(make_gram, range(nsegs))))
+
+        futures = {
+            executor.submit(boost_batch, x, y[y_start:y_stop], trf_length,
+                            delta, nsegs, seg_i, mindelta, error, grams,
+                            segments):
+            (y_start, seg_i) for (y_start, y_stop), seg_i in
+            product(batch_index(len(y)), range(nsegs))}
+        try:
+            for future in as_completed(futures):
+                y_start, seg_i = futures[future]
+                for y_i, h in enumerate(future.result(), y_start):
+                    yield y_i, seg_i, h
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def setup_workers(y, x, trf_length, delta, mindelta, nsegs, error,
+                  segments=None):
     n_y, n_times = y.shape
     n_x, _ = x.shape
 
@@ -524,7 +1038,7 @@ def setup_workers(y, x, trf_length, delta, mindelta, nsegs, error):
     result_queue = Queue(200)
 
     args = (y_buffer, x_buffer, n_y, n_times, n_x, trf_length, delta,
-            mindelta, nsegs, error, job_queue, result_queue)
+            mindelta, nsegs, error, segments, job_queue, result_queue)
     for _ in range(CONFIG['n_workers']):
         process = Process(target=boosting_worker, args=args)
         process.start()
@@ -533,7 +1047,8 @@ def setup_workers(y, x, trf_length, delta, mindelta, nsegs, error):
 
 
 def boosting_worker(y_buffer, x_buffer, n_y, n_times, n_x, trf_length,
-                    delta, mindelta, nsegs, error, job_queue, result_queue):
+                    delta, mindelta, nsegs, error, segments, job_queue,
+                    result_queue):
     if CONFIG['nice']:
         os.nice(CONFIG['nice'])
     signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -541,25 +1056,54 @@ def boosting_worker(y_buffer, x_buffer, n_y, n_times, n_x, trf_length,
     y = np.frombuffer(y_buffer, np.float64, n_y * n_times).reshape((n_y, n_times))
     x = np.frombuffer(x_buffer, np.float64, n_x * n_times).reshape((n_x, n_times))
 
+    grams = {}
     while True:
-        y_i, seg_i = job_queue.get()
-        if y_i == JOB_TERMINATE:
+        y_start, y_stop, seg_i = job_queue.get()
+        if y_start == JOB_TERMINATE:
             return
-        h = boost_1seg(x, y[y_i], trf_length, delta, nsegs, seg_i, mindelta,
-                       error)
-        result_queue.put((y_i, seg_i, h))
+        hs = boost_batch(x, y[y_start:y_stop], trf_length, delta, nsegs,
+                         seg_i, mindelta, error, grams, segments)
+        for y_i, h in enumerate(hs, y_start):
+            result_queue.put((y_i, seg_i, h))
 
 
 def put_jobs(queue, n_y, n_segs, stop):
     "Feed boosting jobs into a Queue"
-    for job in product(range(n_y), range(n_segs)):
-        queue.put(job)
+    for (y_start, y_stop), seg_i in product(batch_index(n_y), range(n_segs)):
+        queue.put((y_start, y_stop, seg_i))
         if stop.isSet():
             while not queue.empty():
                 queue.get()
             break
     for _ in range(CONFIG['n_workers']):
-        queue.put((JOB_TERMINATE, None))
+        queue.put((JOB_TERMINATE, None, None))
+
+
+def convolve_basis(x, window, segments=None):
+    """Convolve ``x`` with the basis window (separately in each trial)
+
+    x.shape is (n_stims, n_samples)
+    """
+    if segments is None:
+        segments = ((0, x.shape[1]),)
+    out = np.zeros(x.shape)
+    for start, stop in segments:
+        for x_i, out_i in zip(x[:, start:stop], out[:, start:stop]):
+            out_i[:] = np.convolve(window, x_i)[:stop - start]
+    return out
+
+
+def apply_basis(h, window, out=None):
+    """Kernel from coefficients for a basis of shifted windows
+
+    h.shape is (n_stims, n_coefficients)
+    out.shape is (n_stims, n_coefficients + len(window) - 1)
+    """
+    if out is None:
+        out = np.empty((len(h), h.shape[1] + len(window) - 1))
+    for h_i, out_i in zip(h, out):
+        out_i[:] = np.convolve(h_i, window)
+    return out
 
 
 def apply_kernel(x, h, out=None):
@@ -579,9 +1123,22 @@ def apply_kernel(x, h, out=None):
     return out
 
 
-def evaluate_kernel(y, x, h, error):
+def evaluate_kernel(y, x, h, error, segments=None):
     """Fit quality statistics
 
+    Parameters
+    ----------
+    y : array (n_times,)
+        Dependent signal.
+    x : array (n_stims, n_times)
+        Stimulus.
+    h : array (n_stims, n_times_trf)
+        Kernel.
+    error : str
+        Error function.
+    segments : array of (start, stop)
+        Trials (the kernel is applied to each trial separately).
+
     Returns
     -------
     r : float | array
@@ -591,12 +1148,15 @@ def evaluate_kernel(y, x, h, error):
     error : float | array
         Error corresponding to error_func.
     """
-    y_pred = apply_kernel(x, h)
-
     # discard onset (length of kernel)
     i0 = h.shape[-1] - 1
-    y = y[i0:]
-    y_pred = y_pred[i0:]
+    if segments is None:
+        y_pred = apply_kernel(x, h)[i0:]
+        y = y[i0:]
+    else:
+        y_pred = np.concatenate([apply_kernel(x[:, start:stop], h)[i0:] for
+                                 start, stop in segments])
+        y = np.concatenate([y[start + i0:stop] for start, stop in segments])
 
     error_func = ERROR_FUNC[error]
     index = np.array(((0, len(y)),), np.int64)
@@ -65,7 +65,7 @@ cdef void l1_for_delta(
         seg_start = indexes[seg_i, 0]
         # start of the segment before the shift-delay
         temp_sum = 0.
-        for i in range(seg_start, seg_start + shift):
+        for i in range(seg_start, min(seg_start + shift, <size_t>indexes[seg_i, 1])):
             temp_sum += fabs(y_error[i])
         e_add[0] += temp_sum
         e_sub[0] += temp_sum
@@ -95,7 +95,7 @@ cdef void l2_for_delta(
         seg_start = indexes[seg_i, 0]
         # start of the segment before the shift-delay
         temp_sum = 0.
-        for i in range(seg_start, seg_start + shift):
+        for i in range(seg_start, min(seg_start + shift, <size_t>indexes[seg_i, 1])):
             temp_sum += y_error[i] ** 2
         e_add[0] += temp_sum
         e_sub[0] += temp_sum
@@ -158,3 +158,83 @@ def update_error(
         for seg_i in range(indexes.shape[0]):
             for i in range(indexes[seg_i, 0] + shift, indexes[seg_i, 1]):
                 y_error[i] -= delta * x[i - shift]
+
+
+def l2_cross_products(
+        FLOAT64 [:] y,
+        FLOAT64 [:,:] x,  # (n_stims, n_times)
+        INT64 [:,:] indexes,  # segment indexes
+        FLOAT64 [:,:] out,  # (n_stims, n_times_trf)
+    ):
+    """Cross-products of ``y`` with the lagged stimuli, summed over segments
+
+    ``out[i_stim, i_time]`` is the sum of ``y[t] * x[i_stim, t - i_time]``
+    over all ``t`` with ``t - i_time`` in the same segment as ``t``.
+    """
+    cdef:
+        double temp
+        size_t n_stims = out.shape[0]
+        size_t n_times_trf = out.shape[1]
+        size_t i_stim, i_time, i, seg_i
+
+    with nogil:
+        for i_stim in range(n_stims):
+            for i_time in range(n_times_trf):
+                temp = 0.
+                for seg_i in range(indexes.shape[0]):
+                    for i in range(indexes[seg_i, 0] + i_time, indexes[seg_i, 1]):
+                        temp += y[i] * x[i_stim, i - i_time]
+                out[i_stim, i_time] = temp
+
+
+def l2_lag_gram(
+        FLOAT64 [:,:] x,  # (n_stims, n_times)
+        INT64 [:,:] indexes,  # segment indexes
+        FLOAT64 [:,:] out,  # (n_stims * n_times_trf, n_stims * n_times_trf)
+    ):
+    """Cross-products of the lagged stimuli, summed over segments
+
+    ``out[i_stim * n_times_trf + i_time, j_stim * n_times_trf + j_time]`` is
+    the sum of ``x[i_stim, t - i_time] * x[j_stim, t - j_time]`` over all
+    ``t`` for which both lagged samples are in the same segment as ``t``.
+    Values are added to ``out``, which should be initialized with zeros.
+
+    For a given lag difference, the sums for consecutive ``i_time`` differ
+    only by one product at the end of the segment, so that each segment is
+    traversed only once for each pair of stimuli and lag difference.
+    """
+    cdef:
+        double temp
+        size_t n_stims = x.shape[0]
+        size_t n_times_trf = out.shape[0] // n_stims
+        size_t i_stim, j_stim, i_time, j_time, lag, seg_i
+        Py_ssize_t a, start, stop
+
+    with nogil:
+        for seg_i in range(indexes.shape[0]):
+            start = indexes[seg_i, 0]
+            stop = indexes[seg_i, 1]
+            for i_stim in range(n_stims):
+                for j_stim in range(n_stims):
+                    # j_time = i_time + lag
+                    for lag in range(n_times_trf):
+                        if start + <Py_ssize_t>lag >= stop:
+                            break
+                        temp = 0.
+                        for a in range(start, stop - lag):
+                            temp += x[i_stim, a + lag] * x[j_stim, a]
+                        for i_time in range(n_times_trf - lag):
+                            j_time = i_time + lag
+                            out[i_stim * n_times_trf + i_time, j_stim * n_times_trf + j_time] += temp
+                            # remove the last sample for the next i_time
+                            a = stop - 1 - <Py_ssize_t>j_time
+                            if a <= start:
+                                break
+                            temp -= x[i_stim, a + lag] * x[j_stim, a]
+
+        # the matrix is symmetric
+        for i_stim in range(n_stims):
+            for j_stim in range(n_stims):
+                for i_time in range(1, n_times_trf):
+                    for j_time in range(i_time):
+                        out[i_stim * n_times_trf + i_time, j_stim * n_times_trf + j_time] = out[j_stim * n_times_trf + j_time, i_stim * n_times_trf + i_time]
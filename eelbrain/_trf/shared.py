@@ -14,6 +14,10 @@ class RevCorrData(object):
         Dependent variable.
     x : array  (n_x, n_times)
         Predictors.
+    segments : None | array  (n_segments, 2)
+        For data with a case dimension, ``(start, stop)`` of each case
+        (trial) on the time axis of ``y`` and ``x`` (cases are placed
+        back-to-back, without copying the data if its layout allows it).
     """
     def __init__(self, y, x, error, scale_data):
         # scale_data param
@@ -40,15 +44,31 @@ class RevCorrData(object):
         time_dim = y.get_dim('time')
         if any(x_.get_dim('time') != time_dim for x_ in x):
             raise ValueError("Not all NDVars have the same time dimension")
+        # trials: cases are placed back-to-back on the time axis
+        if y.has_case:
+            n_cases = len(y)
+            if any(not x_.has_case or len(x_) != n_cases for x_ in x):
+                raise ValueError("y has %i cases; all x need to have the "
+                                 "same number of cases" % (n_cases,))
+            bounds = np.arange(n_cases + 1) * len(time_dim)
+            segments = np.vstack((bounds[:-1], bounds[1:])).T
+            last = ('case', 'time')
+        elif any(x_.has_case for x_ in x):
+            raise ValueError("x has case dimension but y does not")
+        else:
+            n_cases = 1
+            segments = None
+            last = ('time',)
+        n_times = n_cases * len(time_dim)
 
         # y_data:  ydim x time array
-        if y.ndim == 1:
+        if y.ndim == len(last):
             ydims = ()
-            y_data = y.x[None, :]
+            y_data = y.x.reshape((1, n_times))
         else:
-            dimnames = y.get_dimnames(last='time')
-            ydims = y.get_dims(dimnames[:-1])
-            y_data = y.get_data(dimnames).reshape((-1, len(y.time)))
+            dimnames = y.get_dimnames((None,) * (y.ndim - len(last)) + last)
+            ydims = y.get_dims(dimnames[:-len(last)])
+            y_data = y.get_data(dimnames).reshape((-1, n_times))
 
         # x_data:  predictor x time array
         x_data = []
@@ -56,14 +76,15 @@ class RevCorrData(object):
         x_names = []
         n_x = 0
         for x_ in x:
-            if x_.ndim == 1:
+            if x_.ndim == len(last):
                 xdim = None
-                data = x_.x[newaxis, :]
+                data = x_.x.reshape((1, n_times))
                 index = n_x
                 x_names.append(dataobj_repr(x_))
-            elif x_.ndim == 2:
-                xdim = x_.dims[not x_.get_axis('time')]
-                data = x_.get_data((xdim.name, 'time'))
+            elif x_.ndim == len(last) + 1:
+                dimnames = x_.get_dimnames((None,) + last)
+                xdim = x_.get_dim(dimnames[0])
+                data = x_.get_data(dimnames).reshape((-1, n_times))
                 index = slice(n_x, n_x + len(data))
                 x_repr = dataobj_repr(x_)
                 for v in xdim:
@@ -121,6 +142,7 @@ class RevCorrData(object):
             raise ValueError("Data with NaN: " + ', '.join(has_nan))
 
         self.time = time_dim
+        self.segments = segments
         self._scale_data = bool(scale_data)
         # y
         self.y = y_data
@@ -2,13 +2,17 @@
 from math import floor
 import os
 
-from nose.tools import eq_, assert_almost_equal, assert_is_none, assert_raises
+from nose.tools import (
+    eq_, assert_almost_equal, assert_greater, assert_is_none, assert_raises)
 import numpy as np
 from numpy.testing import assert_array_equal, assert_allclose
 import pickle
 import scipy.io
-from eelbrain import test, boosting, convolve, configure, datasets
-from eelbrain._trf._boosting import boost_1seg, evaluate_kernel
+from eelbrain import (
+    NDVar, UTS, test, boosting, convolve, configure, datasets)
+from eelbrain._trf._boosting import (
+    apply_basis, apply_kernel, boost_1seg, boost_batch, convolve_basis,
+    evaluate_kernel, segment_index)
 from eelbrain._utils.testing import assert_dataobj_equal
 
 
@@ -70,6 +74,9 @@ def test_boosting():
     yield run_boosting, ds
     configure(n_workers=True)
     yield run_boosting, ds
+    configure(boosting_backend='thread')
+    yield run_boosting, ds
+    configure(boosting_backend='process')
 
 
 def test_result():
@@ -106,6 +113,76 @@ def test_result():
     assert_raises(ValueError, boosting, ds['y'], ds['x1'], 0, .5, False)
 
 
+def test_boosting_trials():
+    "Test boosting with trials"
+    ds = datasets._get_continuous(1000)
+    time = UTS(0, 0.1, 50)
+    y = NDVar(ds['y'].x.reshape((20, 50)), ('case', time), name='y')
+    x1 = NDVar(ds['x1'].x.reshape((20, 50)), ('case', time), name='x1')
+    x2 = ds['x2']
+    x2 = NDVar(x2.x.reshape((2, 20, 50)).swapaxes(0, 1),
+               ('case', x2.dims[0], time), name='x2')
+    res = boosting(y, [x1, x2], 0, 1)
+    eq_(res.h[0].time, ds['h1'].time)
+    eq_(res.h[1].dims, ds['h2'].dims)
+    assert_greater(res.r, 0.9)
+    res = boosting(y, x1, -0.2, 1)
+    eq_(len(res.h.time), 12)
+    # mismatching cases
+    assert_raises(ValueError, boosting, y, ds['x1'], 0, 1)
+    assert_raises(ValueError, boosting, y[:10], x1, 0, 1)
+
+    # segments
+    segments = np.array(((0, 10), (10, 20), (20, 30)), np.int64)
+    train, test = segment_index(30, 3, 1, segments)
+    assert_array_equal(train, ((0, 10), (20, 30)))
+    assert_array_equal(test, ((10, 20),))
+    train, test = segment_index(30, 6, 1, segments)
+    assert_array_equal(train, ((0, 5), (10, 20), (20, 30)))
+    assert_array_equal(test, ((5, 10),))
+
+
+def test_boosting_basis():
+    "Test boosting with a basis of windows"
+    ds = datasets._get_continuous(1000)
+    x1 = ds['x1']
+    y = convolve(ds['h1'], x1)
+    y.name = 'y'
+    res = boosting(y, x1, 0, 1, basis=0.3)
+    eq_(res.h.time, ds['h1'].time)
+    assert_greater(res.r, 0.5)
+    eq_(repr(res), '<boosting y ~ x1, 0 - 1, basis=0.3>')
+    res_ = pickle.loads(pickle.dumps(res, pickle.HIGHEST_PROTOCOL))
+    eq_(res_.basis, 0.3)
+    assert_raises(ValueError, boosting, y, x1, 0, 1, basis=0.2)
+    assert_raises(ValueError, boosting, y, x1, 0, 1, basis=2)
+
+    # model: kernel from coefficients applied to x
+    rng = np.random.RandomState(0)
+    x = rng.normal(0, 1, (2, 100))
+    h = rng.normal(0, 1, (2, 8))
+    window = np.hamming(3)
+    assert_allclose(apply_kernel(convolve_basis(x, window), h),
+                    apply_kernel(x, apply_basis(h, window)))
+    segments = np.array(((0, 50), (50, 100)), np.int64)
+    x_basis = convolve_basis(x, window, segments)
+    assert_allclose(x_basis[:, 50:], convolve_basis(x[:, 50:], window))
+
+
+def test_boost_batch():
+    "Test boosting several signals together"
+    rng = np.random.RandomState(0)
+    x = rng.normal(0, 1, (2, 1000))
+    h = rng.normal(0, 1, (3, 2, 10))
+    y = np.array([sum(np.convolve(h_, x_)[:1000] for h_, x_ in zip(hs, x))
+                  for hs in h])
+    y += rng.normal(0, 1, y.shape)
+    for segno in (0, 4):
+        hs = boost_batch(x, y, 10, 0.005, 10, segno, 0.0025, 'l2')
+        for y_, h_ in zip(y, hs):
+            assert_allclose(h_, boost_1seg(x, y_, 10, 0.005, 10, segno, 0.0025, 'l2'))
+
+
 def test_boosting_func():
     "Test boosting() against svdboostV4pred.m"
     # 1d-TRF
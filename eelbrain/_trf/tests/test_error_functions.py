@@ -1,7 +1,9 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
 from nose.tools import assert_almost_equal
 import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
 
+from eelbrain._trf._boosting import LagGram, L2GramError, ResidualError
 from eelbrain._trf._boosting_opt import l1, l2
 
 PRECISION = 10
@@ -26,3 +28,35 @@ def test_error_functions():
 
     assert_almost_equal(l1(x, index), np_l1(x), PRECISION)
     assert_almost_equal(l2(x, index), np_l2(x), PRECISION)
+
+
+def test_l2_gram():
+    "Test incremental l2 error against the residual"
+    rng = np.random.RandomState(0)
+    x = rng.normal(0, 1, (3, 200))
+    y = rng.normal(0, 1, (2, 200))
+    train_index = np.array(((0, 80), (120, 200)), np.int64)
+    test_index = np.array(((80, 120),), np.int64)
+    gram = LagGram(x, train_index, test_index, 10)
+    residuals = [ResidualError(y_, x, train_index, test_index, 'l2') for y_ in y]
+    incremental = L2GramError(y, x, gram)
+    index = np.arange(2)
+    error = np.empty((3, 10))
+    sign = np.empty((3, 10), np.int8)
+    error_ = np.empty((2, 3, 10))
+    sign_ = np.empty((2, 3, 10), np.int8)
+    for i_stim, i_time, delta in (((0, 1), (0, 3), (0.1, 0.1)),
+                                  ((2, 2), (9, 9), (-0.1, 0.05)),
+                                  ((1, 0), (4, 0), (0.05, 0.1))):
+        incremental.options(index, np.array((0.1, 0.05)), error_, sign_)
+        for i, (residual, d) in enumerate(zip(residuals, (0.1, 0.05))):
+            assert_allclose(np.array(incremental.evaluate(i)),
+                            residual.evaluate())
+            residual.options(d, error, sign)
+            assert_allclose(error_[i], error)
+            assert_array_equal(sign_[i], sign)
+            residual.update(i_stim[i], i_time[i], delta[i])
+        incremental.update(index, np.array(i_stim), np.array(i_time),
+                           np.array(delta))
+    for i, residual in enumerate(residuals):
+        assert_allclose(np.array(incremental.evaluate(i)), residual.evaluate())
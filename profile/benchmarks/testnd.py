@@ -0,0 +1,137 @@
+# Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
+"""Permutation test throughput
+
+Each benchmark runs one mass-univariate test with permutations. Parameters
+are the test function, the kind of test (``raw``: maximum statistic,
+``cluster``: cluster mass, ``tfce``: threshold-free cluster enhancement) and
+the number of worker processes (:func:`eelbrain.configure`).
+
+``track_permutations_per_second`` only counts the time spent on permutations
+(from :attr:`~eelbrain.testnd.NDTest.timing`), not setting up the data,
+computing the original map and clusters, or packaging the result.
+``peakmem_test`` measures the peak memory of the main process only; with
+``n_workers > 0`` it does not include the worker processes, whose buffers are
+tracked by ``track_permutation_memory``.
+
+Usage::
+
+    $ cd profile
+    $ asv run
+    $ asv run --bench SensorSpace.track_permutations_per_second
+"""
+import numpy as np
+from scipy import ndimage
+
+from eelbrain import NDVar, Scalar, UTS, configure, datasets, testnd
+
+
+TESTS = ('ttest_1samp', 'ttest_rel', 'ttest_ind', 'anova', 'corr')
+KINDS = ('raw', 'cluster', 'tfce')
+N_WORKERS = (0, 2)
+THRESHOLD_ARGS = {'raw': {}, 'cluster': {'pmin': 0.05}, 'tfce': {'tfce': True}}
+
+
+def source_space_dataset(n_rows=30, n_cols=30, n_times=50, seed=0):
+    """Dataset with a synthetic source space NDVar called ``'src'``
+
+    Sources are vertices of a triangulated ``n_rows`` by ``n_cols`` lattice,
+    which has the same neighborhood structure as an icosahedral source space
+    (custom connectivity, 6 neighbors per source).
+    """
+    ds = datasets.get_uts(seed=seed)
+    index = np.arange(n_rows * n_cols).reshape((n_rows, n_cols))
+    edges = np.vstack((
+        np.column_stack((index[:, :-1].ravel(), index[:, 1:].ravel())),
+        np.column_stack((index[:-1].ravel(), index[1:].ravel())),
+        np.column_stack((index[:-1, :-1].ravel(), index[1:, 1:].ravel())),
+    ))
+    edges.sort(1)
+    edges = edges[np.lexsort(edges.T[::-1])]
+    source = Scalar('source', np.arange(index.size),
+                    connectivity=edges.astype(np.uint32))
+    time = UTS(0, 0.01, n_times)
+
+    y = np.random.normal(0, 1, (ds.n_cases, n_rows, n_cols, n_times))
+    y = ndimage.gaussian_filter(y, (0, 2, 2, 1))
+    y /= y.std()
+    # effect of A in a patch
+    y[:30, 5:15, 5:15, 10:40] += np.hanning(30) * 0.5
+    ds['src'] = NDVar(y.reshape((ds.n_cases, index.size, n_times)),
+                      ('case', source, time))
+    return ds
+
+
+def run_test(test, y, ds, samples, kind):
+    kwargs = dict(ds=ds, samples=samples, **THRESHOLD_ARGS[kind])
+    if test == 'ttest_1samp':
+        return testnd.ttest_1samp(y, **kwargs)
+    elif test == 'ttest_rel':
+        return testnd.ttest_rel(y, 'A', 'a1', 'a0', 'rm', **kwargs)
+    elif test == 'ttest_ind':
+        return testnd.ttest_ind(y, 'A', 'a1', 'a0', **kwargs)
+    elif test == 'anova':
+        return testnd.anova(y, 'A * B', **kwargs)
+    elif test == 'corr':
+        return testnd.corr(y, 'Y', **kwargs)
+    else:
+        raise ValueError("test=%r" % (test,))
+
+
+class PermutationBenchmark(object):
+    "Base class, subclasses define ``make_dataset()``, ``y`` and ``samples``"
+    params = (TESTS, KINDS, N_WORKERS)
+    param_names = ('test', 'kind', 'n_workers')
+    timeout = 600
+    y = None
+    samples = None
+
+    def make_dataset(self):
+        raise NotImplementedError
+
+    def setup(self, test, kind, n_workers):
+        configure(n_workers=n_workers or False)
+        self.ds = self.make_dataset()
+
+    def teardown(self, test, kind, n_workers):
+        configure(n_workers=True)
+
+    def time_test(self, test, kind, n_workers):
+        run_test(test, self.y, self.ds, self.samples, kind)
+
+    def peakmem_test(self, test, kind, n_workers):
+        "Peak memory of the main process (excluding worker processes)"
+        run_test(test, self.y, self.ds, self.samples, kind)
+
+    def track_permutations_per_second(self, test, kind, n_workers):
+        res = run_test(test, self.y, self.ds, self.samples, kind)
+        timing = res.timing
+        t = timing['total'] - timing['data'] - timing['finalize']
+        return timing['n_permutations'] / t
+    track_permutations_per_second.unit = 'permutations/s'
+
+    def track_permutation_memory(self, test, kind, n_workers):
+        "Shared data and the buffers of all processes computing permutations"
+        res = run_test(test, self.y, self.ds, self.samples, kind)
+        timing = res.timing
+        memory = timing['memory']
+        n_processes = max(1, len(timing['workers']))
+        return memory['data'] + memory['buffers'] * n_processes
+    track_permutation_memory.unit = 'bytes'
+
+
+class SensorSpace(PermutationBenchmark):
+    "Sensor by time data with sensor connectivity"
+    y = 'utsnd'
+    samples = 1000
+
+    def make_dataset(self):
+        return datasets.get_uts(utsnd=True)
+
+
+class SourceSpace(PermutationBenchmark):
+    "Synthetic source space by time data"
+    y = 'src'
+    samples = 100
+
+    def make_dataset(self):
+        return source_space_dataset()
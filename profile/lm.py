@@ -29,8 +29,8 @@ f_map = np.empty((n_fs, n_tests))
 effects = np.array([[0, 2], [2, 1]], dtype=np.int16)
 df_res = n_cases - n_betas - 1
 
-print "n_cases=%i; n_tests=%i; n_betas=%i" % (n_cases, n_tests, n_betas)
-print "timeit opt.lm_betas(y, x, xsinv, betas)"
-print "timeit -n1000 opt.lm_res_ss(y, x, xsinv, ss)"
-print "timeit -n1000 opt._anova_fmaps(y, x, xsinv, f_map, effects, df_res)"
-print "timeit opt._ss(y, ss)"
+print("n_cases=%i; n_tests=%i; n_betas=%i" % (n_cases, n_tests, n_betas))
+print("timeit opt.lm_betas(y, x, xsinv, betas)")
+print("timeit -n1000 opt.lm_res_ss(y, x, xsinv, ss)")
+print("timeit -n1000 opt._anova_fmaps(y, x, xsinv, f_map, effects, df_res)")
+print("timeit opt._ss(y, ss)")
@@ -15,7 +15,6 @@ if not os.path.exists(fname):
 
 
 setup = '''
-from itertools import izip
 import numpy as np
 import scipy as sp
 from eelbrain.lab import stats, load
@@ -33,7 +32,7 @@ all_adjacent = False
 flat_shape = (y.shape[0], np.prod(y.shape[1:]))
 connectivity_src, connectivity_dst = source.connectivity().T
 conn = {src:[] for src in np.unique(connectivity_src)}
-for src, dst in izip(connectivity_src, connectivity_dst):
+for src, dst in zip(connectivity_src, connectivity_dst):
     conn[src].append(dst)
 criteria=None
 ''' % fname
@@ -44,6 +43,6 @@ stats.testnd._label_clusters(y, out, bin_buff, int_buff, threshold, tail, struct
 
 timer = timeit.Timer(stmt, setup)
 times = timer.repeat(100, 1)
-print times
-print "min = %s" % min(times)
-print "avg of 10 lowest = %s" % (sum(sorted(times)[:10]) / 10)
+print(times)
+print("min = %s" % min(times))
+print("avg of 10 lowest = %s" % (sum(sorted(times)[:10]) / 10))